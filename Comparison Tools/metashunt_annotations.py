@@ -0,0 +1,223 @@
+import numpy as np
+import csv
+import sys
+import metashunt_report
+from metashunt_drift import TIME_WARP, fit_time_warp
+
+# Firmware event annotations overlaid on a capture, with charge, energy and peak current per event.
+#
+# Annotations are CSV rows of host_time_s, event and an optional edge (start, end or point).
+# start/end rows of the same event pair up one to one: each start takes the first end before the
+# next start of that event, and starts or ends left over are counted as unmatched. Point events (boot, sensor read)
+# last until the next point event. Host times are mapped to device time, in seconds from the first
+# sample of the capture, by a TIME_WARP: a constant offset, or offset plus skew fitted to sync
+# pairs. The intervals are kept sorted by start with a running maximum of their ends, which makes
+# overlap queries two binary searches.
+#
+# Per interval statistics are computed for every interval at once. Charge comes from the
+# cumulative charge curve with each sample held until the next, which is linear between
+# samples, so two interpolations give exact charge. Peaks come from the maximum of each
+# elementary segment between interval boundaries, followed by a sparse table over those
+# segments with only as many levels as the widest interval needs.
+
+EDGE_START = "start"
+EDGE_END = "end"
+EDGE_POINT = "point"
+
+def display_how_to_use():
+    print("To use, follow these rules:")
+    print("python metashunt_annotations.py capture annotations_csv output_csv [clock] --- Charge, energy and peak current for every annotated interval")
+    print("annotations_csv rows are host_time_s,event[,edge] with edge start, end or point (the default)")
+    print("clock is either host_offset_s (device time = host time + offset) or a CSV of host_time_s,device_time_s sync pairs to fit offset and skew")
+    print("Captures follow metashunt_report.py: MetaShunt logs or .mscap by default, prefix with otii: or model: for other file types")
+
+# Returns (host_time_s, event names, edges) read from an annotation CSV
+def read_annotation_file(filename):
+    times, names, edges = [], [], []
+    with open(filename, newline="") as f:
+        for row in csv.reader(f):
+            if not row:
+                continue
+            try:
+                t = float(row[0])
+            except ValueError:
+                continue  # Header or comment
+            times.append(t)
+            names.append(row[1].strip())
+            edges.append(row[2].strip().lower() if len(row) > 2 and row[2].strip() else EDGE_POINT)
+    return np.array(times), np.array(names, dtype=object), np.array(edges, dtype=object)
+
+def read_clock_map(argument):
+    try:
+        return TIME_WARP([float(argument), 0.0])
+    except ValueError:
+        pass
+    pairs = np.loadtxt(argument, delimiter=",", skiprows=1, ndmin=2)
+    host_s, device_s = pairs[:, 0], pairs[:, 1]
+    if len(host_s) == 1:
+        return TIME_WARP([device_s[0] - host_s[0], 0.0])
+    return fit_time_warp(host_s, device_s - host_s)
+
+class ANNOTATIONS:
+    def __init__(self, names, starts_s, ends_s, unmatched_starts=0, unmatched_ends=0):
+        order = np.argsort(starts_s, kind="stable")
+        self.names = np.asarray(names, dtype=object)[order]
+        self.starts_s = np.asarray(starts_s, dtype=np.float64)[order]
+        self.ends_s = np.asarray(ends_s, dtype=np.float64)[order]
+        self.max_end_s = np.maximum.accumulate(self.ends_s) if len(self.ends_s) else self.ends_s
+        self.event_names, self.codes = np.unique(self.names.astype(str), return_inverse=True)
+        self.unmatched_starts = unmatched_starts  # start rows with no end before the next start
+        self.unmatched_ends = unmatched_ends  # end rows no start claimed
+
+    def __len__(self):
+        return len(self.starts_s)
+
+    # Indices of intervals that overlap [start_s, end_s)
+    def overlapping(self, start_s, end_s):
+        first = np.searchsorted(self.max_end_s, start_s, side="right")
+        last = np.searchsorted(self.starts_s, end_s, side="left")
+        candidates = np.arange(first, last)
+        return candidates[self.ends_s[candidates] > start_s]
+
+# Builds intervals from annotation rows already in device time
+def build_annotations(device_s, names, edges):
+    order = np.argsort(device_s, kind="stable")
+    device_s, names, edges = device_s[order], names[order], edges[order]
+    interval_names, starts, ends = [], [], []
+    unmatched_starts, unmatched_ends = 0, 0
+
+    # start/end pairs, matched per event name in time order
+    for name in np.unique(names[edges != EDGE_POINT].astype(str)):
+        mine = names.astype(str) == name
+        start_times = device_s[mine & (edges == EDGE_START)]
+        end_times = device_s[mine & (edges == EDGE_END)]
+        # Each start takes the first end after it, unless the next start comes first, so no end
+        # is shared and a lost end never stretches an interval over the next one
+        k = np.searchsorted(end_times, start_times, side="left")
+        # Back to back intervals: an end at the same time as the next start belongs to the earlier one
+        if len(end_times):
+            k[1:] += (k[1:] == k[:-1]) & (end_times[np.minimum(k[1:], len(end_times) - 1)] == start_times[1:])
+        next_start = np.append(start_times[1:], np.inf)
+        paired = k < len(end_times)
+        paired[paired] = end_times[k[paired]] <= next_start[paired]
+        unmatched_starts += int(len(start_times) - paired.sum())
+        unmatched_ends += int(len(end_times) - paired.sum())
+        interval_names.append(np.full(paired.sum(), name, dtype=object))
+        starts.append(start_times[paired])
+        ends.append(end_times[k[paired]])
+
+    # Point events last until the next point event
+    points = edges == EDGE_POINT
+    point_times = device_s[points]
+    if len(point_times) > 1:
+        interval_names.append(names[points][:-1])
+        starts.append(point_times[:-1])
+        ends.append(point_times[1:])
+
+    if not starts:
+        return ANNOTATIONS(np.zeros(0, dtype=object), np.zeros(0), np.zeros(0))
+    return ANNOTATIONS(np.concatenate(interval_names), np.concatenate(starts), np.concatenate(ends),
+                       unmatched_starts, unmatched_ends)
+
+# Maximum of values[lo[k]:hi[k]] for every k, with lo < hi
+def range_max(values, lo, hi):
+    boundaries = np.unique(np.concatenate((lo, hi)))
+    boundaries = boundaries[boundaries < len(values)]
+    segment_max = np.maximum.reduceat(values, boundaries)
+    first = np.searchsorted(boundaries, lo)
+    last = np.searchsorted(boundaries, hi)  # Exclusive
+    span = last - first
+
+    levels = [segment_max]
+    while (1 << len(levels)) <= span.max():
+        previous = levels[-1]
+        width = 1 << (len(levels) - 1)
+        levels.append(np.maximum(previous[:-width], previous[width:]))
+
+    level = np.floor(np.log2(np.maximum(span, 1))).astype(np.int64)
+    result = np.empty(len(lo), dtype=values.dtype)
+    for k, table in enumerate(levels):
+        use = level == k
+        if use.any():
+            result[use] = np.maximum(table[first[use]], table[last[use] - (1 << k)])
+    return result
+
+# Structured array of per interval results in device time
+interval_stats_dtype = np.dtype([
+    ("start_s", np.float64),
+    ("end_s", np.float64),
+    ("charge_uAh", np.float64),
+    ("energy_mWh", np.float64),
+    ("mean_ua", np.float64),
+    ("peak_ua", np.float64),
+])
+
+def interval_stats(t_s, current_ua, annotations, voltage=3.3):
+    t_s = np.asarray(t_s, dtype=np.float64)
+    current_ua = np.asarray(current_ua)
+    dt = np.diff(t_s)
+    last_dt = dt[-1] if len(dt) else 0.0
+    t_ext = np.append(t_s, t_s[-1] + last_dt)
+    charge_uAs = np.concatenate(([0.0], np.cumsum(current_ua * np.append(dt, last_dt), dtype=np.float64)))
+
+    stats = np.zeros(len(annotations), dtype=interval_stats_dtype)
+    stats["start_s"] = annotations.starts_s
+    stats["end_s"] = annotations.ends_s
+    inside = (annotations.starts_s >= t_ext[0]) & (annotations.ends_s <= t_ext[-1]) & (annotations.ends_s > annotations.starts_s)
+
+    charge = np.interp(annotations.ends_s, t_ext, charge_uAs) - np.interp(annotations.starts_s, t_ext, charge_uAs)
+    stats["charge_uAh"] = np.where(inside, charge / 3600.0, np.nan)
+    stats["energy_mWh"] = stats["charge_uAh"] * voltage * 1.0e-3
+    with np.errstate(divide="ignore", invalid="ignore"):
+        stats["mean_ua"] = np.where(inside, charge / (annotations.ends_s - annotations.starts_s), np.nan)
+
+    # The sample in effect at the start through the last sample before the end
+    lo = np.clip(np.searchsorted(t_s, annotations.starts_s, side="right") - 1, 0, len(t_s) - 1)
+    hi = np.maximum(np.searchsorted(t_s, annotations.ends_s, side="left"), lo + 1)
+    stats["peak_ua"] = np.nan
+    if inside.any():
+        stats["peak_ua"][inside] = range_max(current_ua, lo[inside], hi[inside])
+    return stats
+
+# Per event name: count, mean charge, total energy
+def summarize_by_event(annotations, stats):
+    valid = ~np.isnan(stats["charge_uAh"])
+    codes = annotations.codes[valid]
+    n = len(annotations.event_names)
+    count = np.bincount(codes, minlength=n)
+    charge = np.bincount(codes, weights=stats["charge_uAh"][valid], minlength=n)
+    energy = np.bincount(codes, weights=stats["energy_mWh"][valid], minlength=n)
+    peak = np.full(n, -np.inf)
+    np.maximum.at(peak, codes, stats["peak_ua"][valid])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return [{"Event": str(name), "Count": int(c), "Mean charge (uAh)": float(q / c) if c else float("nan"),
+                 "Total energy (mWh)": float(e), "Peak current (uA)": float(p) if c else float("nan")}
+                for name, c, q, e, p in zip(annotations.event_names, count, charge, energy, peak)]
+
+def write_interval_stats(filename, annotations, stats):
+    with open(filename, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["event", "start_s", "end_s", "duration_s", "charge_uAh", "energy_mWh", "mean_ua", "peak_ua"])
+        columns = [annotations.names, stats["start_s"], stats["end_s"], stats["end_s"] - stats["start_s"],
+                   stats["charge_uAh"], stats["energy_mWh"], stats["mean_ua"], stats["peak_ua"]]
+        writer.writerows(zip(*columns))
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 4:
+        print("Please provide a capture, an annotation file and an output file")
+        display_how_to_use()
+        sys.exit()
+
+    profile = metashunt_report.load_capture(sys.argv[1])
+    clock_map = read_clock_map(sys.argv[4]) if len(sys.argv) > 4 else TIME_WARP([0.0, 0.0])
+    host_s, names, edges = read_annotation_file(sys.argv[2])
+    annotations = build_annotations(clock_map.apply(host_s), names, edges)
+    stats = interval_stats(profile.t_s, profile.current_ua, annotations, profile.voltage)
+    write_interval_stats(sys.argv[3], annotations, stats)
+
+    print("{0} intervals from {1} annotations, results written to {2}".format(len(annotations), len(host_s), sys.argv[3]))
+    if annotations.unmatched_starts or annotations.unmatched_ends:
+        print("Skipped {0} start and {1} end rows with no partner".format(annotations.unmatched_starts, annotations.unmatched_ends))
+    for summary in summarize_by_event(annotations, stats):
+        print("{Event:<20} {Count:>8}  mean {Mean charge (uAh):.6g} uAh  total {Total energy (mWh):.6g} mWh  peak {Peak current (uA):.6g} uA".format(**summary))
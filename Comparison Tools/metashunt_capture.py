@@ -0,0 +1,430 @@
+import numpy as np
+import struct
+import json
+import zlib
+import sys
+
+# Compact block-compressed storage for MetaShunt captures (.mscap).
+#
+# Samples are stored as device ticks (int64) and currents in uA. They are grouped in blocks that
+# can each be decoded on their own:
+#   ticks    - first tick in the block header, then tick deltas packed into the narrowest
+#              unsigned width that fits. Streams have near constant deltas, so they compress well.
+#   currents - lossless: the raw float64 bits, byte shuffled so the similar exponent bytes sit
+#              together. current_dtype=np.float32 halves this but is only lossless for data
+#              that was float32 to begin with.
+#              quantized: rounded to a step of 2 * max_error_ua, then delta encoded as the
+#              narrowest signed width. Long runs at a sleep floor become runs of zeros.
+# Each part is then zlib compressed.
+#
+# File layout: magic, blocks..., block index (NumPy structured array), metadata JSON, trailer.
+# The trailer gives the index and metadata sizes so a reader can seek straight to any block.
+#
+# The block index is also a sparse timestamp index. Each entry carries its tick range and
+# precomputed sums, so a time range query binary searches the index, decodes at most the two
+# blocks at the edges of the range and takes everything in between from the block sums.
+
+CAPTURE_MAGIC = b"MSCAP1\x00\x00"
+CAPTURE_TRAILER_MAGIC = b"MSCAPEND"
+CAPTURE_EXTENSION = ".mscap"
+CAPTURE_VERSION = 2
+
+DEFAULT_BLOCK_SAMPLES = 65536
+DEFAULT_TICKS_PER_US = 4.0
+TICK_WRAP = 1 << 32
+
+CURRENT_LOSSLESS = 0
+CURRENT_QUANTIZED = 1
+
+block_header_struct = struct.Struct("<IqBBII")
+trailer_struct = struct.Struct("<QQ8s")
+
+# Per block position and sums. charge_ua_ticks is the sample and hold integral between the block's
+# own samples; the hold from its last sample to the next block's first is added from last_ua.
+block_index_dtype = np.dtype([
+    ("first_tick", "<i8"),
+    ("last_tick", "<i8"),
+    ("first_sample", "<i8"),
+    ("count", "<i8"),
+    ("offset", "<i8"),
+    ("length", "<i8"),
+    ("sum_ua", "<f8"),
+    ("sum_sq_ua", "<f8"),
+    ("min_ua", "<f8"),
+    ("max_ua", "<f8"),
+    ("charge_ua_ticks", "<f8"),
+    ("last_ua", "<f8"),
+])
+
+unsigned_widths = [np.uint8, np.uint16, np.uint32, np.uint64]
+signed_widths = [np.int8, np.int16, np.int32, np.int64]
+
+def display_how_to_use():
+    print("To use, follow these rules:")
+    print("python metashunt_capture.py c input_csv output_mscap [max_error_uA] --- Compress a MetaShunt CSV log, lossless unless a max error is given")
+    print("python metashunt_capture.py x input_mscap output_csv --- Decompress a capture back to a MetaShunt CSV log")
+    print("python metashunt_capture.py i input_mscap --- Print capture information")
+    print("python metashunt_capture.py q input_mscap start_s end_s --- Print current statistics and charge between two times")
+
+def narrowest(values, widths):
+    if len(values) == 0:
+        return widths[0]
+    low = values.min()
+    high = values.max()
+    for width in widths:
+        info = np.iinfo(width)
+        if low >= info.min and high <= info.max:
+            return width
+    return widths[-1]
+
+# Currents exactly as a reader will decode them
+def stored_currents(currents_ua, current_mode, quantization_step):
+    if current_mode == CURRENT_LOSSLESS:
+        return currents_ua
+    return np.rint(currents_ua.astype(np.float64) / quantization_step) * quantization_step
+
+def block_summary(ticks, currents_ua):
+    c = currents_ua.astype(np.float64)
+    return (float(np.sum(c)), float(np.dot(c, c)), float(np.min(c)), float(np.max(c)),
+            float(np.dot(c[:-1], np.diff(ticks))), float(c[-1]))
+
+def encode_block(ticks, currents_ua, current_mode, quantization_step, compression_level):
+    n = len(ticks)
+    deltas = np.diff(ticks)
+    if len(deltas) and deltas.min() < 0:
+        raise ValueError("Capture ticks must not decrease")
+    delta_width = narrowest(deltas, unsigned_widths)
+    tick_bytes = zlib.compress(deltas.astype(delta_width).tobytes(), compression_level)
+
+    if current_mode == CURRENT_LOSSLESS:
+        current_width = currents_ua.dtype.itemsize
+        shuffled = currents_ua.view(np.uint8).reshape(n, current_width).T
+        current_bytes = zlib.compress(np.ascontiguousarray(shuffled).tobytes(), compression_level)
+    else:
+        q = np.rint(currents_ua.astype(np.float64) / quantization_step).astype(np.int64)
+        dq = np.diff(q, prepend=0)
+        width = narrowest(dq, signed_widths)
+        current_width = np.dtype(width).itemsize
+        current_bytes = zlib.compress(dq.astype(width).tobytes(), compression_level)
+
+    header = block_header_struct.pack(n, int(ticks[0]), np.dtype(delta_width).itemsize, current_width,
+                                      len(tick_bytes), len(current_bytes))
+    return header + tick_bytes + current_bytes
+
+def decode_block(data, current_mode, current_dtype, quantization_step):
+    n, first_tick, delta_size, current_width, tick_len, current_len = block_header_struct.unpack_from(data, 0)
+    pos = block_header_struct.size
+    deltas = np.frombuffer(zlib.decompress(data[pos:pos + tick_len]), dtype="<u{0}".format(delta_size))
+    pos += tick_len
+
+    ticks = np.empty(n, dtype=np.int64)
+    ticks[0] = first_tick
+    np.cumsum(deltas, out=ticks[1:])
+    ticks[1:] += first_tick
+
+    raw = zlib.decompress(data[pos:pos + current_len])
+    if current_mode == CURRENT_LOSSLESS:
+        shuffled = np.frombuffer(raw, dtype=np.uint8).reshape(current_width, n)
+        currents_ua = np.ascontiguousarray(shuffled.T).view(current_dtype).reshape(n)
+    else:
+        dq = np.frombuffer(raw, dtype="<i{0}".format(current_width))
+        currents_ua = np.cumsum(dq, dtype=np.int64) * quantization_step
+    return ticks, currents_ua
+
+class CAPTURE_WRITER:
+    def __init__(self, filename, ticks_per_us=DEFAULT_TICKS_PER_US, max_error_ua=None, block_samples=DEFAULT_BLOCK_SAMPLES,
+                 current_dtype=np.float64, compression_level=6, metadata=None):
+        self.filename = filename
+        self.ticks_per_us = ticks_per_us
+        self.block_samples = int(block_samples)
+        self.current_dtype = np.dtype(current_dtype)
+        self.compression_level = compression_level
+        self.metadata = dict(metadata) if metadata else {}
+        if max_error_ua:
+            self.current_mode = CURRENT_QUANTIZED
+            # Slightly under 2x so float rounding never pushes the error past the bound
+            self.quantization_step = 2.0 * max_error_ua * (1.0 - 1.0e-9)
+        else:
+            self.current_mode = CURRENT_LOSSLESS
+            self.quantization_step = 0.0
+        self.max_error_ua = max_error_ua
+        # Quantization works from the full precision input
+        self.input_dtype = self.current_dtype if self.current_mode == CURRENT_LOSSLESS else np.dtype(np.float64)
+
+        self.f = open(filename, "wb")
+        self.f.write(CAPTURE_MAGIC)
+        self.index = []
+        self.num_samples = 0
+        self.pending_ticks = []
+        self.pending_currents = []
+        self.pending_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _write_block(self, ticks, currents_ua):
+        data = encode_block(ticks, currents_ua, self.current_mode, self.quantization_step, self.compression_level)
+        offset = self.f.tell()
+        self.f.write(data)
+        summary = block_summary(ticks, stored_currents(currents_ua, self.current_mode, self.quantization_step))
+        self.index.append((int(ticks[0]), int(ticks[-1]), self.num_samples, len(ticks), offset, len(data)) + summary)
+        self.num_samples += len(ticks)
+
+    def write(self, ticks, currents_ua):
+        ticks = np.asarray(ticks, dtype=np.int64)
+        currents_ua = np.asarray(currents_ua, dtype=self.input_dtype)
+        if len(ticks) == 0:
+            return
+        self.pending_ticks.append(ticks)
+        self.pending_currents.append(currents_ua)
+        self.pending_count += len(ticks)
+        if self.pending_count < self.block_samples:
+            return
+
+        ticks = np.concatenate(self.pending_ticks)
+        currents_ua = np.concatenate(self.pending_currents)
+        full = (len(ticks) // self.block_samples) * self.block_samples
+        for start in range(0, full, self.block_samples):
+            self._write_block(ticks[start:start + self.block_samples], currents_ua[start:start + self.block_samples])
+        self.pending_ticks = [ticks[full:]]
+        self.pending_currents = [currents_ua[full:]]
+        self.pending_count = len(ticks) - full
+
+    def close(self):
+        if self.f is None:
+            return
+        if self.pending_count:
+            self._write_block(np.concatenate(self.pending_ticks), np.concatenate(self.pending_currents))
+        index = np.array(self.index, dtype=block_index_dtype)
+        meta = {
+            "version": CAPTURE_VERSION,
+            "ticks_per_us": self.ticks_per_us,
+            "current_dtype": self.current_dtype.str,
+            "current_mode": self.current_mode,
+            "quantization_step": self.quantization_step,
+            "max_error_ua": self.max_error_ua,
+            "num_samples": self.num_samples,
+            "block_samples": self.block_samples,
+            "metadata": self.metadata,
+        }
+        index_bytes = index.tobytes()
+        meta_bytes = json.dumps(meta).encode("utf-8")
+        self.f.write(index_bytes)
+        self.f.write(meta_bytes)
+        self.f.write(trailer_struct.pack(len(index_bytes), len(meta_bytes), CAPTURE_TRAILER_MAGIC))
+        self.f.close()
+        self.f = None
+
+class CAPTURE_READER:
+    def __init__(self, filename):
+        self.filename = filename
+        self.f = open(filename, "rb")
+        if self.f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            self.f.close()
+            raise ValueError("{0} is not a MetaShunt capture".format(filename))
+
+        self.f.seek(-trailer_struct.size, 2)
+        trailer_offset = self.f.tell()
+        index_len, meta_len, magic = trailer_struct.unpack(self.f.read(trailer_struct.size))
+        if magic != CAPTURE_TRAILER_MAGIC:
+            self.f.close()
+            raise ValueError("{0} is truncated or was not closed".format(filename))
+        self.f.seek(trailer_offset - meta_len - index_len)
+        index_bytes = self.f.read(index_len)
+        self.meta = json.loads(self.f.read(meta_len).decode("utf-8"))
+        if self.meta["version"] != CAPTURE_VERSION:
+            self.f.close()
+            raise ValueError("{0} is capture version {1}, this reader supports version {2}".format(
+                filename, self.meta["version"], CAPTURE_VERSION))
+        self.index = np.frombuffer(index_bytes, dtype=block_index_dtype)
+        self.block_cache = {}
+
+        self.ticks_per_us = self.meta["ticks_per_us"]
+        self.current_mode = self.meta["current_mode"]
+        # Quantized currents come back as float64 so the error bound is not widened by rounding
+        self.current_dtype = np.dtype(self.meta["current_dtype"]) if self.current_mode == CURRENT_LOSSLESS else np.dtype(np.float64)
+        self.quantization_step = self.meta["quantization_step"]
+        self.num_samples = self.meta["num_samples"]
+        self.metadata = self.meta.get("metadata", {})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.num_samples
+
+    @property
+    def num_blocks(self):
+        return len(self.index)
+
+    def close(self):
+        self.f.close()
+
+    def read_block(self, k):
+        entry = self.index[k]
+        self.f.seek(int(entry["offset"]))
+        data = self.f.read(int(entry["length"]))
+        return decode_block(data, self.current_mode, self.current_dtype, self.quantization_step)
+
+    def cached_block(self, k):
+        if k not in self.block_cache:
+            if len(self.block_cache) >= 4:
+                self.block_cache.pop(next(iter(self.block_cache)))
+            self.block_cache[k] = self.read_block(k)
+        return self.block_cache[k]
+
+    # Times count from the first sample, or from tick 0 for a capture with no samples
+    def tick_at(self, t_s):
+        first_tick = int(self.index["first_tick"][0]) if self.num_blocks else 0
+        return first_tick + int(round(t_s * 1.0e6 * self.ticks_per_us))
+
+    # Blocks overlapping the tick range
+    def _block_range(self, start_tick, end_tick):
+        k0 = int(np.searchsorted(self.index["last_tick"], start_tick, side="left"))
+        k1 = int(np.searchsorted(self.index["first_tick"], end_tick, side="right")) - 1
+        return k0, k1
+
+    # Time each sample of block k is held for, up to the next sample, clipped to the tick range
+    def _hold_ticks(self, k, ticks, start_tick, end_tick):
+        next_tick = int(self.index["first_tick"][k + 1]) if k + 1 < self.num_blocks else int(ticks[-1])
+        held_until = np.append(ticks[1:], next_tick)
+        return np.clip(np.minimum(held_until, end_tick) - np.maximum(ticks, start_tick), 0, None)
+
+    # Samples with start_s <= t <= end_s, times in seconds from the first sample of the capture
+    def time_range(self, start_s, end_s):
+        start_tick = self.tick_at(start_s)
+        end_tick = self.tick_at(end_s)
+        k0, k1 = self._block_range(start_tick, end_tick)
+        ticks_parts, current_parts = [], []
+        for k in range(k0, k1 + 1):
+            ticks, currents_ua = self.cached_block(k) if k in (k0, k1) else self.read_block(k)
+            lo = int(np.searchsorted(ticks, start_tick, side="left"))
+            hi = int(np.searchsorted(ticks, end_tick, side="right"))
+            ticks_parts.append(ticks[lo:hi])
+            current_parts.append(currents_ua[lo:hi])
+        if not ticks_parts:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=self.current_dtype)
+        return np.concatenate(ticks_parts), np.concatenate(current_parts)
+
+    # Statistics between two times. Blocks entirely inside the range come from the index sums,
+    # so only the (at most two) edge blocks are read and decoded.
+    def aggregate(self, start_s, end_s):
+        start_tick = self.tick_at(start_s)
+        end_tick = self.tick_at(end_s)
+        result = {"samples": 0, "start_s": start_s, "end_s": end_s, "charge_uAh": 0.0}
+        if self.num_blocks == 0:
+            return result
+        k0, k1 = self._block_range(start_tick, end_tick)
+
+        count, total, total_sq, minimum, maximum, charge_ua_ticks = 0, 0.0, 0.0, [], [], 0.0
+        if k0 <= k1:
+            inner = self.index[k0 + 1:k1]
+            count = int(np.sum(inner["count"]))
+            total = float(np.sum(inner["sum_ua"]))
+            total_sq = float(np.sum(inner["sum_sq_ua"]))
+            minimum = [float(np.min(inner["min_ua"]))] if len(inner) else []
+            maximum = [float(np.max(inner["max_ua"]))] if len(inner) else []
+            charge_ua_ticks = float(np.sum(inner["charge_ua_ticks"]))
+            if len(inner):
+                # Hold from each inner block's last sample to the next block's first
+                charge_ua_ticks += float(np.dot(inner["last_ua"], self.index["first_tick"][k0 + 2:k1 + 1] - inner["last_tick"]))
+
+            for k in sorted({k0, k1}):
+                ticks, currents_ua = self.cached_block(k)
+                c = currents_ua.astype(np.float64)
+                in_range = c[(ticks >= start_tick) & (ticks <= end_tick)]
+                if len(in_range):
+                    count += len(in_range)
+                    total += float(np.sum(in_range))
+                    total_sq += float(np.dot(in_range, in_range))
+                    minimum.append(float(np.min(in_range)))
+                    maximum.append(float(np.max(in_range)))
+                charge_ua_ticks += float(np.dot(c, self._hold_ticks(k, ticks, start_tick, end_tick)))
+
+        # Range starting in the gap after the previous block, still holding its last sample. This
+        # also covers a range lying wholly inside a gap, which has no samples but still has charge.
+        if 0 < k0 < self.num_blocks:
+            first_tick = int(self.index["first_tick"][k0])
+            if start_tick < first_tick:
+                charge_ua_ticks += float(self.index["last_ua"][k0 - 1]) * (min(first_tick, end_tick) - start_tick)
+
+        ticks_per_s = self.ticks_per_us * 1.0e6
+        result["charge_uAh"] = charge_ua_ticks / ticks_per_s / 3600.0
+        span_ticks = min(end_tick, int(self.index["last_tick"][-1])) - max(start_tick, int(self.index["first_tick"][0]))
+        if span_ticks > 0:
+            result["time_weighted_mean_ua"] = charge_ua_ticks / span_ticks
+
+        result["samples"] = count
+        if count == 0:
+            return result
+        mean = total / count
+        result["mean_ua"] = mean
+        result["std_ua"] = float(np.sqrt(max(total_sq / count - mean * mean, 0.0)))
+        result["min_ua"] = min(minimum)
+        result["max_ua"] = max(maximum)
+        return result
+
+    def iter_blocks(self, start=0, stop=None):
+        stop = self.num_blocks if stop is None else stop
+        for k in range(start, stop):
+            yield self.read_block(k)
+
+    def read_all(self):
+        ticks = np.empty(self.num_samples, dtype=np.int64)
+        currents_ua = np.empty(self.num_samples, dtype=self.current_dtype)
+        for entry, (block_ticks, block_currents) in zip(self.index, self.iter_blocks()):
+            start = int(entry["first_sample"])
+            ticks[start:start + len(block_ticks)] = block_ticks
+            currents_ua[start:start + len(block_ticks)] = block_currents
+        return ticks, currents_ua
+
+def write_capture(filename, ticks, currents_ua, **kwargs):
+    with CAPTURE_WRITER(filename, **kwargs) as writer:
+        writer.write(ticks, currents_ua)
+
+def read_capture(filename):
+    with CAPTURE_READER(filename) as reader:
+        ticks, currents_ua = reader.read_all()
+        return ticks, currents_ua, reader.ticks_per_us
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 3:
+        display_how_to_use()
+        sys.exit()
+
+    command_character = sys.argv[1]
+    if command_character == 'c' and len(sys.argv) > 3:
+        data = np.loadtxt(sys.argv[2], delimiter=",", skiprows=1, ndmin=2)
+        ticks = np.rint(data[:,0] * DEFAULT_TICKS_PER_US).astype(np.int64)
+        max_error_ua = float(sys.argv[4]) if len(sys.argv) > 4 else None
+        write_capture(sys.argv[3], ticks, data[:,1], max_error_ua=max_error_ua)
+        print("Compressed {0} samples into {1}".format(len(ticks), sys.argv[3]))
+    elif command_character == 'x' and len(sys.argv) > 3:
+        ticks, currents_ua, ticks_per_us = read_capture(sys.argv[2])
+        csv_output = np.transpose(np.array([ticks / ticks_per_us, currents_ua]))
+        np.savetxt(sys.argv[3], csv_output, header='time [us], current [uA]', delimiter = ", ", comments='')
+        print("Decompressed {0} samples into {1}".format(len(ticks), sys.argv[3]))
+    elif command_character == 'i':
+        with CAPTURE_READER(sys.argv[2]) as reader:
+            print("Samples: {0}".format(reader.num_samples))
+            print("Blocks: {0}".format(reader.num_blocks))
+            if reader.num_blocks:
+                print("Duration: {0} s".format((reader.index["last_tick"][-1] - reader.index["first_tick"][0]) / reader.ticks_per_us / 1.0e6))
+            if reader.current_mode == CURRENT_QUANTIZED:
+                print("Quantized, max error {0} uA".format(reader.meta["max_error_ua"]))
+            else:
+                print("Lossless {0} currents".format(reader.current_dtype))
+    elif command_character == 'q' and len(sys.argv) > 4:
+        with CAPTURE_READER(sys.argv[2]) as reader:
+            result = reader.aggregate(float(sys.argv[3]), float(sys.argv[4]))
+            for key, value in result.items():
+                print("{0}: {1}".format(key, value))
+    else:
+        display_how_to_use()
@@ -0,0 +1,198 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# Clock drift estimation between two instruments recording the same DUT.
+#
+# A single t_shift only lines up one part of a long capture when the clocks run at slightly
+# different rates. Here both traces are resampled onto a common grid, a coarse constant offset
+# is found from the whole trace, and then short windows across the capture are cross-correlated
+# in parallel to measure the local offset. An offset plus skew line (or a continuous piecewise
+# linear curve) is fitted to those local offsets, weighted by correlation strength, and returned
+# as a TIME_WARP that maps the target's times onto the reference clock.
+#
+# The windows only search max_lag_s around the current estimate, so on a long capture with a
+# large skew only the windows near the middle line up on the first pass. The target is then
+# warped by that fit and the windows measured again, which brings more of them into range each
+# time, until the fit stops moving.
+
+class TIME_WARP:
+    def __init__(self, coefficients, knots=()):
+        self.coefficients = np.asarray(coefficients, dtype=np.float64)
+        self.knots = np.asarray(knots, dtype=np.float64)
+
+    @property
+    def offset_s(self):
+        return float(self.coefficients[0])
+
+    @property
+    def skew_ppm(self):
+        return float(self.coefficients[1]) * 1.0e6
+
+    def offset(self, t_s):
+        t_s = np.asarray(t_s, dtype=np.float64)
+        result = self.coefficients[0] + self.coefficients[1] * t_s
+        for knot, coefficient in zip(self.knots, self.coefficients[2:]):
+            result = result + coefficient * np.maximum(t_s - knot, 0.0)
+        return result
+
+    # Target clock to reference clock
+    def apply(self, t_s):
+        return np.asarray(t_s, dtype=np.float64) + self.offset(t_s)
+
+    # Reference clock to target clock. The warp is close to identity, so a few fixed point steps converge
+    def invert(self, t_ref_s, iterations=4):
+        t_ref_s = np.asarray(t_ref_s, dtype=np.float64)
+        t_s = t_ref_s - self.offset(t_ref_s)
+        for i in range(iterations):
+            t_s = t_ref_s - self.offset(t_s)
+        return t_s
+
+def hinge_basis(t_s, knots):
+    columns = [np.ones_like(t_s), t_s] + [np.maximum(t_s - knot, 0.0) for knot in knots]
+    return np.stack(columns, axis=1)
+
+def fit_time_warp(times_s, offsets_s, weights=None, n_segments=1, outlier_mad=3.0):
+    times_s = np.asarray(times_s, dtype=np.float64)
+    offsets_s = np.asarray(offsets_s, dtype=np.float64)
+    weights = np.ones_like(times_s) if weights is None else np.clip(np.asarray(weights, dtype=np.float64), 0.0, None)
+    knots = np.linspace(times_s.min(), times_s.max(), n_segments + 1)[1:-1] if n_segments > 1 else np.zeros(0)
+
+    design = hinge_basis(times_s, knots)
+    keep = weights > 0
+    # Two passes, dropping windows that locked onto the wrong peak
+    for attempt in range(2):
+        w = np.sqrt(weights[keep])
+        coefficients = np.linalg.lstsq(design[keep] * w[:, None], offsets_s[keep] * w, rcond=None)[0]
+        residuals = offsets_s - design @ coefficients
+        mad = np.median(np.abs(residuals[keep] - np.median(residuals[keep])))
+        if mad == 0:
+            break
+        keep = keep & (np.abs(residuals) <= outlier_mad * 1.4826 * mad)
+        if keep.sum() < design.shape[1]:
+            break
+    return TIME_WARP(coefficients, knots)
+
+def resample(t_s, y, grid_s):
+    return np.interp(grid_s, t_s, y, left=np.nan, right=np.nan)
+
+def correlate_valid(long_segment, short_segment):
+    n = len(long_segment) + len(short_segment)
+    nfft = 1 << (n - 1).bit_length()
+    spectrum = np.fft.rfft(long_segment, nfft) * np.conj(np.fft.rfft(short_segment, nfft))
+    return np.fft.irfft(spectrum, nfft)[:len(long_segment) - len(short_segment) + 1]
+
+def peak_with_subsample(values):
+    k = int(np.argmax(values))
+    if 0 < k < len(values) - 1:
+        a, b, c = values[k - 1], values[k], values[k + 1]
+        denominator = a - 2.0 * b + c
+        if denominator != 0:
+            return k + 0.5 * (a - c) / denominator, b
+    return float(k), values[k]
+
+# Best constant offset (s) to add to the target times, from the whole overlapping trace
+def coarse_offset(ref_t_s, ref_y, t_s, y, max_offset_s, num_points=1 << 16):
+    start = min(ref_t_s[0], t_s[0]) - max_offset_s
+    end = max(ref_t_s[-1], t_s[-1]) + max_offset_s
+    fs = (num_points - 1) / (end - start)
+    grid = start + np.arange(num_points) / fs
+    ref = np.nan_to_num(resample(ref_t_s, ref_y, grid) - np.mean(ref_y))
+    target = np.nan_to_num(resample(t_s, y, grid) - np.mean(y))
+    max_lag = int(np.ceil(max_offset_s * fs))
+    padded = np.concatenate((np.zeros(max_lag), target, np.zeros(max_lag)))
+    lag, peak = peak_with_subsample(correlate_valid(padded, ref))
+    return -(lag - max_lag) / fs
+
+def window_offset(ref_grid, target_grid, start, window, max_lag):
+    ref = ref_grid[start:start + window]
+    target = target_grid[start - max_lag:start + window + max_lag]
+    if np.isnan(ref).any() or np.isnan(target).any():
+        return None
+    ref = ref - ref.mean()
+    target = target - target.mean()
+    ref_norm = np.sqrt(np.dot(ref, ref))
+    if ref_norm == 0:
+        return None
+    corr = correlate_valid(target, ref)
+    energy = np.concatenate(([0.0], np.cumsum(target * target)))
+    target_norm = np.sqrt(np.maximum(energy[window:] - energy[:-window], 1.0e-30))
+    lag, peak = peak_with_subsample(corr / (ref_norm * target_norm))
+    return lag - max_lag, peak
+
+# Local offsets of windows across the capture, measured around the offsets the warp already gives.
+# Returns (window times in target clock, offsets, correlation peaks)
+def window_offsets(ref_t_s, ref_y, t_s, y, fs, warp, window_s, step_s, max_lag_s, workers=None):
+    warped_t_s = warp.apply(t_s)
+
+    start = max(ref_t_s[0], warped_t_s[0])
+    end = min(ref_t_s[-1], warped_t_s[-1])
+    if end - start < window_s:
+        raise ValueError("Captures overlap for less than one window")
+    grid = np.arange(start, end, 1.0 / fs)
+    ref_grid = resample(ref_t_s, ref_y, grid)
+    target_grid = resample(warped_t_s, y, grid)
+
+    window = int(round(window_s * fs))
+    max_lag = int(round(max_lag_s * fs))
+    starts = np.arange(max_lag, len(grid) - window - max_lag, max(int(round(step_s * fs)), 1))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda s: window_offset(ref_grid, target_grid, s, window, max_lag), starts))
+
+    center_refs, lags, peaks = [], [], []
+    for s, result in zip(starts, results):
+        if result is None:
+            continue
+        lag, peak = result
+        center_refs.append(grid[s] + 0.5 * window_s)
+        lags.append(lag / fs)
+        peaks.append(peak)
+    center_refs, lags, peaks = np.array(center_refs), np.array(lags), np.array(peaks)
+    # Feature at reference time c shows up at warped target time c + lag, so unwarp that
+    centers = warp.invert(center_refs + lags)
+    return centers, center_refs - centers, peaks
+
+# Returns (TIME_WARP, window times in target clock, measured offsets, correlation peaks)
+def estimate_time_warp(ref_t_s, ref_y, t_s, y, fs, window_s=2.0, step_s=None, max_lag_s=0.05,
+                       max_offset_s=10.0, n_segments=1, min_correlation=0.5, max_iterations=8, workers=None):
+    ref_t_s = np.asarray(ref_t_s, dtype=np.float64)
+    t_s = np.asarray(t_s, dtype=np.float64)
+    step_s = window_s if step_s is None else step_s
+
+    warp = TIME_WARP([coarse_offset(ref_t_s, ref_y, t_s, y, max_offset_s), 0.0])
+    for iteration in range(max_iterations):
+        centers, offsets, peaks = window_offsets(ref_t_s, ref_y, t_s, y, fs, warp, window_s, step_s, max_lag_s, workers)
+        good = peaks >= min_correlation
+        if good.sum() < 2:
+            break
+        previous = warp
+        warp = fit_time_warp(centers[good], offsets[good], peaks[good], n_segments=n_segments)
+        # Done once the fit moves by less than a grid step anywhere in the capture
+        moved = np.max(np.abs(warp.offset(t_s[[0, -1]]) - previous.offset(t_s[[0, -1]])))
+        if len(warp.knots):
+            moved = max(moved, np.max(np.abs(warp.offset(warp.knots) - previous.offset(warp.knots))))
+        if moved < 1.0 / fs:
+            break
+    return warp, centers, offsets, peaks
+
+def estimate_profile_time_warp(profile, reference_profile, fs, **kwargs):
+    return estimate_time_warp(reference_profile.t_s, reference_profile.current_ua, profile.t_s, profile.current_ua, fs, **kwargs)
+
+# Applies a warp to a capture only as its samples are read
+class WARPED_CAPTURE:
+    def __init__(self, reader, time_warp):
+        self.reader = reader
+        self.time_warp = time_warp
+
+    # Samples between two reference clock times, with times in seconds on the reference clock
+    def time_range(self, start_s, end_s):
+        if self.reader.num_blocks == 0:
+            return np.zeros(0), np.zeros(0, dtype=self.reader.current_dtype)
+        target_start, target_end = self.time_warp.invert([start_s, end_s])
+        ticks, currents_ua = self.reader.time_range(target_start, target_end)
+        t_s = (ticks - int(self.reader.index["first_tick"][0])) / (self.reader.ticks_per_us * 1.0e6)
+        return self.time_warp.apply(t_s), currents_ua
+
+    def aggregate(self, start_s, end_s):
+        target_start, target_end = self.time_warp.invert([start_s, end_s])
+        return self.reader.aggregate(float(target_start), float(target_end))
@@ -0,0 +1,175 @@
+import numpy as np
+import sys
+import os
+import metashunt_capture
+
+# Ensemble averaging of repeated triggered captures.
+#
+# Each event is a burst of samples with the trigger at a known sample index. The true trigger
+# instant usually falls between two samples, so it is refined by interpolating where the
+# current crosses the trigger level. All events are then stacked into one (events x samples)
+# array, shifted by their fractional trigger position with linear interpolation, over the
+# largest window every event covers. Bursts are sampled at a fixed rate, so the alignment and
+# all statistics are plain array operations on the stack with no per-event Python loop.
+# Events are padded and interpolated batch_events at a time into the preallocated stack, so
+# the float64 interpolation temporaries never exceed one batch however many events there are.
+
+ENSEMBLE_PERCENTILES = (5.0, 25.0, 75.0, 95.0)
+DEFAULT_BATCH_EVENTS = 256
+
+def display_how_to_use():
+    print("To use, follow these rules:")
+    print("python metashunt_ensemble.py event_directory [level_uA] --- Average every event_*.mscap in the directory and plot the bands")
+    print("Give level_uA (the trigger level) to align events on the interpolated level crossing instead of the trigger sample")
+
+class ENSEMBLE:
+    def __init__(self, stack_ua, sample_period_us, pre_samples, trigger_positions):
+        self.stack_ua = stack_ua
+        self.sample_period_us = sample_period_us
+        self.pre_samples = pre_samples
+        self.trigger_positions = trigger_positions
+
+    def __len__(self):
+        return self.stack_ua.shape[0]
+
+    # Time of each column relative to the trigger
+    @property
+    def offsets_us(self):
+        return (np.arange(self.stack_ua.shape[1]) - self.pre_samples) * self.sample_period_us
+
+    @property
+    def mean_ua(self):
+        return self.stack_ua.mean(axis=0, dtype=np.float64)
+
+    @property
+    def median_ua(self):
+        return np.median(self.stack_ua, axis=0)
+
+    @property
+    def std_ua(self):
+        return self.stack_ua.std(axis=0, dtype=np.float64)
+
+    # Rows in the same order as q
+    def percentiles_ua(self, q=ENSEMBLE_PERCENTILES):
+        return np.percentile(self.stack_ua, q, axis=0)
+
+    # Charge of every event over the aligned window
+    @property
+    def event_charge_uAh(self):
+        return self.stack_ua.sum(axis=1, dtype=np.float64) * self.sample_period_us / 3.6e9
+
+# Fractional sample positions of the trigger. With a level, the crossing between the trigger
+# sample and the one before it is linearly interpolated.
+def refine_trigger_positions(currents_list, trigger_indices, level_ua=None):
+    positions = trigger_indices.astype(np.float64)
+    if level_ua is None:
+        return positions
+    ok = (trigger_indices > 0) & (trigger_indices < np.array([len(c) for c in currents_list]))
+    rows = np.flatnonzero(ok)
+    before = np.array([currents_list[k][trigger_indices[k] - 1] for k in rows], dtype=np.float64)
+    after = np.array([currents_list[k][trigger_indices[k]] for k in rows], dtype=np.float64)
+    step = after - before
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fraction = np.where(step != 0, (level_ua - before) / step, 1.0)
+    positions[ok] = trigger_indices[ok] - 1 + np.clip(fraction, 0.0, 1.0)
+    return positions
+
+# Events zero padded to a common width, with room for the sample after the last
+def pad_events(currents_list, dtype):
+    padded = np.zeros((len(currents_list), max(len(c) for c in currents_list) + 1), dtype=dtype)
+    for row, currents_ua in zip(padded, currents_list):
+        row[:len(currents_ua)] = currents_ua
+    return padded
+
+# currents_list: one array per event, trigger_indices: trigger sample in each event
+def align_events(currents_list, trigger_indices, sample_period_us, level_ua=None,
+                 pre_samples=None, post_samples=None, dtype=np.float32, batch_events=DEFAULT_BATCH_EVENTS):
+    trigger_indices = np.asarray(trigger_indices, dtype=np.int64)
+    lengths = np.array([len(c) for c in currents_list])
+    if len(lengths) == 0:
+        raise ValueError("No events to align")
+    batches = [slice(k, k + batch_events) for k in range(0, len(lengths), batch_events)]
+
+    positions = refine_trigger_positions(currents_list, trigger_indices, level_ua)
+
+    # Largest window that every event covers, so the stack has no gaps
+    available_pre = int(np.floor(positions.min()))
+    available_post = int(np.floor((lengths - 1 - positions).min()))
+    pre_samples = available_pre if pre_samples is None else min(pre_samples, available_pre)
+    post_samples = available_post if post_samples is None else min(post_samples, available_post)
+    if pre_samples + post_samples <= 0:
+        raise ValueError("Events share no common window around the trigger")
+
+    columns = np.arange(-pre_samples, post_samples + 1)
+    stack = np.empty((len(lengths), len(columns)), dtype=dtype)
+    for batch in batches:
+        padded = pad_events(currents_list[batch], dtype)
+        grid = positions[batch, None] + columns[None, :]
+        below = np.floor(grid).astype(np.int64)
+        fraction = (grid - below).astype(dtype)
+        lower = np.take_along_axis(padded, below, axis=1)
+        upper = np.take_along_axis(padded, below + 1, axis=1)
+        stack[batch] = lower + (upper - lower) * fraction
+    return ENSEMBLE(stack, sample_period_us, pre_samples, positions)
+
+# Works on SOFTWARE_TRIGGER events, using the median tick spacing as the sample period
+def align_trigger_events(events, ticks_per_us=metashunt_capture.DEFAULT_TICKS_PER_US, level_ua=None, **kwargs):
+    period_ticks = np.median(np.concatenate([np.diff(e.ticks) for e in events]))
+    return align_events([e.currents_ua for e in events], [e.trigger_index for e in events],
+                        period_ticks / ticks_per_us, level_ua=level_ua, **kwargs)
+
+# Reads saved event captures. Captures without a trigger index, such as burst logs, trigger at sample 0.
+def load_event_captures(paths):
+    currents_list, trigger_indices, periods_us = [], [], []
+    for path in paths:
+        with metashunt_capture.CAPTURE_READER(path) as reader:
+            ticks, currents_ua = reader.read_all()
+            trigger_indices.append(int(reader.metadata.get("trigger_index", 0)))
+            periods_us.append(np.median(np.diff(ticks)) / reader.ticks_per_us)
+        currents_list.append(currents_ua)
+    return currents_list, trigger_indices, float(np.median(periods_us))
+
+def plot_ensemble(ensemble, title="Triggered Event Ensemble"):
+    import matplotlib.pyplot as plt
+
+    t_ms = ensemble.offsets_us / 1000.0
+    p5, p25, p75, p95 = ensemble.percentiles_ua()
+    fig, (ax_current, ax_charge) = plt.subplots(2, 1)
+    ax_current.fill_between(t_ms, p5, p95, alpha=0.2, linewidth=0, label="5-95%")
+    ax_current.fill_between(t_ms, p25, p75, alpha=0.4, linewidth=0, label="25-75%")
+    ax_current.plot(t_ms, ensemble.mean_ua, label="Mean")
+    ax_current.plot(t_ms, ensemble.median_ua, label="Median", linestyle="--")
+    ax_current.set(xlabel='Time from trigger, ms', ylabel='Current, uA',
+        title='{0} ({1} events)'.format(title, len(ensemble)))
+    ax_current.grid()
+    ax_current.legend()
+
+    charge = ensemble.event_charge_uAh
+    ax_charge.hist(charge, bins=min(max(len(charge) // 10, 10), 100))
+    ax_charge.set(xlabel='Event charge, uAh', ylabel='Events',
+        title='Charge per event (mean {0:.4g} uAh, std {1:.3g} uAh)'.format(charge.mean(), charge.std()))
+    ax_charge.grid()
+
+    fig.tight_layout()
+    plt.show()
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 2:
+        print("Please provide a directory of event captures")
+        display_how_to_use()
+        sys.exit()
+
+    directory = sys.argv[1]
+    level_ua = float(sys.argv[2]) if len(sys.argv) > 2 else None
+    paths = sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(metashunt_capture.CAPTURE_EXTENSION))
+    if not paths:
+        print("No {0} files in {1}".format(metashunt_capture.CAPTURE_EXTENSION, directory))
+        sys.exit(1)
+
+    currents_list, trigger_indices, sample_period_us = load_event_captures(paths)
+    ensemble = align_events(currents_list, trigger_indices, sample_period_us, level_ua=level_ua)
+    charge = ensemble.event_charge_uAh
+    print("{0} events, window {1:.3f} ms, charge per event {2:.6g} +/- {3:.3g} uAh".format(
+        len(ensemble), ensemble.stack_ua.shape[1] * sample_period_us / 1000.0, charge.mean(), charge.std()))
+    plot_ensemble(ensemble)
@@ -0,0 +1,142 @@
+import numpy as np
+
+# Stateful streaming filters for current samples.
+#
+# Every filter takes chunks of (ticks, values) and returns the filtered (ticks, values), with one
+# vectorized call per chunk. The state needed to continue (IIR delay line, the last n - 1 inputs,
+# decimation phase) is carried to the next chunk, so feeding a stream in any chunking gives the
+# same output as filtering it in one piece. Filters work in the sample domain, and each output
+# keeps the tick of the newest input it depends on. scipy is only needed to design the IIR and
+# FIR coefficients.
+
+MEDIAN_BLOCK_SAMPLES = 1 << 16  # Outputs per np.median call, which copies width values for each
+
+class STREAM_FILTER:
+    # Samples between an input and the output that is centred on it
+    group_delay_samples = 0.0
+
+    def reset(self):
+        pass
+
+    def process(self, ticks, values):
+        raise NotImplementedError
+
+class IIR_LOWPASS(STREAM_FILTER):
+    def __init__(self, cutoff_hz, fs, order=2):
+        from scipy import signal
+
+        self.cutoff_hz = cutoff_hz
+        self.fs = fs
+        self.b, self.a = signal.butter(order, cutoff_hz, fs=fs)
+        self.lfilter = signal.lfilter
+        self.lfilter_zi = signal.lfilter_zi(self.b, self.a)
+        self.group_delay_samples = float(np.mean(signal.group_delay((self.b, self.a), w=[cutoff_hz / 10.0], fs=fs)[1]))
+        self.reset()
+
+    def reset(self):
+        self.zi = None
+
+    def process(self, ticks, values):
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return ticks, values
+        if self.zi is None:
+            # Start settled at the first value rather than ringing up from zero
+            self.zi = self.lfilter_zi * values[0]
+        filtered, self.zi = self.lfilter(self.b, self.a, values, zi=self.zi)
+        return ticks, filtered
+
+class MOVING_AVERAGE(STREAM_FILTER):
+    def __init__(self, width):
+        self.width = int(width)
+        self.group_delay_samples = (self.width - 1) / 2.0
+        self.reset()
+
+    def reset(self):
+        self.history = np.zeros(0)
+
+    def process(self, ticks, values):
+        values = np.asarray(values, dtype=np.float64)
+        extended = np.concatenate((self.history, values))
+        sums = np.concatenate(([0.0], np.cumsum(extended)))
+        # Until width samples have arrived, average over what there is
+        counts = np.minimum(np.arange(1, len(extended) + 1), self.width)
+        ends = np.arange(1, len(extended) + 1)
+        averages = (sums[ends] - sums[ends - counts]) / counts
+        self.history = extended[-(self.width - 1):] if self.width > 1 else extended[:0]
+        return ticks, averages[len(extended) - len(values):]
+
+class MEDIAN_FILTER(STREAM_FILTER):
+    def __init__(self, width):
+        self.width = int(width)
+        self.group_delay_samples = (self.width - 1) / 2.0
+        self.reset()
+
+    def reset(self):
+        self.history = None
+
+    def process(self, ticks, values):
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return ticks, values
+        if self.history is None:
+            # Pad with the first value so the first outputs are medians of real data
+            self.history = np.full(self.width - 1, values[0])
+        extended = np.concatenate((self.history, values))
+        windows = np.lib.stride_tricks.sliding_window_view(extended, self.width)
+        self.history = extended[len(extended) - (self.width - 1):]
+        # In blocks, so a large chunk never needs a len(values) x width copy
+        medians = np.empty(len(values))
+        for start in range(0, len(values), MEDIAN_BLOCK_SAMPLES):
+            medians[start:start + MEDIAN_BLOCK_SAMPLES] = np.median(windows[start:start + MEDIAN_BLOCK_SAMPLES], axis=1)
+        return ticks, medians
+
+class DECIMATING_FIR(STREAM_FILTER):
+    def __init__(self, factor, numtaps=None, taps=None):
+        self.factor = int(factor)
+        if taps is None:
+            from scipy import signal
+            numtaps = 8 * self.factor + 1 if numtaps is None else int(numtaps)
+            taps = signal.firwin(numtaps, 1.0 / self.factor)  # Cutoff at the new Nyquist frequency
+        self.taps = np.asarray(taps, dtype=np.float64)
+        self.group_delay_samples = (len(self.taps) - 1) / 2.0
+        self.reset()
+
+    def reset(self):
+        self.history = None
+        self.history_ticks = None
+        self.phase = 0  # Input samples to skip before the next output
+
+    def process(self, ticks, values):
+        ticks = np.asarray(ticks)
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return ticks[:0], values
+        if self.history is None:
+            self.history = np.full(len(self.taps) - 1, values[0])
+            self.history_ticks = np.full(len(self.taps) - 1, ticks[0])
+        extended = np.concatenate((self.history, values))
+        extended_ticks = np.concatenate((self.history_ticks, ticks))
+
+        windows = np.lib.stride_tricks.sliding_window_view(extended, len(self.taps))[self.phase::self.factor]
+        outputs = windows @ self.taps[::-1]
+        out_ticks = extended_ticks[len(self.taps) - 1 + self.phase::self.factor][:len(outputs)]
+
+        self.phase = (self.phase - len(values)) % self.factor
+        keep = len(self.taps) - 1
+        self.history = extended[len(extended) - keep:]
+        self.history_ticks = extended_ticks[len(extended_ticks) - keep:]
+        return out_ticks, outputs
+
+# Several named filters fed from the same stream
+class FILTER_BANK:
+    def __init__(self, filters):
+        self.filters = dict(filters)
+
+    def reset(self):
+        for stream_filter in self.filters.values():
+            stream_filter.reset()
+
+    # {name: (ticks, values)}
+    def process(self, ticks, values):
+        return {name: stream_filter.process(ticks, values) for name, stream_filter in self.filters.items()}
@@ -0,0 +1,143 @@
+import numpy as np
+import sys
+
+# Streaming, time weighted current histogram on log spaced bins.
+#
+# Each sample is held until the next one, so its weight is the time to the next sample. The last
+# sample of a chunk is carried over and weighted once the next chunk arrives. Bins cover 1 nA to
+# 1 A by default with underflow and overflow bins at either end, and both time and charge are
+# accumulated per bin. Histograms with the same edges simply add, so captures and devices can be
+# merged from their saved histograms without touching raw data.
+
+DEFAULT_BINS_PER_DECADE = 10
+DEFAULT_MIN_UA = 1.0e-3
+DEFAULT_MAX_UA = 1.0e6
+
+def display_how_to_use():
+    print("To use, follow these rules:")
+    print("python metashunt_histogram.py output_npz histogram_npz [histogram_npz ...] --- Merge saved histograms and print the residency table")
+
+def log_edges(min_ua=DEFAULT_MIN_UA, max_ua=DEFAULT_MAX_UA, bins_per_decade=DEFAULT_BINS_PER_DECADE):
+    decades = np.log10(max_ua) - np.log10(min_ua)
+    return np.logspace(np.log10(min_ua), np.log10(max_ua), int(round(decades * bins_per_decade)) + 1)
+
+class CURRENT_HISTOGRAM:
+    def __init__(self, edges_ua=None):
+        self.edges_ua = log_edges() if edges_ua is None else np.asarray(edges_ua, dtype=np.float64)
+        # Bin 0 is underflow (below edges_ua[0]), the last bin is overflow (at or above edges_ua[-1])
+        self.time_s = np.zeros(len(self.edges_ua) + 1)
+        self.charge_uAs = np.zeros(len(self.edges_ua) + 1)
+        self.last_t = None
+        self.last_ua = None
+
+    def reset(self):
+        self.time_s[:] = 0.0
+        self.charge_uAs[:] = 0.0
+        self.last_t = None
+        self.last_ua = None
+
+    @property
+    def total_time_s(self):
+        return float(self.time_s.sum())
+
+    def update(self, t_s, current_ua):
+        t_s = np.asarray(t_s, dtype=np.float64)
+        current_ua = np.asarray(current_ua, dtype=np.float64)
+        if len(t_s) == 0:
+            return
+        if self.last_t is not None:
+            t_s = np.concatenate(([self.last_t], t_s))
+            current_ua = np.concatenate(([self.last_ua], current_ua))
+        self.last_t = t_s[-1]
+        self.last_ua = current_ua[-1]
+
+        dt = np.diff(t_s)
+        held = current_ua[:-1]
+        bins = np.searchsorted(self.edges_ua, held, side="right")
+        self.time_s += np.bincount(bins, weights=dt, minlength=len(self.time_s))
+        self.charge_uAs += np.bincount(bins, weights=held * dt, minlength=len(self.charge_uAs))
+
+    def merge(self, other):
+        if not np.array_equal(self.edges_ua, other.edges_ua):
+            raise ValueError("Histograms have different bin edges")
+        self.time_s += other.time_s
+        self.charge_uAs += other.charge_uAs
+        return self
+
+    def __add__(self, other):
+        merged = CURRENT_HISTOGRAM(self.edges_ua)
+        return merged.merge(self).merge(other)
+
+    # Fraction of time spent in each bin, including the underflow and overflow bins
+    def residency(self):
+        total = self.total_time_s
+        return self.time_s / total if total > 0 else self.time_s.copy()
+
+    # Fraction of time with current at or above each edge
+    def ccdf(self):
+        tail = np.cumsum(self.residency()[::-1])[::-1]
+        return self.edges_ua, tail[1:]
+
+    # Time and charge fractions per decade, as (lower edges in uA, time fraction, charge fraction)
+    def decade_residency(self):
+        decades = np.floor(np.log10(self.edges_ua[:-1]) + 1.0e-9)
+        lower = np.unique(decades)
+        index = np.searchsorted(lower, decades)
+        time_s = np.bincount(index, weights=self.time_s[1:-1], minlength=len(lower))
+        charge = np.bincount(index, weights=self.charge_uAs[1:-1], minlength=len(lower))
+        total_time = self.total_time_s
+        total_charge = float(self.charge_uAs.sum())
+        return (10.0 ** lower, time_s / total_time if total_time > 0 else time_s,
+                charge / total_charge if total_charge != 0 else charge)
+
+    def save(self, filename):
+        np.savez(filename, edges_ua=self.edges_ua, time_s=self.time_s, charge_uAs=self.charge_uAs)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            histogram = cls(data["edges_ua"])
+            histogram.time_s[:] = data["time_s"]
+            histogram.charge_uAs[:] = data["charge_uAs"]
+        return histogram
+
+def format_current(ua):
+    for unit, scale in (("A", 1.0e6), ("mA", 1.0e3), ("uA", 1.0), ("nA", 1.0e-3)):
+        if ua >= scale:
+            return "{0:g} {1}".format(ua / scale, unit)
+    return "{0:g} nA".format(ua * 1.0e3)
+
+# Rows of (decade label, time fraction, charge fraction)
+def residency_table(histogram):
+    lower, time_fraction, charge_fraction = histogram.decade_residency()
+    total_time = histogram.total_time_s
+    total_charge = float(histogram.charge_uAs.sum())
+    time_fraction_of = lambda k: float(histogram.time_s[k] / total_time) if total_time > 0 else 0.0
+    charge_fraction_of = lambda k: float(histogram.charge_uAs[k] / total_charge) if total_charge != 0 else 0.0
+    rows = []
+    if histogram.time_s[0] > 0:
+        rows.append(("below {0}".format(format_current(histogram.edges_ua[0])), time_fraction_of(0), charge_fraction_of(0)))
+    for low, t, q in zip(lower, time_fraction, charge_fraction):
+        rows.append(("{0} - {1}".format(format_current(low), format_current(low * 10.0)), float(t), float(q)))
+    if histogram.time_s[-1] > 0:
+        rows.append(("above {0}".format(format_current(histogram.edges_ua[-1])), time_fraction_of(-1), charge_fraction_of(-1)))
+    return rows
+
+def print_residency_table(histogram):
+    print("{0:<20} {1:>10} {2:>10}".format("Current", "Time %", "Charge %"))
+    for label, t, q in residency_table(histogram):
+        print("{0:<20} {1:>10.3f} {2:>10.3f}".format(label, 100.0 * t, 100.0 * q))
+    print("Total time {0:.6g} s".format(histogram.total_time_s))
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 3:
+        print("Please provide an output file and at least one histogram")
+        display_how_to_use()
+        sys.exit()
+
+    merged = CURRENT_HISTOGRAM.load(sys.argv[2])
+    for filename in sys.argv[3:]:
+        merged.merge(CURRENT_HISTOGRAM.load(filename))
+    merged.save(sys.argv[1])
+    print_residency_table(merged)
@@ -1,58 +1,81 @@
-import matplotlib
-import matplotlib.pyplot as plt
 import numpy as np
 from enum import Enum
-from scipy import signal
+import metashunt_capture
 
 
 class FILETYPE(Enum):
     METASHUNT_LOG = 1
     EMBEDDED_POWER_MODEL = 2
     OTII_LOG = 3
+    METASHUNT_CAPTURE = 4
 
 class ALIGNMENTTYPE(Enum):
     TIMESHIFT = 1
     CROSSCORRELATE = 2
     NOALIGN = 3
+    TIMEWARP = 4
 
+# Only the loaded time base and current are stored. Alignment is kept as an offset (or time
+# warp) applied on access, and power and energy are derived on first access and cached until
+# the voltage or alignment changes. With compact=True, time is stored as tick deltas in the
+# narrowest integer width that fits (usually one or two bytes) and current as float32. t_s and
+# power are then rebuilt on each access instead of being cached, and energy is cached as float32.
 class PROFILE:
-    def __init__(self, filename: str, filetype: FILETYPE, alignment_type: ALIGNMENTTYPE, label: str, t_shift: float = None, alignment_profile = None, voltage: float = 3.3):
+    def __init__(self, filename: str, filetype: FILETYPE, alignment_type: ALIGNMENTTYPE, label: str, t_shift: float = None, alignment_profile = None, voltage: float = 3.3, time_warp = None, compact: bool = False):
         self.filename = filename
         self.filetype = filetype
         self.alignment_type = alignment_type
         self.label = label
-        self.t_shift = t_shift
-        self.current_ua = []
-        self.power_mW = []
-        self.energy_mWh = []
-        self.t_s = []
+        self.compact = compact
+        self.ticks_per_us = metashunt_capture.DEFAULT_TICKS_PER_US
+        self._voltage = voltage
+        self._t_shift = 0.0
+        self._time_warp = None
+        self._cache = {}
         self.num_datapoints = None
-        self.voltage = voltage
 
         # Load the data
         if filetype == FILETYPE.METASHUNT_LOG:
             data = np.loadtxt(filename, delimiter=",", skiprows=1)
             time_us = data[:,0]
-            self.t_s = time_us * 1.0e-6
-            self.t_s = self.t_s - self.t_s[0]
-            self.current_ua = data[:,1]
-            self.num_datapoints = len(self.t_s)
+            t_s = time_us * 1.0e-6
+            t_s = t_s - t_s[0]
+            current_ua = data[:,1]
         elif filetype == FILETYPE.OTII_LOG:
             data = np.loadtxt(filename, delimiter=",", skiprows=1)
-            self.t_s = data[:,0]
-            self.current_ua = data[:,1] * 1.0e6
-            self.num_datapoints = len(self.t_s)
+            t_s = data[:,0]
+            current_ua = data[:,1] * 1.0e6
         elif filetype == FILETYPE.EMBEDDED_POWER_MODEL:
             data = np.loadtxt(filename, delimiter=",", skiprows=1)
-            self.t_s = data[:,0]
-            self.current_ua = data[:,1] * 1.0e3
-            self.num_datapoints = len(self.t_s)
+            t_s = data[:,0]
+            current_ua = data[:,1] * 1.0e3
+        elif filetype == FILETYPE.METASHUNT_CAPTURE:
+            ticks, current_ua, self.ticks_per_us = metashunt_capture.read_capture(filename)
+            t_s = None
+            ticks = ticks - ticks[0]
+
+        if compact:
+            if t_s is not None:
+                ticks = np.rint(t_s * (1.0e6 * self.ticks_per_us)).astype(np.int64)
+            self._first_tick = int(ticks[0]) if len(ticks) else 0
+            deltas = np.diff(ticks)
+            widths = metashunt_capture.unsigned_widths if len(deltas) == 0 or deltas.min() >= 0 else metashunt_capture.signed_widths
+            self._tick_deltas = deltas.astype(metashunt_capture.narrowest(deltas, widths))
+            self._t_base_s = None
+            self._current_ua = np.asarray(current_ua, dtype=np.float32)
+        else:
+            self._t_base_s = t_s if t_s is not None else ticks * (1.0e-6 / self.ticks_per_us)
+            self._tick_deltas = None
+            self._current_ua = np.asarray(current_ua, dtype=np.float64)
+        self.num_datapoints = len(self._current_ua)
 
         if alignment_type == ALIGNMENTTYPE.NOALIGN:
             pass
         elif alignment_type == ALIGNMENTTYPE.TIMESHIFT:
-            self.t_s = self.t_s + t_shift
+            self.t_shift = t_shift
         elif alignment_type == ALIGNMENTTYPE.CROSSCORRELATE:
+            # scipy is only needed for this alignment, so it is imported here
+            from scipy import signal
 
             # Calculate the cross-correlation
             correlation = signal.correlate(self.current_ua, alignment_profile.current_ua, mode='valid')
@@ -61,44 +84,137 @@ class PROFILE:
             lag = np.argmax(correlation)
 
             # Apply the timeshift
-            self.t_s = self.t_s - self.t_s[lag]
-
-        # Calculate power and cumulative energy
-        self.power_mW = 0.001 * self.voltage * self.current_ua
-        self.energy_mWh = np.zeros((len(self.power_mW)))
-        for i in range(1,len(self.power_mW)):
-            self.energy_mWh[i] = self.energy_mWh[i-1] + (self.power_mW[i] + self.power_mW[i-1])*0.5*(self.t_s[i] - self.t_s[i-1])/3600.0
+            self.t_shift = -self.base_t_s[lag]
+        elif alignment_type == ALIGNMENTTYPE.TIMEWARP:
+            # Offset plus clock skew, see metashunt_drift.estimate_time_warp
+            self.time_warp = time_warp
+
+    # Time as loaded, before alignment
+    @property
+    def base_t_s(self):
+        if self._t_base_s is not None:
+            return self._t_base_s
+        ticks = np.empty(len(self._tick_deltas) + 1, dtype=np.int64)
+        ticks[0] = self._first_tick
+        np.cumsum(self._tick_deltas, dtype=np.int64, out=ticks[1:])
+        ticks[1:] += self._first_tick
+        return ticks * (1.0e-6 / self.ticks_per_us)
+
+    @property
+    def current_ua(self):
+        return self._current_ua
+
+    @property
+    def voltage(self):
+        return self._voltage
+
+    @voltage.setter
+    def voltage(self, value):
+        self._voltage = value
+        self._invalidate("power_mW", "energy_mWh")
+
+    @property
+    def t_shift(self):
+        return self._t_shift
+
+    @t_shift.setter
+    def t_shift(self, value):
+        self._t_shift = 0.0 if value is None else value
+        self._invalidate("t_s", "energy_mWh")
+
+    @property
+    def time_warp(self):
+        return self._time_warp
+
+    @time_warp.setter
+    def time_warp(self, value):
+        self._time_warp = value
+        self._invalidate("t_s", "energy_mWh")
+
+    def _invalidate(self, *names):
+        for name in names:
+            self._cache.pop(name, None)
+
+    @property
+    def t_s(self):
+        if "t_s" in self._cache:
+            return self._cache["t_s"]
+        t_s = self.base_t_s
+        if self._time_warp is not None:
+            t_s = self._time_warp.apply(t_s)
+        if self._t_shift:
+            t_s = t_s + self._t_shift
+        if not self.compact:
+            self._cache["t_s"] = t_s
+        return t_s
+
+    @property
+    def power_mW(self):
+        if "power_mW" in self._cache:
+            return self._cache["power_mW"]
+        power_mW = (0.001 * self._voltage) * self._current_ua
+        if not self.compact:
+            self._cache["power_mW"] = power_mW
+        return power_mW
+
+    @property
+    def energy_mWh(self):
+        if "energy_mWh" not in self._cache:
+            power_mW = self.power_mW
+            # Summed in float64 either way, compact profiles keep the result as float32
+            energy_mWh = np.zeros(len(power_mW), dtype=np.float32 if self.compact else np.float64)
+            energy_mWh[1:] = np.cumsum((power_mW[1:] + power_mW[:-1])*0.5*np.diff(self.t_s)/3600.0, dtype=np.float64)
+            self._cache["energy_mWh"] = energy_mWh
+        return self._cache["energy_mWh"]
+
+    # Drops cached derived channels, they are rebuilt on next access
+    def release_derived(self):
+        self._cache.clear()
+
+    # Piecewise constant segments of the aligned profile, keyword arguments as metashunt_segments.build_segments
+    def segments(self, **kwargs):
+        import metashunt_segments
+        return metashunt_segments.build_segments(self.t_s, self.current_ua, **kwargs)
+
+PLOT_MAX_POINTS = 4000
+
+# At most max_points points per line, each bin drawn as its min and max so spikes stay visible
+def decimate_for_plot(t, y, max_points=PLOT_MAX_POINTS):
+    import metashunt_report
+
+    if len(t) <= max_points:
+        return t, y
+    t_center, y_min, y_max, y_mean = metashunt_report.envelope(t, y, max_points // 2)
+    return np.repeat(t_center, 2), np.column_stack((y_min, y_max)).ravel()
 
 def plot_profiles(profiles_array):
+    import matplotlib.pyplot as plt
 
-    fig, ax = plt.subplots()
-    for profile in profiles_array:
-
-        ax.plot(profile.t_s, profile.current_ua, label=profile.label)
-
-    ax.set(xlabel='Time, s', ylabel='Current, uA',
-        title='Current Profile Comparison')
-    ax.grid()
-    ax.legend()
+    fig, ax_current = plt.subplots()
+    fig, ax_power = plt.subplots()
+    fig, ax_energy = plt.subplots()
 
-    fig, ax = plt.subplots()
+    # One profile's full time base at a time, only the decimated lines are kept for the figures
     for profile in profiles_array:
+        t_s = profile.t_s
+        ax_current.plot(*decimate_for_plot(t_s, profile.current_ua), label=profile.label)
+        ax_power.plot(*decimate_for_plot(t_s, profile.power_mW), label=profile.label)
+        ax_energy.plot(*decimate_for_plot(t_s, profile.energy_mWh), label=profile.label)
+        del t_s
 
-        ax.plot(profile.t_s, profile.power_mW, label=profile.label)
+    ax_current.set(xlabel='Time, s', ylabel='Current, uA',
+        title='Current Profile Comparison')
+    ax_current.grid()
+    ax_current.legend()
 
-    ax.set(xlabel='Time, s', ylabel='Power, mW',
+    ax_power.set(xlabel='Time, s', ylabel='Power, mW',
         title='Power Profile Comparison')
-    ax.grid()
-    ax.legend()
-
-    fig, ax = plt.subplots()
-    for profile in profiles_array:
-
-        ax.plot(profile.t_s, profile.energy_mWh, label=profile.label)
+    ax_power.grid()
+    ax_power.legend()
 
-    ax.set(xlabel='Time, s', ylabel='Energy, mWh',
+    ax_energy.set(xlabel='Time, s', ylabel='Energy, mWh',
         title='Cumulative Energy Profile Comparison')
-    ax.grid()
-    ax.legend()
+    ax_energy.grid()
+    ax_energy.legend()
 
-    plt.show()
\ No newline at end of file
+    plt.show()
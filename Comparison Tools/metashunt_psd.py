@@ -0,0 +1,100 @@
+import numpy as np
+
+# Streaming Welch power spectral density of current.
+#
+# Samples arrive with irregular timing, so each chunk is first resampled onto a uniform grid
+# at fs by linear interpolation, carrying the last sample over to the next chunk. Every full
+# segment of nperseg resampled points (overlapping by noverlap) is detrended, windowed and
+# transformed, and its periodogram is added to a running sum. Memory is one partial segment
+# plus the accumulator, however long the stream runs.
+
+class STREAMING_PSD:
+    def __init__(self, fs, nperseg=4096, noverlap=None):
+        self.fs = float(fs)
+        self.nperseg = int(nperseg)
+        self.noverlap = self.nperseg // 2 if noverlap is None else int(noverlap)
+        self.step = self.nperseg - self.noverlap
+        self.window = np.hanning(self.nperseg + 1)[:-1]  # Periodic Hann, as in scipy.signal.welch
+        self.scale = 1.0 / (self.fs * np.sum(self.window**2))
+        self.frequencies_hz = np.fft.rfftfreq(self.nperseg, 1.0 / self.fs)
+        self.reset()
+
+    def reset(self):
+        self.psd_sum = np.zeros(len(self.frequencies_hz))
+        self.segment_count = 0
+        self.pending = np.zeros(0)
+        self.last_t = None
+        self.last_y = None
+        self.next_t = None
+
+    def _resample(self, t_s, y):
+        if self.last_t is not None:
+            t_s = np.concatenate(([self.last_t], t_s))
+            y = np.concatenate(([self.last_y], y))
+        else:
+            self.next_t = t_s[0]
+        self.last_t = t_s[-1]
+        self.last_y = y[-1]
+        if self.next_t > t_s[-1]:
+            return np.zeros(0)
+        count = int(np.floor((t_s[-1] - self.next_t) * self.fs)) + 1
+        grid = self.next_t + np.arange(count) / self.fs
+        self.next_t = grid[-1] + 1.0 / self.fs
+        return np.interp(grid, t_s, y)
+
+    def update(self, t_s, current_ua):
+        t_s = np.asarray(t_s, dtype=np.float64)
+        current_ua = np.asarray(current_ua, dtype=np.float64)
+        if len(t_s) == 0:
+            return
+        data = np.concatenate((self.pending, self._resample(t_s, current_ua)))
+        if len(data) < self.nperseg:
+            self.pending = data
+            return
+
+        segments = np.lib.stride_tricks.sliding_window_view(data, self.nperseg)[::self.step]
+        segments = segments - segments.mean(axis=1, keepdims=True)
+        spectrum = np.abs(np.fft.rfft(segments * self.window, axis=1))**2
+        self.psd_sum += spectrum.sum(axis=0)
+        self.segment_count += len(segments)
+        self.pending = data[len(segments) * self.step:]
+
+    # One sided PSD in uA^2/Hz, averaged over every segment so far
+    @property
+    def psd(self):
+        if self.segment_count == 0:
+            return np.zeros(len(self.frequencies_hz))
+        psd = self.psd_sum * self.scale / self.segment_count
+        psd[1:] *= 2.0
+        if self.nperseg % 2 == 0:
+            psd[-1] /= 2.0
+        return psd
+
+    # Integrated RMS noise in uA over a frequency band
+    def band_rms(self, f_low_hz=0.0, f_high_hz=None):
+        f_high_hz = self.fs / 2.0 if f_high_hz is None else f_high_hz
+        band = (self.frequencies_hz >= f_low_hz) & (self.frequencies_hz <= f_high_hz)
+        df = self.fs / self.nperseg
+        return float(np.sqrt(np.sum(self.psd[band]) * df))
+
+def profile_psd(profile, fs, nperseg=4096, chunk_samples=1000000):
+    estimator = STREAMING_PSD(fs, nperseg)
+    for start in range(0, len(profile.t_s), chunk_samples):
+        estimator.update(profile.t_s[start:start + chunk_samples], profile.current_ua[start:start + chunk_samples])
+    return estimator
+
+def plot_psd_profiles(profiles_array, fs, nperseg=4096):
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots()
+    for profile in profiles_array:
+        estimator = profile_psd(profile, fs, nperseg)
+        ax.loglog(estimator.frequencies_hz[1:], estimator.psd[1:],
+                  label="{0} ({1:.3g} uA RMS)".format(profile.label, estimator.band_rms(estimator.frequencies_hz[1])))
+
+    ax.set(xlabel='Frequency, Hz', ylabel='Current PSD, uA^2/Hz',
+        title='Current Noise Comparison')
+    ax.grid()
+    ax.legend()
+
+    plt.show()
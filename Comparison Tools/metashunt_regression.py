@@ -0,0 +1,242 @@
+import numpy as np
+import json
+import sys
+import metashunt_report
+from metashunt_histogram import CURRENT_HISTOGRAM
+
+# Power regression checks against compact baseline fingerprints.
+#
+# A fingerprint holds a few hundred numbers describing a baseline capture: energy in each of a
+# fixed set of time phases, duty cycle above an activity threshold, the residency of a
+# CURRENT_HISTOGRAM (time weighted, log current bins) and a decimated mean current envelope, plus the tolerances to check against. It is
+# built once and saved as .npz, so checking a new capture never reloads or realigns the baseline.
+#
+# Everything is derived from the cumulative charge with each sample held until the next one.
+# That curve is piecewise linear, so the charge in any window is exact from two interpolations.
+#
+# A new capture rarely starts at the same point of the workload as the baseline. Before scoring,
+# its envelope is cross-correlated against the stored one at a fraction of an envelope bin to
+# find the time shift, and every check then uses the fingerprint's phases and bins moved by it.
+
+ACTIVITY_FLOOR_UA = 0.1  # Lowest sleep floor used to place the activity threshold
+
+DEFAULT_TOLERANCES = {
+    "total_energy_rel": 0.05,  # Relative change in total energy
+    "phase_energy_rel": 0.10,  # Largest relative change of any phase energy
+    "duty_cycle_abs": 0.02,  # Absolute change in the fraction of time above the activity threshold
+    "histogram_distance": 0.10,  # Total variation distance between time weighted histograms
+    "envelope_rms_rel": 0.15,  # RMS envelope difference relative to the baseline envelope RMS
+}
+
+ALIGN_STEPS_PER_BIN = 8  # Shift search resolution as a fraction of an envelope bin
+ALIGN_REFINE_LEVELS = 3  # Each refinement narrows the shift by another ALIGN_STEPS_PER_BIN
+DEFAULT_MAX_SHIFT_FRACTION = 0.25  # Search this fraction of the baseline duration beyond the capture's own slack
+
+def display_how_to_use():
+    print("To use, follow these rules:")
+    print("python metashunt_regression.py b fingerprint_npz baseline_capture [tolerances_json] --- Build a baseline fingerprint")
+    print("python metashunt_regression.py c fingerprint_npz capture [capture ...] --- Check captures against a fingerprint, exit code 1 if any fail")
+    print("Captures follow metashunt_report.py: MetaShunt logs or .mscap by default, prefix with otii: or model: for other file types")
+
+# Charge in uAs at every sample time, with one extra point one sample period after the last sample
+def cumulative_charge(t_s, current_ua):
+    t_s = np.asarray(t_s, dtype=np.float64)
+    current_ua = np.asarray(current_ua, dtype=np.float64)
+    dt = np.diff(t_s)
+    last_dt = dt[-1] if len(dt) else 0.0
+    t_ext = np.append(t_s, t_s[-1] + last_dt)
+    charge = np.concatenate(([0.0], np.cumsum(current_ua * np.append(dt, last_dt))))
+    return t_ext, charge
+
+def window_charge_uAs(t_ext, charge, edges_s):
+    return np.diff(np.interp(edges_s, t_ext, charge))
+
+# Fraction of time in each CURRENT_HISTOGRAM bin, underflow and overflow included. Each sample
+# is held until the next point of t_ext
+def residency(t_ext, current_ua, edges_ua=None):
+    histogram = CURRENT_HISTOGRAM(edges_ua)
+    histogram.update(t_ext, np.append(current_ua, current_ua[-1]))
+    return histogram.residency()
+
+class FINGERPRINT:
+    def __init__(self, label, voltage, phase_edges_s, phase_energy_mWh, threshold_ua, duty_cycle,
+                 histogram, histogram_edges_ua, envelope_edges_s, envelope_ua, tolerances=None):
+        self.label = label
+        self.voltage = voltage
+        self.phase_edges_s = np.asarray(phase_edges_s, dtype=np.float64)
+        self.phase_energy_mWh = np.asarray(phase_energy_mWh, dtype=np.float64)
+        self.threshold_ua = threshold_ua
+        self.duty_cycle = duty_cycle
+        self.histogram = np.asarray(histogram, dtype=np.float64)
+        self.histogram_edges_ua = np.asarray(histogram_edges_ua, dtype=np.float64)
+        self.envelope_edges_s = np.asarray(envelope_edges_s, dtype=np.float64)
+        self.envelope_ua = np.asarray(envelope_ua, dtype=np.float64)
+        self.tolerances = dict(DEFAULT_TOLERANCES, **(tolerances or {}))
+
+    @property
+    def total_energy_mWh(self):
+        return float(self.phase_energy_mWh.sum())
+
+    def save(self, filename):
+        meta = {"label": self.label, "voltage": self.voltage, "threshold_ua": self.threshold_ua,
+                "duty_cycle": self.duty_cycle, "tolerances": self.tolerances}
+        np.savez(filename, phase_edges_s=self.phase_edges_s, phase_energy_mWh=self.phase_energy_mWh,
+                 histogram=self.histogram, histogram_edges_ua=self.histogram_edges_ua,
+                 envelope_edges_s=self.envelope_edges_s, envelope_ua=self.envelope_ua,
+                 meta=np.array(json.dumps(meta)))
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            meta = json.loads(str(data["meta"]))
+            return cls(meta["label"], meta["voltage"], data["phase_edges_s"], data["phase_energy_mWh"], meta["threshold_ua"],
+                       meta["duty_cycle"], data["histogram"], data["histogram_edges_ua"], data["envelope_edges_s"],
+                       data["envelope_ua"], meta["tolerances"])
+
+def build_fingerprint(profile, n_phases=10, n_envelope=512, tolerances=None):
+    t_s = np.asarray(profile.t_s, dtype=np.float64)
+    t_s = t_s - t_s[0]
+    current_ua = np.asarray(profile.current_ua, dtype=np.float64)
+    t_ext, charge = cumulative_charge(t_s, current_ua)
+
+    phase_edges_s = np.linspace(0.0, t_ext[-1], n_phases + 1)
+    phase_energy_mWh = window_charge_uAs(t_ext, charge, phase_edges_s) * profile.voltage / 3.6e9
+    envelope_edges_s = np.linspace(0.0, t_ext[-1], n_envelope + 1)
+    envelope_ua = window_charge_uAs(t_ext, charge, envelope_edges_s) / np.diff(envelope_edges_s)
+
+    # Halfway between sleep floor and active level on a log scale
+    low, high = np.percentile(current_ua, [5.0, 99.5])
+    threshold_ua = float(np.sqrt(max(low, ACTIVITY_FLOOR_UA) * max(high, ACTIVITY_FLOOR_UA)))
+    duty_cycle = float(np.sum(np.diff(t_ext)[current_ua >= threshold_ua]) / t_ext[-1])
+
+    return FINGERPRINT(profile.label, profile.voltage, phase_edges_s, phase_energy_mWh, threshold_ua, duty_cycle,
+                       residency(t_ext, current_ua), CURRENT_HISTOGRAM().edges_ua, envelope_edges_s, envelope_ua, tolerances)
+
+# Time (s) to add to the fingerprint's edges so they line up with the capture
+def estimate_shift_s(fingerprint, t_ext, charge, max_shift_s):
+    edges_s = fingerprint.envelope_edges_s
+    duration_s = edges_s[-1] - edges_s[0]
+    bin_s = duration_s / (len(edges_s) - 1)
+    step_s = bin_s / ALIGN_STEPS_PER_BIN
+    min_shift_s = -max_shift_s
+    max_shift_s = max(t_ext[-1] - duration_s, 0.0) + max_shift_s
+
+    # Capture envelope with bins starting every step, then the stored envelope against every
+    # ALIGN_STEPS_PER_BIN-th of them
+    starts_s = min_shift_s + step_s * np.arange(int(np.ceil((max_shift_s - min_shift_s + duration_s) / step_s)) + 1)
+    fine_ua = (np.interp(starts_s + bin_s, t_ext, charge) - np.interp(starts_s, t_ext, charge)) / bin_s
+    template = np.zeros((len(edges_s) - 2) * ALIGN_STEPS_PER_BIN + 1)
+    template[::ALIGN_STEPS_PER_BIN] = fingerprint.envelope_ua - fingerprint.envelope_ua.mean()
+    if len(fine_ua) < len(template):
+        return 0.0
+
+    n = len(fine_ua) + len(template)
+    nfft = 1 << (n - 1).bit_length()
+    spectrum = np.fft.rfft(fine_ua, nfft) * np.conj(np.fft.rfft(template, nfft))
+    corr = np.fft.irfft(spectrum, nfft)[:len(fine_ua) - len(template) + 1]
+    shift_s = min_shift_s + int(np.argmax(corr)) * step_s - edges_s[0]
+
+    # Refine around the peak to the shift that best matches the envelope
+    for level in range(ALIGN_REFINE_LEVELS):
+        candidates_s = shift_s + np.linspace(-step_s, step_s, 2 * ALIGN_STEPS_PER_BIN + 1)
+        shifted = edges_s[None, :] + candidates_s[:, None]
+        envelopes_ua = np.diff(np.interp(shifted, t_ext, charge), axis=1) / bin_s
+        shift_s = candidates_s[np.argmin(np.sum((envelopes_ua - fingerprint.envelope_ua)**2, axis=1))]
+        step_s /= ALIGN_STEPS_PER_BIN
+    return float(shift_s)
+
+class CHECK_RESULT:
+    def __init__(self, label, checks, shift_s=0.0):
+        self.label = label
+        self.checks = checks  # {name: (value, limit, passed)}
+        self.shift_s = shift_s  # Where the baseline's start was found in the capture
+
+    @property
+    def passed(self):
+        return all(passed for value, limit, passed in self.checks.values())
+
+def relative_change(value, reference):
+    return abs(value - reference) / abs(reference) if reference != 0 else (0.0 if value == 0 else np.inf)
+
+# Scores a capture against the fingerprint on its phase and envelope grid, moved to where the
+# baseline lines up in the capture. align=False scores from the capture's first sample.
+def check_profile(fingerprint, profile, align=True, max_shift_fraction=DEFAULT_MAX_SHIFT_FRACTION):
+    t_s = np.asarray(profile.t_s, dtype=np.float64)
+    t_s = t_s - t_s[0]
+    current_ua = np.asarray(profile.current_ua, dtype=np.float64)
+    t_ext, charge = cumulative_charge(t_s, current_ua)
+    tolerances = fingerprint.tolerances
+    checks = {}
+
+    duration_s = float(fingerprint.phase_edges_s[-1])
+    shift_s = estimate_shift_s(fingerprint, t_ext, charge, max_shift_fraction * duration_s) if align else 0.0
+    phase_edges_s = fingerprint.phase_edges_s + shift_s
+    envelope_edges_s = fingerprint.envelope_edges_s + shift_s
+
+    # The capture has to cover the whole shifted baseline
+    slack_s = duration_s * 1.0e-6
+    covered_s = min(t_ext[-1], phase_edges_s[-1]) - max(0.0, phase_edges_s[0])
+    duration_ok = phase_edges_s[0] >= -slack_s and phase_edges_s[-1] <= t_ext[-1] + slack_s
+    checks["duration_s"] = (float(covered_s), duration_s, bool(duration_ok))
+
+    # Samples held within the shifted baseline, for the duty cycle and histogram
+    held_s = np.clip(np.minimum(t_ext[1:], phase_edges_s[-1]) - np.maximum(t_ext[:-1], phase_edges_s[0]), 0.0, None)
+    window_s = held_s.sum()
+
+    phase_energy = window_charge_uAs(t_ext, charge, phase_edges_s) * fingerprint.voltage / 3.6e9
+    total_change = relative_change(phase_energy.sum(), fingerprint.total_energy_mWh)
+    checks["total_energy_rel"] = (total_change, tolerances["total_energy_rel"], total_change <= tolerances["total_energy_rel"])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        phase_change = np.abs(phase_energy - fingerprint.phase_energy_mWh) / np.abs(fingerprint.phase_energy_mWh)
+    phase_change = float(np.nanmax(np.where(fingerprint.phase_energy_mWh != 0, phase_change, 0.0)))
+    checks["phase_energy_rel"] = (phase_change, tolerances["phase_energy_rel"], phase_change <= tolerances["phase_energy_rel"])
+
+    duty_cycle = float(np.sum(held_s[current_ua >= fingerprint.threshold_ua]) / window_s) if window_s > 0 else 0.0
+    duty_change = abs(duty_cycle - fingerprint.duty_cycle)
+    checks["duty_cycle_abs"] = (duty_change, tolerances["duty_cycle_abs"], duty_change <= tolerances["duty_cycle_abs"])
+
+    # Times built from the held durations give samples outside the window zero weight
+    window_residency = residency(np.append(0.0, np.cumsum(held_s)), current_ua, fingerprint.histogram_edges_ua)
+    distance = 0.5 * float(np.abs(window_residency - fingerprint.histogram).sum())
+    checks["histogram_distance"] = (distance, tolerances["histogram_distance"], distance <= tolerances["histogram_distance"])
+
+    envelope_ua = window_charge_uAs(t_ext, charge, envelope_edges_s) / np.diff(envelope_edges_s)
+    reference_rms = np.sqrt(np.mean(fingerprint.envelope_ua**2))
+    envelope_change = float(np.sqrt(np.mean((envelope_ua - fingerprint.envelope_ua)**2)) / reference_rms) if reference_rms > 0 else 0.0
+    checks["envelope_rms_rel"] = (envelope_change, tolerances["envelope_rms_rel"], envelope_change <= tolerances["envelope_rms_rel"])
+
+    return CHECK_RESULT(profile.label, {name: (float(v), float(l), bool(p)) for name, (v, l, p) in checks.items()}, float(shift_s))
+
+def print_check_report(fingerprint, results):
+    print("Baseline: {0} ({1:.6g} mWh, duty cycle {2:.2%})".format(fingerprint.label, fingerprint.total_energy_mWh, fingerprint.duty_cycle))
+    for result in results:
+        print("{0}: {1} (aligned at {2:+.6g} s)".format(result.label, "PASS" if result.passed else "FAIL", result.shift_s))
+        for name, (value, limit, passed) in result.checks.items():
+            print("    {0:<20} {1:>12.4g}  limit {2:<10.4g} {3}".format(name, value, limit, "ok" if passed else "FAIL"))
+    failures = sum(1 for result in results if not result.passed)
+    print("{0} of {1} captures passed".format(len(results) - failures, len(results)))
+    return failures == 0
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 4:
+        print("Please provide a mode, a fingerprint file and at least one capture")
+        display_how_to_use()
+        sys.exit()
+
+    if sys.argv[1] == "b":
+        tolerances = None
+        if len(sys.argv) > 4:
+            with open(sys.argv[4]) as f:
+                tolerances = json.load(f)
+        fingerprint = build_fingerprint(metashunt_report.load_capture(sys.argv[3]), tolerances=tolerances)
+        fingerprint.save(sys.argv[2])
+        print("Fingerprint of {0} written to {1}: {2:.6g} mWh, duty cycle {3:.2%}".format(
+            fingerprint.label, sys.argv[2], fingerprint.total_energy_mWh, fingerprint.duty_cycle))
+    elif sys.argv[1] == "c":
+        fingerprint = FINGERPRINT.load(sys.argv[2])
+        results = [check_profile(fingerprint, metashunt_report.load_capture(argument)) for argument in sys.argv[3:]]
+        if not print_check_report(fingerprint, results):
+            sys.exit(1)
+    else:
+        display_how_to_use()
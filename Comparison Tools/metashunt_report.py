@@ -0,0 +1,186 @@
+import numpy as np
+import sys
+import os
+import io
+import base64
+import html
+import metashunt_profile_processing as mpp
+import metashunt_histogram
+
+# Headless static reports for captures and PROFILE lists.
+#
+# Every trace is reduced to a min/max/mean envelope with one bin per output pixel column
+# before it reaches matplotlib, so drawing cost depends on the image width and not on the
+# number of samples. Figures are rendered with the Agg backend and written as PNGs plus a
+# single HTML file with the images embedded, so no display is needed.
+
+REPORT_WIDTH_PX = 1200
+REPORT_HEIGHT_PX = 400
+REPORT_DPI = 100
+
+file_type_prefixes = {
+    "metashunt": mpp.FILETYPE.METASHUNT_LOG,
+    "otii": mpp.FILETYPE.OTII_LOG,
+    "model": mpp.FILETYPE.EMBEDDED_POWER_MODEL,
+    "mscap": mpp.FILETYPE.METASHUNT_CAPTURE,
+}
+
+def display_how_to_use():
+    print("To use, follow these rules:")
+    print("python metashunt_report.py output_dir capture_csv [capture_csv ...] --- Write an HTML/PNG report for the captures")
+    print("Captures are MetaShunt logs by default, or compressed captures if they end in .mscap. Prefix with otii: or model: for other file types, e.g. otii:otii_arc_esp32.csv")
+
+# Returns (bin centers, min, max, mean) with at most n_bins bins, bins uniform in t
+def envelope(t, y, n_bins):
+    t = np.asarray(t)
+    y = np.asarray(y)
+    if len(t) <= 2 * n_bins:
+        return t, y, y, y
+
+    edges = np.linspace(t[0], t[-1], n_bins + 1)
+    starts = np.searchsorted(t, edges[:-1], side="left")
+    starts = np.unique(starts[starts < len(t)])
+    counts = np.diff(np.append(starts, len(t)))
+
+    y_min = np.minimum.reduceat(y, starts)
+    y_max = np.maximum.reduceat(y, starts)
+    y_mean = np.add.reduceat(y, starts, dtype=np.float64) / counts
+    t_center = np.add.reduceat(t, starts, dtype=np.float64) / counts
+    return t_center, y_min, y_max, y_mean
+
+def sample_rate_hz(t_s):
+    dt = np.diff(t_s)
+    with np.errstate(divide="ignore"):
+        rate = np.where(dt > 0, 1.0 / np.where(dt > 0, dt, 1.0), np.nan)
+    return t_s[1:], rate
+
+def profile_summary(profile):
+    t_s = np.asarray(profile.t_s)
+    current_ua = np.asarray(profile.current_ua)
+    duration_s = float(t_s[-1] - t_s[0]) if len(t_s) > 1 else 0.0
+    return {
+        "Label": profile.label,
+        "Samples": len(t_s),
+        "Duration (s)": duration_s,
+        "Mean current (uA)": float(np.mean(current_ua)),
+        "Min current (uA)": float(np.min(current_ua)),
+        "Max current (uA)": float(np.max(current_ua)),
+        "Mean power (mW)": float(np.mean(profile.power_mW)),
+        "Energy (mWh)": float(profile.energy_mWh[-1]) if len(profile.energy_mWh) else 0.0,
+        "Mean sample rate (Hz)": (len(t_s) - 1) / duration_s if duration_s > 0 else 0.0,
+    }
+
+# One row per current decade, with the percentage of time each profile spent there
+def residency_rows(profiles_array):
+    tables = []
+    for profile in profiles_array:
+        histogram = metashunt_histogram.CURRENT_HISTOGRAM()
+        histogram.update(profile.t_s, profile.current_ua)
+        tables.append({label: t for label, t, q in metashunt_histogram.residency_table(histogram)})
+    labels = []
+    for table in tables:
+        labels += [label for label in table if label not in labels]
+    return [dict([("Current", label)] + [(p.label + " time %", 100.0 * table.get(label, 0.0)) for p, table in zip(profiles_array, tables)])
+            for label in labels]
+
+def render_envelope_plot(traces, xlabel, ylabel, title, width_px, height_px):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    n_bins = max(width_px // 2, 1)
+    fig, ax = plt.subplots(figsize=(width_px / REPORT_DPI, height_px / REPORT_DPI), dpi=REPORT_DPI)
+    for label, t, y in traces:
+        t_center, y_min, y_max, y_mean = envelope(t, y, n_bins)
+        line, = ax.plot(t_center, y_mean, label=label, linewidth=0.8)
+        ax.fill_between(t_center, y_min, y_max, color=line.get_color(), alpha=0.3, linewidth=0)
+    ax.set(xlabel=xlabel, ylabel=ylabel, title=title)
+    ax.grid()
+    ax.legend()
+
+    png = io.BytesIO()
+    fig.savefig(png, format="png")
+    plt.close(fig)
+    return png.getvalue()
+
+def summary_table_html(summaries):
+    if not summaries:
+        return ""
+    columns = list(summaries[0].keys())
+    rows = ["<tr>" + "".join("<th>{0}</th>".format(html.escape(c)) for c in columns) + "</tr>"]
+    for summary in summaries:
+        cells = []
+        for c in columns:
+            value = summary[c]
+            text = "{0:.6g}".format(value) if isinstance(value, float) else str(value)
+            cells.append("<td>{0}</td>".format(html.escape(text)))
+        rows.append("<tr>" + "".join(cells) + "</tr>")
+    return "<table>\n" + "\n".join(rows) + "\n</table>"
+
+def write_report(profiles_array, output_dir, title="MetaShunt Report", width_px=REPORT_WIDTH_PX, height_px=REPORT_HEIGHT_PX):
+    os.makedirs(output_dir, exist_ok=True)
+
+    plots = [
+        ("current", "Current Profile Comparison", "Current, uA", [(p.label, p.t_s, p.current_ua) for p in profiles_array]),
+        ("power", "Power Profile Comparison", "Power, mW", [(p.label, p.t_s, p.power_mW) for p in profiles_array]),
+        ("energy", "Cumulative Energy Profile Comparison", "Energy, mWh", [(p.label, p.t_s, p.energy_mWh) for p in profiles_array]),
+        ("sample_rate", "Sample Rate", "Frequency, Hz", [(p.label,) + sample_rate_hz(np.asarray(p.t_s)) for p in profiles_array]),
+    ]
+
+    sections = []
+    for name, plot_title, ylabel, traces in plots:
+        png = render_envelope_plot(traces, "Time, s", ylabel, plot_title, width_px, height_px)
+        with open(os.path.join(output_dir, name + ".png"), "wb") as f:
+            f.write(png)
+        sections.append('<h2>{0}</h2>\n<img src="data:image/png;base64,{1}" alt="{0}">'.format(
+            html.escape(plot_title), base64.b64encode(png).decode("ascii")))
+
+    summaries = [profile_summary(p) for p in profiles_array]
+    report_html = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{0}</title>
+<style>
+body {{ font-family: sans-serif; margin: 2em; }}
+table {{ border-collapse: collapse; }}
+th, td {{ border: 1px solid #999; padding: 4px 8px; text-align: right; }}
+th {{ background: #eee; }}
+</style>
+</head>
+<body>
+<h1>{0}</h1>
+<h2>Summary</h2>
+{1}
+<h2>Current Residency</h2>
+{2}
+{3}
+</body>
+</html>
+""".format(html.escape(title), summary_table_html(summaries), summary_table_html(residency_rows(profiles_array)), "\n".join(sections))
+
+    report_file_name = os.path.join(output_dir, "report.html")
+    with open(report_file_name, "w") as f:
+        f.write(report_html)
+    return report_file_name
+
+def load_capture(argument):
+    filetype = mpp.FILETYPE.METASHUNT_CAPTURE if argument.endswith(".mscap") else mpp.FILETYPE.METASHUNT_LOG
+    filename = argument
+    prefix, sep, rest = argument.partition(":")
+    if sep and prefix in file_type_prefixes:
+        filetype = file_type_prefixes[prefix]
+        filename = rest
+    return mpp.PROFILE(filename=filename, filetype=filetype, alignment_type=mpp.ALIGNMENTTYPE.NOALIGN,
+                       label=os.path.basename(filename))
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 3:
+        print("Please provide an output directory and at least one capture")
+        display_how_to_use()
+        sys.exit()
+
+    profiles = [load_capture(argument) for argument in sys.argv[2:]]
+    report_file_name = write_report(profiles, sys.argv[1])
+    print("Report written to {0}".format(report_file_name))
@@ -0,0 +1,263 @@
+import numpy as np
+import sys
+import metashunt_capture
+
+# Piecewise constant representation of current traces, for sleep dominated workloads.
+#
+# A trace is a sequence of segments, each held at one level from its start to the start of the
+# next. Runs of samples whose spread stays within a tolerance collapse into one segment, and
+# samples where the signal moves are kept as one sample segments, so full resolution survives
+# only where it matters. A segment's level is its exact charge divided by its duration (each
+# sample held until the next), and its minimum and maximum sample are kept for peaks and
+# envelopes. Charge, mean, peak, value lookups and plotting all work on segment boundaries and a
+# cumulative charge at each boundary, so their cost depends on the number of segments rather
+# than samples.
+#
+# Building is mostly vectorized. Samples are first marked quiet when they lie in some window of
+# min_run samples within tolerance. Every other sample becomes its own segment. Quiet stretches
+# that are within tolerance as a whole become one segment directly, and only the rest are split
+# greedily, one step per segment.
+
+DEFAULT_ABS_TOL_UA = 0.1
+DEFAULT_REL_TOL = 0.01
+DEFAULT_MIN_RUN = 2
+
+def display_how_to_use():
+    print("To use, follow these rules:")
+    print("python metashunt_segments.py capture [abs_tol_uA] [rel_tol] [output_npz] --- Collapse a capture into constant segments and compare with the samples")
+    print("Samples are merged while their spread stays within abs_tol_uA + rel_tol * |current|, by default {0} uA and {1}".format(DEFAULT_ABS_TOL_UA, DEFAULT_REL_TOL))
+    print("Captures follow metashunt_report.py: MetaShunt logs or .mscap by default, prefix with otii: or model: for other file types")
+
+class SEGMENTED_TRACE:
+    def __init__(self, starts_s, end_s, level_ua, min_ua, max_ua, samples):
+        self.starts_s = np.asarray(starts_s, dtype=np.float64)
+        self.end_s = float(end_s)
+        self.level_ua = np.asarray(level_ua, dtype=np.float64)
+        self.min_ua = np.asarray(min_ua, dtype=np.float64)
+        self.max_ua = np.asarray(max_ua, dtype=np.float64)
+        self.samples = np.asarray(samples, dtype=np.int64)
+        self.edges_s = np.append(self.starts_s, self.end_s)
+        self.cumulative_charge_uAs = np.concatenate(([0.0], np.cumsum(self.level_ua * np.diff(self.edges_s))))
+
+    def __len__(self):
+        return len(self.starts_s)
+
+    @property
+    def sample_count(self):
+        return int(self.samples.sum())
+
+    @property
+    def compression_ratio(self):
+        return self.sample_count / len(self) if len(self) else 1.0
+
+    @property
+    def duration_s(self):
+        return self.end_s - self.edges_s[0] if len(self) else 0.0
+
+    def _bounds(self, start_s, end_s):
+        start_s = self.edges_s[0] if start_s is None else start_s
+        end_s = self.end_s if end_s is None else end_s
+        return start_s, end_s
+
+    # Charge between two times, one interpolation of the cumulative charge at each end. Exact at
+    # segment boundaries. Inside a merged segment the samples are within tolerance of its level,
+    # which bounds the error. Works on arrays of start and end times.
+    def charge_uAs(self, start_s=None, end_s=None):
+        start_s, end_s = self._bounds(start_s, end_s)
+        return np.interp(end_s, self.edges_s, self.cumulative_charge_uAs) - np.interp(start_s, self.edges_s, self.cumulative_charge_uAs)
+
+    def charge_uAh(self, start_s=None, end_s=None):
+        return self.charge_uAs(start_s, end_s) / 3600.0
+
+    def energy_mWh(self, voltage=3.3, start_s=None, end_s=None):
+        return self.charge_uAh(start_s, end_s) * voltage * 1.0e-3
+
+    def mean_ua(self, start_s=None, end_s=None):
+        start_s, end_s = self._bounds(start_s, end_s)
+        return self.charge_uAs(start_s, end_s) / (np.asarray(end_s) - np.asarray(start_s))
+
+    # Level in effect at each time
+    def value_at(self, t_s):
+        k = np.clip(np.searchsorted(self.edges_s, t_s, side="right") - 1, 0, len(self) - 1)
+        return self.level_ua[k]
+
+    # Indices of the segments overlapping [start_s, end_s)
+    def segment_range(self, start_s=None, end_s=None):
+        start_s, end_s = self._bounds(start_s, end_s)
+        first = max(int(np.searchsorted(self.edges_s, start_s, side="right")) - 1, 0)
+        last = min(int(np.searchsorted(self.edges_s, end_s, side="left")), len(self))
+        return first, max(last, first)
+
+    # Largest and smallest sample of the segments overlapping the range
+    def peak_ua(self, start_s=None, end_s=None):
+        first, last = self.segment_range(start_s, end_s)
+        return float(self.max_ua[first:last].max()) if last > first else float("nan")
+
+    def floor_ua(self, start_s=None, end_s=None):
+        first, last = self.segment_range(start_s, end_s)
+        return float(self.min_ua[first:last].min()) if last > first else float("nan")
+
+    # The part of the trace within [start_s, end_s), with the outer segments cut to fit
+    def window(self, start_s=None, end_s=None):
+        start_s, end_s = self._bounds(start_s, end_s)
+        first, last = self.segment_range(start_s, end_s)
+        starts_s = self.starts_s[first:last].copy()
+        if len(starts_s):
+            starts_s[0] = max(starts_s[0], start_s)
+        return SEGMENTED_TRACE(starts_s, min(end_s, self.end_s), self.level_ua[first:last], self.min_ua[first:last],
+                               self.max_ua[first:last], self.samples[first:last])
+
+    # (times, levels) with two points per segment, drawing the trace as steps with plain line plots
+    def step_arrays(self, start_s=None, end_s=None):
+        part = self.window(start_s, end_s) if start_s is not None or end_s is not None else self
+        return np.repeat(part.edges_s, 2)[1:-1], np.repeat(part.level_ua, 2)
+
+    def plot(self, ax=None, label=None, envelope=True, start_s=None, end_s=None):
+        import matplotlib.pyplot as plt
+
+        if ax is None:
+            fig, ax = plt.subplots()
+        part = self.window(start_s, end_s) if start_s is not None or end_s is not None else self
+        t_s, level_ua = part.step_arrays()
+        line, = ax.plot(t_s, level_ua, label=label)
+        if envelope:
+            # Spread of the samples merged into each segment
+            ax.fill_between(t_s, np.repeat(part.min_ua, 2), np.repeat(part.max_ua, 2), color=line.get_color(), alpha=0.2, linewidth=0)
+        ax.set(xlabel='Time, s', ylabel='Current, uA')
+        return ax
+
+    def save(self, filename):
+        np.savez(filename, starts_s=self.starts_s, end_s=self.end_s, level_ua=self.level_ua, min_ua=self.min_ua,
+                 max_ua=self.max_ua, samples=self.samples)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            return cls(data["starts_s"], float(data["end_s"]), data["level_ua"], data["min_ua"], data["max_ua"], data["samples"])
+
+# Joins traces that follow each other in time
+def concatenate(traces):
+    traces = [trace for trace in traces if len(trace)]
+    if not traces:
+        return SEGMENTED_TRACE(np.zeros(0), 0.0, np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0, dtype=np.int64))
+    return SEGMENTED_TRACE(np.concatenate([trace.starts_s for trace in traces]), traces[-1].end_s,
+                           np.concatenate([trace.level_ua for trace in traces]), np.concatenate([trace.min_ua for trace in traces]),
+                           np.concatenate([trace.max_ua for trace in traces]), np.concatenate([trace.samples for trace in traces]))
+
+# Start index of every run in values[first:last] that stays within tolerance, taken greedily
+def split_runs(values, first, last, abs_tol_ua, rel_tol):
+    starts = []
+    position = first
+    width = 256
+    while position < last:
+        stop = min(position + width, last)
+        window = values[position:stop]
+        spread = np.maximum.accumulate(window) - np.minimum.accumulate(window)
+        tolerance = abs_tol_ua + rel_tol * np.minimum.accumulate(np.abs(window))
+        outside = spread > tolerance
+        if not outside.any() and stop < last:
+            width *= 2  # The run goes on past the window, look further
+            continue
+        starts.append(position)
+        position += int(np.argmax(outside)) if outside.any() else len(window)
+        width = 256
+    return starts
+
+def build_segments(t_s, current_ua, abs_tol_ua=DEFAULT_ABS_TOL_UA, rel_tol=DEFAULT_REL_TOL, min_run=DEFAULT_MIN_RUN, end_s=None):
+    t_s = np.asarray(t_s, dtype=np.float64)
+    values = np.asarray(current_ua, dtype=np.float64)
+    n = len(values)
+    if n == 0:
+        return concatenate([])
+    dt = np.diff(t_s)
+    # The last sample is held until end_s, or for one more sample interval
+    end_s = (t_s[-1] + (dt[-1] if len(dt) else 0.0)) if end_s is None else float(end_s)
+
+    # Quiet samples lie in at least one window of min_run samples that is within tolerance
+    min_run = max(int(min_run), 1)
+    quiet = np.zeros(n, dtype=bool)
+    if n >= min_run:
+        # Window maximum and minimum from shifted copies, faster than reducing a strided view
+        count = n - min_run + 1
+        high, low = values[:count].copy(), values[:count].copy()
+        magnitude = np.abs(values)
+        floor = magnitude[:count].copy()
+        for k in range(1, min_run):
+            np.maximum(high, values[k:k + count], out=high)
+            np.minimum(low, values[k:k + count], out=low)
+            np.minimum(floor, magnitude[k:k + count], out=floor)
+        valid = high - low <= abs_tol_ua + rel_tol * floor
+        covered = np.concatenate(([0], np.cumsum(valid)))
+        index = np.arange(n)
+        quiet = covered[np.minimum(index, n - min_run) + 1] - covered[np.clip(index - min_run + 1, 0, n - min_run + 1)] > 0
+
+    # Quiet stretches as [stretch_starts, stretch_ends)
+    change = np.diff(np.concatenate(([False], quiet, [False])).astype(np.int8))
+    stretch_starts = np.flatnonzero(change == 1)
+    stretch_ends = np.flatnonzero(change == -1)
+    starts = [np.flatnonzero(~quiet)]
+    if len(stretch_starts):
+        # reduceat runs to the next stretch start, so mask out the moving samples in between
+        masked_high = np.where(quiet, values, -np.inf)
+        masked_low = np.where(quiet, values, np.inf)
+        spread = np.maximum.reduceat(masked_high, stretch_starts) - np.minimum.reduceat(masked_low, stretch_starts)
+        floor = np.minimum.reduceat(np.where(quiet, np.abs(values), np.inf), stretch_starts)
+        whole = spread <= abs_tol_ua + rel_tol * floor
+        starts.append(stretch_starts[whole])
+        for first, last in zip(stretch_starts[~whole], stretch_ends[~whole]):
+            starts.append(np.array(split_runs(values, first, last, abs_tol_ua, rel_tol), dtype=np.int64))
+    starts = np.sort(np.concatenate(starts).astype(np.int64))
+
+    # Every segment from the cumulative charge of the samples, held until the next
+    t_ext = np.append(t_s, end_s)
+    charge_uAs = np.concatenate(([0.0], np.cumsum(values * np.diff(t_ext))))
+    nexts = np.append(starts[1:], n)
+    durations = t_ext[nexts] - t_ext[starts]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        level_ua = np.where(durations > 0, (charge_uAs[nexts] - charge_uAs[starts]) / durations, values[starts])
+    return SEGMENTED_TRACE(t_s[starts], end_s, level_ua, np.minimum.reduceat(values, starts), np.maximum.reduceat(values, starts), nexts - starts)
+
+# Segments a .mscap capture block by block, without loading it whole. Times are in seconds from
+# the first sample, and each block's last sample is held until the first sample of the next.
+def segment_capture(filename, abs_tol_ua=DEFAULT_ABS_TOL_UA, rel_tol=DEFAULT_REL_TOL, min_run=DEFAULT_MIN_RUN):
+    traces = []
+    with metashunt_capture.CAPTURE_READER(filename) as reader:
+        scale = 1.0e-6 / reader.ticks_per_us
+        first_tick = None
+        previous = None
+        for ticks, currents_ua in reader.iter_blocks():
+            if len(ticks) == 0:
+                continue
+            if first_tick is None:
+                first_tick = ticks[0]
+            t_s = (ticks - first_tick) * scale
+            if previous is not None:
+                traces.append(build_segments(*previous, abs_tol_ua, rel_tol, min_run, end_s=t_s[0]))
+            previous = (t_s, currents_ua)
+        if previous is not None:
+            traces.append(build_segments(*previous, abs_tol_ua, rel_tol, min_run))
+    return concatenate(traces)
+
+if __name__ == "__main__":
+    import metashunt_report
+
+    if len(sys.argv) < 2:
+        print("Please provide a capture")
+        display_how_to_use()
+        sys.exit()
+
+    abs_tol_ua = float(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_ABS_TOL_UA
+    rel_tol = float(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_REL_TOL
+    if sys.argv[1].endswith(metashunt_capture.CAPTURE_EXTENSION):
+        trace = segment_capture(sys.argv[1], abs_tol_ua, rel_tol)
+    else:
+        profile = metashunt_report.load_capture(sys.argv[1])
+        trace = build_segments(profile.t_s, profile.current_ua, abs_tol_ua, rel_tol)
+
+    print("{0} samples in {1} segments ({2:.1f}x fewer)".format(trace.sample_count, len(trace), trace.compression_ratio))
+    print("Single sample segments: {0}".format(int(np.sum(trace.samples == 1))))
+    print("Duration: {0:.6g} s".format(trace.duration_s))
+    print("Charge: {0:.6g} uAh, mean current {1:.6g} uA, peak {2:.6g} uA".format(trace.charge_uAh(), trace.mean_ua(), trace.peak_ua()))
+    if len(sys.argv) > 4:
+        trace.save(sys.argv[4])
+        print("Segments written to {0}".format(sys.argv[4]))
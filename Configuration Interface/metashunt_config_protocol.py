@@ -0,0 +1,149 @@
+import struct
+import time
+import math
+
+# Resistor configuration command layer shared by the V1 and V2 configure tools.
+#
+# Commands: 0xAA, command, length, data..., checksum (sum of everything after 0xAA)
+#   Write resistor: command 2, data = index (uint8), value (float32)
+#   Read resistor:  command 3, data = index (uint8)
+# Replies:  0xAA, 0x04, index (uint8), value (float32), checksum
+#
+# The read reply carries the index, so several requests can be in flight at once and
+# replies are matched back to their resistor by index instead of by arrival order.
+
+COMMAND_WRITE_RESISTOR = 2
+COMMAND_READ_RESISTOR = 3
+REPLY_RESISTOR = 0x04
+
+STATUS_UNCHANGED = "unchanged"
+STATUS_SET = "set"
+STATUS_FAILED = "failed"
+
+def add_checksum(payload):
+    payload = bytearray(payload)
+    payload.append(sum(payload[1:]) & 0xFF)
+    return payload
+
+def write_resistor_command(index, value):
+    return add_checksum(struct.pack("<BBBBf", 0xAA, COMMAND_WRITE_RESISTOR, 5, index, value))
+
+def read_resistor_command(index):
+    return add_checksum(struct.pack("<BBBB", 0xAA, COMMAND_READ_RESISTOR, 1, index))
+
+def values_match(device_value, desired_value, rel_tol=1e-5):
+    return device_value is not None and math.isclose(device_value, desired_value, rel_tol=rel_tol)
+
+class REPLY_PARSER:
+    def __init__(self):
+        self.step = 0
+        self.chk = 0
+        self.payload = bytearray()
+
+    # Feed raw bytes, get back every complete (index, value) reply
+    def feed(self, data):
+        replies = []
+        for byte in data:
+            if self.step == 0:
+                if byte == 0xAA:
+                    self.step = 1
+            elif self.step == 1:
+                if byte == REPLY_RESISTOR:
+                    self.step = 2
+                    self.chk = byte
+                    self.payload = bytearray()
+                elif byte != 0xAA:
+                    # Not a correct message, so reset
+                    self.step = 0
+            elif self.step == 2:
+                self.payload.append(byte)
+                self.chk = (self.chk + byte) & 0xFF
+                if len(self.payload) == 5:
+                    self.step = 3
+            elif self.step == 3:
+                if byte == self.chk:
+                    replies.append(struct.unpack("<Bf", bytes(self.payload)))
+                self.step = 0
+        return replies
+
+class CONFIG_LINK:
+    def __init__(self, ser, index_dict, timeout=0.15, retries=3, rel_tol=1e-5):
+        self.ser = ser
+        self.index_dict = index_dict
+        self.timeout = timeout
+        self.retries = retries
+        self.rel_tol = rel_tol
+
+    def _collect(self, parser, pending, values, deadline):
+        while pending and time.time() < deadline:
+            data = self.ser.read(max(1, self.ser.in_waiting))
+            for index, value in parser.feed(data):
+                if index in pending:
+                    pending.discard(index)
+                    values[index] = value
+
+    # One batched read of the given resistors, re-requesting any that time out
+    def read_all(self, keys):
+        keys = list(keys)
+        values = {}
+        pending = set(self.index_dict[key] for key in keys)
+        parser = REPLY_PARSER()
+        self.ser.reset_input_buffer()
+        for attempt in range(self.retries + 1):
+            if not pending:
+                break
+            self.ser.write(b"".join(read_resistor_command(index) for index in sorted(pending)))
+            self._collect(parser, pending, values, time.time() + self.timeout + 0.002 * len(pending))
+        return {key: values.get(self.index_dict[key]) for key in keys}
+
+    def write_all(self, config_data):
+        if config_data:
+            self.ser.write(b"".join(write_resistor_command(self.index_dict[key], value)
+                                    for key, value in config_data.items()))
+
+    # Only writes values that differ from the device, then verifies with one read-back.
+    # Returns {key: (status, device_value)}
+    def configure(self, config_data):
+        device_values = self.read_all(config_data.keys())
+        results = {}
+        to_write = {}
+        for key, value in config_data.items():
+            if values_match(device_values[key], value, self.rel_tol):
+                results[key] = (STATUS_UNCHANGED, device_values[key])
+            else:
+                to_write[key] = value
+
+        for attempt in range(self.retries + 1):
+            if not to_write:
+                break
+            self.write_all(to_write)
+            device_values = self.read_all(to_write.keys())
+            for key in list(to_write.keys()):
+                if values_match(device_values[key], to_write[key], self.rel_tol):
+                    results[key] = (STATUS_SET, device_values[key])
+                    del to_write[key]
+
+        for key in to_write:
+            results[key] = (STATUS_FAILED, device_values[key])
+        return results
+
+def print_configuration_report(config_data, results, index_dict):
+    for key in config_data:
+        status, value = results[key]
+        if status == STATUS_UNCHANGED:
+            print("Resistor {0} already {1} Ohm".format(key, value))
+        elif status == STATUS_SET:
+            print("Resistor {0} set to {1} Ohm".format(key, value))
+        elif value is None:
+            print("ERROR ************** Nothing heard back for {0} ************** ERROR".format(key))
+        else:
+            print("Received back {} index and {} Ohm".format(index_dict[key], value))
+            print("Should be {} index and {} Ohm".format(index_dict[key], config_data[key]))
+            print("Configuration of {0} Failed".format(key))
+
+    failed = [key for key in config_data if results[key][0] == STATUS_FAILED]
+    if failed:
+        print("Configuration Failed for {0}".format(", ".join(failed)))
+    else:
+        print("Configuration Set Correctly")
+    return len(failed) == 0
@@ -0,0 +1,137 @@
+import serial
+import sys
+import os
+import time
+import json
+import serial.tools.list_ports
+from concurrent.futures import ThreadPoolExecutor
+from metashunt_config_protocol import CONFIG_LINK, STATUS_FAILED, STATUS_SET
+from metashunt_configure import config_index_dict as v1_config_index_dict
+from metashunt_v2_configure import config_index_dict as v2_config_index_dict
+
+# Provision every connected MetaShunt from a manifest keyed by USB serial number:
+# {
+#     "<usb serial number>" : {"version" : 2, "config" : "metashunt_v2_cfg.json"},
+#     ...
+# }
+# Config paths are relative to the manifest, and "version" (1 or 2) defaults to 2. All matched devices
+# are configured in parallel.
+
+config_index_dicts = {1: v1_config_index_dict, 2: v2_config_index_dict}
+
+def display_how_to_use():
+    print("To use, follow these rules:")
+    print("python metashunt_fleet_provision.py manifest_json [report_json] --- Configure and verify every connected device in the manifest")
+
+def find_metashunt_ports():
+    ports = {}
+    for comport in serial.tools.list_ports.comports():
+        if "STM" in comport.description and comport.serial_number:
+            ports[comport.serial_number] = comport.device
+    return ports
+
+def load_manifest(manifest_file_name):
+    with open(manifest_file_name) as f:
+        manifest = json.load(f)
+
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_file_name))
+    devices = {}
+    for serial_number, entry in manifest.items():
+        config_file_name = os.path.join(manifest_dir, entry["config"])
+        with open(config_file_name) as f:
+            config_data = json.load(f)
+        devices[serial_number] = {"version": entry.get("version", 2), "config": config_file_name, "config_data": config_data}
+    return devices
+
+# Error for a manifest entry that cannot be provisioned whether or not it is connected
+def manifest_error(device):
+    if device["version"] not in config_index_dicts:
+        return "Unsupported version {0!r}, expected 1 or 2".format(device["version"])
+    return None
+
+def provision_device(serial_number, port, device):
+    result = {"serial_number": serial_number, "port": port, "config": device["config"], "resistors": {}}
+    error = manifest_error(device)
+    if error:
+        result["passed"] = False
+        result["error"] = error
+        result["duration_s"] = 0.0
+        return result
+    index_dict = config_index_dicts[device["version"]]
+    start = time.time()
+    try:
+        ser = serial.Serial(port, timeout=0.1)
+        try:
+            link = CONFIG_LINK(ser, index_dict)
+            resistor_results = link.configure(device["config_data"])
+        finally:
+            ser.close()
+    except Exception as e:
+        # Any failure on one device is that device's result, the rest of the fleet carries on
+        result["passed"] = False
+        result["error"] = str(e) if isinstance(e, serial.SerialException) else "{0}: {1}".format(type(e).__name__, e)
+        result["duration_s"] = time.time() - start
+        return result
+
+    result["resistors"] = {key: {"status": status, "value": value} for key, (status, value) in resistor_results.items()}
+    result["written"] = sum(1 for status, value in resistor_results.values() if status == STATUS_SET)
+    result["passed"] = all(status != STATUS_FAILED for status, value in resistor_results.values())
+    result["duration_s"] = time.time() - start
+    return result
+
+def provision_fleet(devices, ports):
+    matched = [serial_number for serial_number in devices if serial_number in ports]
+    results = {}
+    if matched:
+        with ThreadPoolExecutor(max_workers=len(matched)) as executor:
+            futures = {serial_number: executor.submit(provision_device, serial_number, ports[serial_number], devices[serial_number])
+                       for serial_number in matched}
+            for serial_number, future in futures.items():
+                results[serial_number] = future.result()
+
+    for serial_number in devices:
+        if serial_number not in ports:
+            results[serial_number] = {"serial_number": serial_number, "port": None, "config": devices[serial_number]["config"],
+                                      "passed": False, "error": manifest_error(devices[serial_number]) or "Not connected"}
+    return results
+
+def print_fleet_report(results, ports):
+    print("{0:<28}{1:<16}{2:<8}{3:<10}{4}".format("Serial Number", "Port", "Result", "Written", "Details"))
+    for serial_number, result in results.items():
+        if "error" in result:
+            details = result["error"]
+        else:
+            failed = [key for key, r in result["resistors"].items() if r["status"] == STATUS_FAILED]
+            details = "Failed: " + ", ".join(failed) if failed else "{0:.2f} s".format(result["duration_s"])
+        print("{0:<28}{1:<16}{2:<8}{3:<10}{4}".format(serial_number, str(result["port"]), "PASS" if result["passed"] else "FAIL",
+                                                     str(result.get("written", "-")), details))
+
+    for serial_number, port in ports.items():
+        if serial_number not in results:
+            print("Connected device {0} on {1} is not in the manifest, skipped".format(serial_number, port))
+
+    passed = sum(1 for result in results.values() if result["passed"])
+    print("{0} of {1} devices passed".format(passed, len(results)))
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 2:
+        print("Please provide a manifest file")
+        display_how_to_use()
+        sys.exit()
+
+    devices = load_manifest(sys.argv[1])
+    ports = find_metashunt_ports()
+    print("Found {0} connected MetaShunts, {1} devices in manifest".format(len(ports), len(devices)))
+
+    start_time = time.time()
+    results = provision_fleet(devices, ports)
+    print_fleet_report(results, ports)
+    print("Provisioning took {0:.2f} s".format(time.time() - start_time))
+
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], "w") as f:
+            json.dump(results, f, indent=4)
+
+    if not all(result["passed"] for result in results.values()):
+        sys.exit(1)
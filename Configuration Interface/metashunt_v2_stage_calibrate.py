@@ -0,0 +1,202 @@
+import numpy as np
+import json
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Realtime Interface"))
+
+# Multi-point calibration of all eight V2 stages.
+#
+# A plan lists known reference loads and the stage each one lands in:
+# {
+#     "V_bus" : 5.05,
+#     "settle_s" : 0.5,
+#     "capture_s" : 2.0,
+#     "wait_for_enter" : true,
+#     "steps" : [ {"load_ohm" : 10.0, "stage" : 7}, {"load_ohm" : 21.9, "stage" : 6}, ... ]
+# }
+# A step may carry "measured_ma" instead of being captured, to reuse hand measurements.
+#
+# The device moves to a lower resistance stage when the shunt voltage would leave the ADC range
+# (3 V reference over a gain of 50), so stage k covers currents up to SHUNT_FULL_SCALE_V / r_eff[k].
+# Every load has to land well inside its declared stage's range. The stream does not carry the
+# stage, so each capture's stage is inferred from its measured current and the step is rejected if
+# it differs from the declared one.
+#
+# For each step the shunt voltage the device saw is measured_current * configured r_eff, and the
+# true current is (V_bus - shunt voltage) / load. Each stage resistance is then the least squares
+# slope of shunt voltage against true current over all steps on that stage.
+
+stage_resistor_keys = ["R19", "R17", "R15", "R13", "R11", "R9", "R2", "R1"]
+SHUNT_FULL_SCALE_V = 3.0 / 50.0
+STAGE_MARGIN = 0.1  # Loads must sit this fraction away from either end of their stage range
+
+def display_how_to_use():
+    print("To use, follow these rules:")
+    print("python metashunt_v2_stage_calibrate.py config_json plan_json output_json --- Capture every plan step, fit all stage resistances and write a corrected config")
+
+def stage_resistances(config_data):
+    fet_r = config_data["R_FET"]
+    r_eff = np.zeros(len(stage_resistor_keys))
+    r_eff[0] = config_data[stage_resistor_keys[0]]
+    for k in range(1, len(stage_resistor_keys)):
+        r_eff[k] = 1.0/((1.0/(config_data[stage_resistor_keys[k]] + fet_r)) + (1.0/r_eff[k-1]))
+    return r_eff
+
+# (lowest, highest) current in A of every stage
+def stage_ranges(r_eff):
+    upper = SHUNT_FULL_SCALE_V / np.asarray(r_eff)
+    return np.concatenate(([0.0], upper[:-1])), upper
+
+def stage_for_current(current_a, r_eff):
+    lower, upper = stage_ranges(r_eff)
+    return np.minimum(np.searchsorted(upper, current_a), len(upper) - 1)
+
+# Problems with the plan: loads whose current is not well inside their declared stage
+def check_plan(steps, r_eff, V_bus):
+    lower, upper = stage_ranges(r_eff)
+    problems = []
+    for step in steps:
+        k = step["stage"]
+        current_a = V_bus / (step["load_ohm"] + r_eff[k])
+        if not (lower[k] * (1.0 + STAGE_MARGIN) <= current_a <= upper[k] * (1.0 - STAGE_MARGIN)):
+            problems.append("{0} Ohm draws {1:.4g} A, outside stage {2} ({3:.4g} A to {4:.4g} A with margin)".format(
+                step["load_ohm"], current_a, k, lower[k] * (1.0 + STAGE_MARGIN), upper[k] * (1.0 - STAGE_MARGIN)))
+    return problems
+
+# Inverse of stage_resistances. R_FET is kept and any correction is lumped into each stage resistor,
+# since only the effective resistance of each stage matters.
+def config_from_stage_resistances(config_data, r_eff):
+    fet_r = config_data["R_FET"]
+    r_eff_old = stage_resistances(config_data)
+    # Each stage adds a branch in parallel, so stage resistance must fall from one stage to the next
+    if np.any(np.diff(r_eff) >= 0.0):
+        raise ValueError("Stage resistances must decrease from stage to stage, got {0}".format([float(r) for r in r_eff]))
+    new_config = dict(config_data)
+    new_config[stage_resistor_keys[0]] = float(r_eff[0])
+    for k in range(1, len(stage_resistor_keys)):
+        if r_eff[k] == r_eff_old[k] and r_eff[k-1] == r_eff_old[k-1]:
+            # Untouched stage, keep the exact original value
+            continue
+        branch_r = 1.0/((1.0/r_eff[k]) - (1.0/r_eff[k-1]))
+        new_config[stage_resistor_keys[k]] = float(branch_r - fet_r)
+    return new_config
+
+def reduce_step(current_ma):
+    current_ma = np.asarray(current_ma, dtype=np.float64)
+    p5, median, p95 = np.percentile(current_ma, [5.0, 50.0, 95.0])
+    return {"samples": int(len(current_ma)), "mean_ma": float(np.mean(current_ma)), "median_ma": float(median),
+            "std_ma": float(np.std(current_ma)), "p5_ma": float(p5), "p95_ma": float(p95)}
+
+def capture_step(reader, step, plan):
+    if plan.get("wait_for_enter", True):
+        input("Connect the {0} Ohm reference load and press Enter".format(step["load_ohm"]))
+    reader.ser.reset_input_buffer()
+    reader.capture(plan.get("settle_s", 0.5))
+    ticks, current_ma = reader.capture(plan.get("capture_s", 2.0))
+    if len(current_ma) == 0:
+        print("ERROR ************** No data for {0} Ohm load ************** ERROR".format(step["load_ohm"]))
+        return None
+    return reduce_step(current_ma)
+
+def fit_stage_resistances(r_eff_current, V_bus, steps, stats):
+    stages = np.array([step["stage"] for step in steps])
+    loads = np.array([step["load_ohm"] for step in steps], dtype=np.float64)
+    measured_a = np.array([s["median_ma"] for s in stats]) * 1.0e-3
+
+    shunt_v = measured_a * r_eff_current[stages]
+    actual_a = (V_bus - shunt_v) / loads
+
+    # Block diagonal design: one column per calibrated stage
+    fitted_stages = np.unique(stages)
+    design = np.zeros((len(steps), len(fitted_stages)))
+    design[np.arange(len(steps)), np.searchsorted(fitted_stages, stages)] = actual_a
+    solution, residuals, rank, sv = np.linalg.lstsq(design, shunt_v, rcond=None)
+
+    r_eff_new = np.array(r_eff_current, dtype=np.float64)
+    r_eff_new[fitted_stages] = solution
+    fit_error_v = shunt_v - design @ solution
+    return r_eff_new, fitted_stages, fit_error_v
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 4:
+        print("Please provide the current configuration, calibration plan and output JSON files")
+        display_how_to_use()
+        sys.exit()
+
+    with open(sys.argv[1]) as f:
+        config_data = json.load(f)
+    with open(sys.argv[2]) as f:
+        plan = json.load(f)
+    output_file_name = sys.argv[3]
+
+    steps = plan["steps"]
+    r_eff_current = stage_resistances(config_data)
+    problems = check_plan(steps, r_eff_current, plan["V_bus"])
+    if problems:
+        for problem in problems:
+            print("ERROR ************** {0} ************** ERROR".format(problem))
+        print("Fix the calibration plan, config not written")
+        sys.exit()
+
+    stats = [None] * len(steps)
+    for i, step in enumerate(steps):
+        if "measured_ma" in step:
+            stats[i] = reduce_step([step["measured_ma"]])
+
+    if any(s is None for s in stats):
+        import serial
+        from metashunt_v2_stream import STREAM_READER, find_metashunt_port
+
+        port = find_metashunt_port()
+        if not port:
+            print("Could not connect to MetaShunt")
+            sys.exit()
+        ser = serial.Serial(port, timeout=0.1)
+        print("Connected to MetaShunt")
+        reader = STREAM_READER(ser)
+        for i, step in enumerate(steps):
+            if stats[i] is None:
+                stats[i] = capture_step(reader, step, plan)
+        ser.close()
+
+    # A load the device measured on another stage would calibrate the wrong resistor
+    for i, (step, s) in enumerate(zip(steps, stats)):
+        if s is None:
+            continue
+        measured_stage = int(stage_for_current(s["median_ma"] * 1.0e-3, r_eff_current))
+        if measured_stage != step["stage"]:
+            print("ERROR ************** {0} Ohm load measured {1:.4f} mA, which is stage {2}, not stage {3}. Step rejected ************** ERROR".format(
+                step["load_ohm"], s["median_ma"], measured_stage, step["stage"]))
+            stats[i] = None
+
+    captured = [i for i, s in enumerate(stats) if s is not None]
+    steps = [steps[i] for i in captured]
+    stats = [stats[i] for i in captured]
+    if not steps:
+        print("No calibration data, config not written")
+        sys.exit()
+
+    for step, s in zip(steps, stats):
+        print("Stage {0}, {1} Ohm load: median {2:.4f} mA, std {3:.4f} mA over {4} samples".format(
+            step["stage"], step["load_ohm"], s["median_ma"], s["std_ma"], s["samples"]))
+
+    r_eff_new, fitted_stages, fit_error_v = fit_stage_resistances(r_eff_current, plan["V_bus"], steps, stats)
+    for k in fitted_stages:
+        print("Stage {0} effective resistance was set to: {1} Ohm, but is actually {2} Ohm".format(k, r_eff_current[k], r_eff_new[k]))
+    print("RMS fit error: {0} mV".format(1000.0 * np.sqrt(np.mean(fit_error_v**2))))
+
+    try:
+        new_config = config_from_stage_resistances(config_data, r_eff_new)
+    except ValueError as e:
+        print("ERROR ************** {0} ************** ERROR".format(e))
+        print("Config not written")
+        sys.exit()
+    for key in stage_resistor_keys:
+        if new_config[key] != config_data[key]:
+            print("Updated {0} is {1} Ohm, but was {2} Ohm".format(key, new_config[key], config_data[key]))
+
+    with open(output_file_name, "w") as f:
+        json.dump(new_config, f, indent=4)
+    print("Corrected configuration written to {0}".format(output_file_name))
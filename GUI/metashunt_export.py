@@ -0,0 +1,102 @@
+import threading
+import os
+import numpy as np
+import metashunt_capture
+
+# Background export of measurement snapshots so the Dear PyGui callback thread never blocks.
+#
+# The format follows the file extension:
+#   .npz   - NumPy columnar arrays time_s and current_mA
+#   .mscap - compressed MetaShunt capture
+#   other  - CSV with the same "Time (s),Current (mA)" columns as before
+# CSV rows are formatted a chunk at a time with a single string format call per chunk.
+# When part of the session was spilled to disk, the spill capture is streamed out first and
+# the resident samples follow it.
+
+EXPORT_CHUNK_SAMPLES = 100000
+
+class EXPORT_JOB:
+    def __init__(self, path, times_us, currents_uA, ticks_per_us=metashunt_capture.DEFAULT_TICKS_PER_US, spill_path=None):
+        self.path = path
+        self.times_us = times_us
+        self.currents_uA = currents_uA
+        self.spill_path = spill_path
+        self.ticks_per_us = ticks_per_us
+        self.progress = 0.0
+        self.done = False
+        self.error = None
+        self.cancel_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def _chunks(self):
+        n = len(self.times_us)
+        done = 0
+        if self.spill_path is not None:
+            with metashunt_capture.CAPTURE_READER(self.spill_path) as reader:
+                total = len(reader) + n
+                for ticks, currents_uA in reader.iter_blocks():
+                    if self.cancelled:
+                        return
+                    yield ticks / reader.ticks_per_us, currents_uA
+                    done += len(ticks)
+                    self.progress = done / total
+        else:
+            total = n
+        for start in range(0, n, EXPORT_CHUNK_SAMPLES):
+            if self.cancelled:
+                return
+            stop = min(start + EXPORT_CHUNK_SAMPLES, n)
+            yield self.times_us[start:stop], self.currents_uA[start:stop]
+            self.progress = (done + stop) / total
+
+    def _export_csv(self):
+        with open(self.path, "w") as f:
+            f.write("Time (s),Current (mA)\n")
+            for times_us, currents_uA in self._chunks():
+                columns = np.empty((len(times_us), 2))
+                columns[:, 0] = times_us / 1e6  # Convert to seconds
+                columns[:, 1] = currents_uA / 1000.0  # Convert uA to mA
+                f.write(("%.6f,%.8f\n" * len(columns)) % tuple(columns.ravel().tolist()))
+
+    def _export_npz(self):
+        if self.spill_path is not None:
+            chunks = list(self._chunks())
+            if self.cancelled:
+                return
+            times_us = np.concatenate([t for t, i in chunks])
+            currents_uA = np.concatenate([i for t, i in chunks])
+        else:
+            times_us, currents_uA = self.times_us, self.currents_uA
+        np.savez(self.path, time_s=times_us / 1e6, current_mA=currents_uA / 1000.0)
+        self.progress = 1.0
+
+    def _export_capture(self):
+        with metashunt_capture.CAPTURE_WRITER(self.path, ticks_per_us=self.ticks_per_us) as writer:
+            for times_us, currents_uA in self._chunks():
+                writer.write(np.rint(times_us * self.ticks_per_us).astype(np.int64), currents_uA)
+
+    def _run(self):
+        try:
+            extension = os.path.splitext(self.path)[1].lower()
+            if extension == ".npz":
+                self._export_npz()
+            elif extension == metashunt_capture.CAPTURE_EXTENSION:
+                self._export_capture()
+            else:
+                self._export_csv()
+            if self.cancelled and os.path.exists(self.path):
+                os.remove(self.path)
+        except Exception as e:
+            self.error = e
+        self.done = True
@@ -0,0 +1,110 @@
+import threading
+import os
+import numpy as np
+
+# Background import of exported logs so large files never block the Dear PyGui callback thread.
+#
+# The file is read in blocks of raw text. Each block is cut at its last newline and parsed in C
+# with np.fromstring, then copied straight into float64 buffers that grow by doubling, so there
+# are no per-line Python objects. Like SAMPLE_BUFFER, growing allocates fresh arrays, so the GUI
+# can draw a decimated preview of the samples loaded so far while the worker keeps going.
+#
+# Files are CSV with a header row, time in seconds in the first column and current in mA in the
+# second, as written by the GUI export.
+
+IMPORT_BLOCK_BYTES = 1 << 22
+
+# Min and max of each group of samples, interleaved so spikes survive in the preview
+def decimate_for_plot(t, y, max_points=4000):
+    n = len(t)
+    if n <= max_points:
+        return t, y
+    starts = np.arange(0, n, -(-2 * n // max_points))
+    t_pairs = np.repeat(t[starts], 2)
+    y_pairs = np.empty(2 * len(starts), dtype=y.dtype)
+    y_pairs[0::2] = np.minimum.reduceat(y, starts)
+    y_pairs[1::2] = np.maximum.reduceat(y, starts)
+    return t_pairs, y_pairs
+
+class IMPORT_JOB:
+    def __init__(self, path, initial_capacity=65536):
+        self.path = path
+        self.progress = 0.0
+        self.done = False
+        self.error = None
+        self._state = (0, np.empty(initial_capacity), np.empty(initial_capacity))
+        self.cancel_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def __len__(self):
+        return self._state[0]
+
+    # Read-only views of everything parsed so far, times in s and currents in uA
+    def arrays(self):
+        count, times_s, currents_uA = self._state
+        times_view = times_s[:count]
+        currents_view = currents_uA[:count]
+        times_view.flags.writeable = False
+        currents_view.flags.writeable = False
+        return times_view, currents_view
+
+    def _append(self, rows):
+        count, times_s, currents_uA = self._state
+        n = len(rows)
+        if count + n > len(times_s):
+            capacity = len(times_s)
+            while capacity < count + n:
+                capacity *= 2
+            new_times = np.empty(capacity)
+            new_currents = np.empty(capacity)
+            new_times[:count] = times_s[:count]
+            new_currents[:count] = currents_uA[:count]
+            times_s, currents_uA = new_times, new_currents
+        times_s[count:count + n] = rows[:, 0]
+        currents_uA[count:count + n] = rows[:, 1] * 1000.0  # mA to uA
+        self._state = (count + n, times_s, currents_uA)
+
+    def _parse(self, text, columns):
+        text = text.replace("\r", "").strip().replace("\n", ",")
+        if not text:
+            return
+        values = np.fromstring(text, sep=",")
+        if len(values) % columns:
+            raise ValueError("Rows do not all have {0} columns".format(columns))
+        self._append(values.reshape(-1, columns))
+
+    def _run(self):
+        try:
+            size = max(os.path.getsize(self.path), 1)
+            with open(self.path, "r") as f:
+                header = f.readline()
+                columns = header.count(",") + 1
+                remainder = ""
+                read_chars = len(header)
+                while not self.cancelled:
+                    block = f.read(IMPORT_BLOCK_BYTES)
+                    if not block:
+                        self._parse(remainder, columns)
+                        break
+                    read_chars += len(block)
+                    block = remainder + block
+                    cut = block.rfind("\n") + 1
+                    remainder = block[cut:]
+                    self._parse(block[:cut], columns)
+                    self.progress = min(read_chars / size, 1.0)  # Logs are ASCII, so characters are bytes
+            if not self.cancelled:
+                self.progress = 1.0
+        except Exception as e:
+            self.error = e
+        self.done = True
@@ -0,0 +1,70 @@
+import time
+import os
+import numpy as np
+import metashunt_capture
+
+# Replays a recorded capture into the GUI as if it were arriving from the device.
+#
+# Samples are read a chunk at a time (.mscap block by block, .npz and CSV exports whole) and
+# handed to a sink, normally SAMPLE_BUFFER.extend, from the acquisition thread just like
+# serial_worker. Each chunk is released once wall clock time times the speed factor reaches the
+# chunk's first sample, so speed 1.0 is real time, 10.0 is ten times faster and None does not
+# wait at all, which makes playback a repeatable load generator for GUI throughput.
+
+PLAYBACK_CHUNK_SAMPLES = 2048
+PLAYBACK_SPEEDS = {"Real-time": 1.0, "2x": 2.0, "10x": 10.0, "100x": 100.0, "Max": None}
+
+# Yields (times_us, currents_uA) chunks with times relative to the first sample
+def read_recording(path, chunk_samples=PLAYBACK_CHUNK_SAMPLES):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == metashunt_capture.CAPTURE_EXTENSION:
+        with metashunt_capture.CAPTURE_READER(path) as reader:
+            first_tick = None
+            for ticks, currents_ua in reader.iter_blocks():
+                if first_tick is None and len(ticks):
+                    first_tick = int(ticks[0])
+                times_us = (ticks - first_tick) / reader.ticks_per_us
+                for start in range(0, len(ticks), chunk_samples):
+                    yield times_us[start:start + chunk_samples], currents_ua[start:start + chunk_samples]
+        return
+
+    if extension == ".npz":
+        with np.load(path) as data:
+            times_us = data["time_s"] * 1e6
+            currents_uA = data["current_mA"] * 1000.0
+    else:
+        columns = np.loadtxt(path, delimiter=",", skiprows=1, ndmin=2)
+        times_us = columns[:, 0] * 1e6
+        currents_uA = columns[:, 1] * 1000.0
+    if len(times_us) == 0:
+        return
+    times_us = times_us - times_us[0]
+    for start in range(0, len(times_us), chunk_samples):
+        yield times_us[start:start + chunk_samples], currents_uA[start:start + chunk_samples]
+
+class PLAYBACK_SOURCE:
+    def __init__(self, path, speed=1.0, chunk_samples=PLAYBACK_CHUNK_SAMPLES):
+        self.path = path
+        self.speed = speed
+        self.chunk_samples = chunk_samples
+        self.samples_played = 0
+        self.elapsed_s = 0.0
+
+    @property
+    def samples_per_second(self):
+        return self.samples_played / self.elapsed_s if self.elapsed_s > 0 else 0.0
+
+    # Feeds every chunk to sink(times_us, currents_uA) until the recording ends or keep_running() is False
+    def run(self, sink, keep_running=lambda: True):
+        start = time.perf_counter()
+        for times_us, currents_uA in read_recording(self.path, self.chunk_samples):
+            if not keep_running():
+                break
+            if self.speed is not None:
+                wait_s = times_us[0] / 1e6 / self.speed - (time.perf_counter() - start)
+                if wait_s > 0:
+                    time.sleep(wait_s)
+            sink(times_us, currents_uA)
+            self.samples_played += len(times_us)
+        self.elapsed_s = time.perf_counter() - start
+        return self.samples_played
@@ -0,0 +1,289 @@
+import numpy as np
+import threading
+import queue
+import os
+import time
+
+# Single producer / multi consumer sample storage for the GUI.
+#
+# The serial worker is the only writer. It fills typed NumPy arrays and then publishes
+# (generation, count, times, currents, spill) as one tuple, which is a single reference swap.
+# Readers grab that tuple and slice the first `count` samples, which gives a view and
+# never a copy. Samples below `count` are never written again, and growing or resetting
+# allocates fresh arrays, so a reader's view stays consistent while the writer continues.
+# reset() and finish_spill() may come from another thread while the writer is mid-append. The
+# writer publishes, and opens or feeds the spill capture, under a small lock and only if the
+# generation it started from is still current, so a reset is never undone by a stale tuple and
+# no capture is reopened after it was finished.
+#
+# With a memory budget set, the resident arrays never grow past the budget. When they are
+# full, the oldest samples are reduced to one summary row per SPILL_SUMMARY_SAMPLES samples
+# (time span, min, max, sum and charge), which stays in RAM, and the raw samples are handed
+# to a background thread that appends them to a compressed .mscap capture on disk. Charts and
+# statistics use the summaries for the spilled part of the session and raw samples after it.
+# The capture belongs to the session, so reset() deletes it along with the samples.
+
+SPILL_SUMMARY_SAMPLES = 1024
+
+spill_summary_dtype = np.dtype([
+    ("start_us", np.float64),  # First sample time
+    ("end_us", np.float64),  # Time of the sample after the group, so groups tile the session
+    ("samples", np.int64),
+    ("min_uA", np.float64),
+    ("max_uA", np.float64),
+    ("sum_uA", np.float64),
+    ("charge_uAs", np.float64),  # Each sample held until the next one, as the live charge plot does
+])
+
+def summarize_spill(times_us, currents_uA, next_time_us, group_samples=SPILL_SUMMARY_SAMPLES):
+    n = len(times_us)
+    starts = np.arange(0, n, group_samples)
+    ends_us = np.append(times_us[starts[1:]], next_time_us)
+    dt_s = np.diff(np.append(times_us, next_time_us)) / 1e6
+    summaries = np.empty(len(starts), dtype=spill_summary_dtype)
+    summaries["start_us"] = times_us[starts]
+    summaries["end_us"] = ends_us
+    summaries["samples"] = np.diff(np.append(starts, n))
+    summaries["min_uA"] = np.minimum.reduceat(currents_uA, starts)
+    summaries["max_uA"] = np.maximum.reduceat(currents_uA, starts)
+    summaries["sum_uA"] = np.add.reduceat(currents_uA, starts, dtype=np.float64)
+    summaries["charge_uAs"] = np.add.reduceat(currents_uA * dt_s, starts, dtype=np.float64)
+    return summaries
+
+# Appends spilled samples to a capture file from its own thread so disk writes and compression
+# never stall the serial worker
+class SPILL_WRITER:
+    def __init__(self, path, ticks_per_us):
+        import metashunt_capture
+
+        self.path = path
+        self.ticks_per_us = ticks_per_us
+        self.writer = metashunt_capture.CAPTURE_WRITER(path, ticks_per_us=ticks_per_us, current_dtype=np.float64,
+                                                       metadata={"source": "MetaShunt V2 GUI spill"})
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            times_us, currents_uA = item
+            try:
+                self.writer.write(np.rint(times_us * self.ticks_per_us).astype(np.int64), currents_uA)
+            except Exception as e:
+                self.error = e
+        self.writer.close()
+
+    def write(self, times_us, currents_uA):
+        self.queue.put((times_us, currents_uA))
+
+    # Blocks until everything queued is on disk, after which the capture can be read
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+class SAMPLE_SNAPSHOT:
+    def __init__(self, generation, count, times_us, currents_uA, spilled_count=0, summaries=None, spill_path=None):
+        self.generation = generation
+        self.count = count  # Every sample in the session, spilled or resident
+        self.times_us = times_us  # Resident samples only
+        self.currents_uA = currents_uA
+        self.spilled_count = spilled_count
+        self.summaries = np.zeros(0, dtype=spill_summary_dtype) if summaries is None else summaries
+        self.spill_path = spill_path
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def spilled_charge_uAs(self):
+        return float(np.sum(self.summaries["charge_uAs"]))
+
+    # Mean current over the whole session, spilled part included
+    def mean_uA(self):
+        if self.count == 0:
+            return float("nan")
+        return (float(np.sum(self.summaries["sum_uA"])) + float(np.sum(self.currents_uA, dtype=np.float64))) / self.count
+
+    def min_uA(self):
+        values = np.append(self.summaries["min_uA"], self.currents_uA)
+        return float(np.min(values)) if len(values) else float("nan")
+
+    def max_uA(self):
+        values = np.append(self.summaries["max_uA"], self.currents_uA)
+        return float(np.max(values)) if len(values) else float("nan")
+
+class SAMPLE_BUFFER:
+    def __init__(self, initial_capacity: int = 65536, time_dtype=np.float64, current_dtype=np.float64,
+                 memory_budget_bytes: int = None, spill_directory: str = None, ticks_per_us: float = 4.0,
+                 spill_prefix: str = "metashunt_spill"):
+        self.initial_capacity = max(int(initial_capacity), 1)
+        self.time_dtype = time_dtype
+        self.current_dtype = current_dtype
+        self.spill_directory = spill_directory
+        self.spill_prefix = spill_prefix
+        self.ticks_per_us = ticks_per_us
+        self.spill_writer = None
+        self.spill_finished = False
+        self.generation = 0
+        self._publish_lock = threading.Lock()
+        self.set_memory_budget(memory_budget_bytes)
+        self._state = self._empty_state()
+
+    def _empty_state(self):
+        return (self.generation, 0,
+                np.empty(self.initial_capacity, dtype=self.time_dtype),
+                np.empty(self.initial_capacity, dtype=self.current_dtype),
+                (0, 0, np.empty(64, dtype=spill_summary_dtype), None))
+
+    def __len__(self):
+        return self._state[1] + self._state[4][0]
+
+    # Budget for resident samples, None keeps everything in RAM. Takes effect on the next growth
+    def set_memory_budget(self, memory_budget_bytes):
+        if memory_budget_bytes is None:
+            self.budget_samples = None
+            return
+        sample_bytes = np.dtype(self.time_dtype).itemsize + np.dtype(self.current_dtype).itemsize
+        self.budget_samples = max(int(memory_budget_bytes) // sample_bytes, 4 * SPILL_SUMMARY_SAMPLES)
+
+    def _grow(self, times, currents, count, needed):
+        capacity = len(times)
+        while capacity < needed:
+            capacity *= 2
+        new_times = np.empty(capacity, dtype=self.time_dtype)
+        new_currents = np.empty(capacity, dtype=self.current_dtype)
+        new_times[:count] = times[:count]
+        new_currents[:count] = currents[:count]
+        return new_times, new_currents
+
+    def _spill_path(self):
+        directory = self.spill_directory if self.spill_directory is not None else os.getcwd()
+        name = "{0}_{1}_{2}.mscap".format(self.spill_prefix, time.strftime("%Y%m%d_%H%M%S"), self.generation)
+        return os.path.join(directory, name)
+
+    # Moves the oldest whole summary groups out of RAM, keeping about half the budget resident
+    def _spill(self, generation, times, currents, count, spill):
+        spilled_count, summary_count, summaries, spill_path = spill
+        spill_n = (max(count - self.budget_samples // 2, 0) // SPILL_SUMMARY_SAMPLES) * SPILL_SUMMARY_SAMPLES
+        if spill_n == 0 or spill_n >= count:
+            return times, currents, count, spill
+
+        with self._publish_lock:
+            # After a reset or finish_spill the samples are discarded or stay resident instead
+            if generation != self.generation or self.spill_finished:
+                return times, currents, count, spill
+            if self.spill_writer is None:
+                self.spill_writer = SPILL_WRITER(self._spill_path(), self.ticks_per_us)
+            spill_path = self.spill_writer.path
+            # The old arrays are never written again, so the spill thread can read them without a copy
+            self.spill_writer.write(times[:spill_n], currents[:spill_n])
+
+        new_summaries = summarize_spill(times[:spill_n], currents[:spill_n], times[spill_n])
+        if summary_count + len(new_summaries) > len(summaries):
+            capacity = len(summaries)
+            while capacity < summary_count + len(new_summaries):
+                capacity *= 2
+            grown = np.empty(capacity, dtype=spill_summary_dtype)
+            grown[:summary_count] = summaries[:summary_count]
+            summaries = grown
+        summaries[summary_count:summary_count + len(new_summaries)] = new_summaries
+
+        resident = count - spill_n
+        new_times = np.empty(max(self.budget_samples, resident), dtype=self.time_dtype)
+        new_currents = np.empty(len(new_times), dtype=self.current_dtype)
+        new_times[:resident] = times[spill_n:count]
+        new_currents[:resident] = currents[spill_n:count]
+        spill = (spilled_count + spill_n, summary_count + len(new_summaries), summaries, spill_path)
+        return new_times, new_currents, resident, spill
+
+    def _make_room(self, generation, times, currents, count, spill, n):
+        if self.budget_samples is not None and count + n > self.budget_samples:
+            times, currents, count, spill = self._spill(generation, times, currents, count, spill)
+        if count + n > len(times):
+            times, currents = self._grow(times, currents, count, count + n)
+        return times, currents, count, spill
+
+    # Swaps in the writer's new state unless a reset has started a new generation meanwhile
+    def _publish(self, state):
+        with self._publish_lock:
+            if state[0] == self.generation:
+                self._state = state
+
+    # Writer side, only ever called from one thread
+    def append(self, t_us, i_uA):
+        generation, count, times, currents, spill = self._state
+        if count == len(times):
+            times, currents, count, spill = self._make_room(generation, times, currents, count, spill, 1)
+        times[count] = t_us
+        currents[count] = i_uA
+        self._publish((generation, count + 1, times, currents, spill))
+
+    def extend(self, t_us, i_uA):
+        t_us = np.asarray(t_us)
+        i_uA = np.asarray(i_uA)
+        n = len(t_us)
+        if n == 0:
+            return
+        generation, count, times, currents, spill = self._state
+        if count + n > len(times):
+            times, currents, count, spill = self._make_room(generation, times, currents, count, spill, n)
+        times[count:count + n] = t_us
+        currents[count:count + n] = i_uA
+        self._publish((generation, count + n, times, currents, spill))
+
+    @staticmethod
+    def _close_spill(writer):
+        writer.close()
+        if writer.error is not None:
+            print(f"Failed to spill samples to '{writer.path}': {writer.error}")
+
+    # Flushes the spill capture so it can be read back, returns its path or None if nothing spilled.
+    # Nothing more is spilled until the next reset, later samples stay resident
+    def finish_spill(self):
+        with self._publish_lock:
+            writer = self.spill_writer
+            self.spill_writer = None
+            self.spill_finished = True
+        if writer is None:
+            return None
+        self._close_spill(writer)
+        return writer.path
+
+    # Safe from any thread. Samples the writer is adding at the same moment are dropped,
+    # and the session's spill capture is deleted
+    def reset(self):
+        # Fresh arrays, so snapshots taken before the reset remain valid
+        with self._publish_lock:
+            spill_path = self._state[4][3]
+            writer = self.spill_writer
+            self.spill_writer = None
+            self.spill_finished = False
+            self.generation += 1
+            self._state = self._empty_state()
+        if writer is not None:
+            self._close_spill(writer)
+            spill_path = writer.path
+        if spill_path is not None and os.path.exists(spill_path):
+            try:
+                os.remove(spill_path)
+            except OSError as e:
+                print(f"Could not delete spill capture '{spill_path}': {e}")
+
+    # Reader side, safe from any thread without a lock
+    def snapshot(self, max_samples: int = None):
+        generation, count, times, currents, spill = self._state
+        spilled_count, summary_count, summaries, spill_path = spill
+        if max_samples is not None:
+            count = min(count, max_samples)
+        times_view = times[:count]
+        currents_view = currents[:count]
+        summaries_view = summaries[:summary_count]
+        times_view.flags.writeable = False
+        currents_view.flags.writeable = False
+        summaries_view.flags.writeable = False
+        return SAMPLE_SNAPSHOT(generation, spilled_count + count, times_view, currents_view,
+                               spilled_count, summaries_view, spill_path)
@@ -1,18 +1,33 @@
-from PIL import Image
 import dearpygui.dearpygui as dpg
 import threading
+import os
 import serial
 import serial.tools.list_ports
 import struct
 import array
 import time
 import io
+import sys
 import numpy as np
-from scipy.signal import correlate, correlation_lags
 
-# Measurement buffer
-measured_times_raw = []
-measured_currents_uA = []
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Comparison Tools"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Realtime Interface"))
+
+from metashunt_sample_buffer import SAMPLE_BUFFER
+from metashunt_export import EXPORT_JOB
+from metashunt_import import IMPORT_JOB, decimate_for_plot
+from metashunt_psd import STREAMING_PSD
+from metashunt_histogram import CURRENT_HISTOGRAM
+from metashunt_filters import MOVING_AVERAGE, MEDIAN_FILTER, IIR_LOWPASS
+from metashunt_playback import PLAYBACK_SOURCE, PLAYBACK_SPEEDS
+from metashunt_v2_latency import LATENCY_TRACKER
+
+# Measurement buffer, written only by serial_worker and read lock-free through snapshots.
+# In continuous mode samples beyond the memory budget are spilled to a capture in the working directory,
+# which is deleted when the session is cleared, a new one starts or the application closes
+DEFAULT_MEMORY_BUDGET_MB = 512
+measurement_buffer = SAMPLE_BUFFER()
+measurement_thread = None
 
 # Imported data
 imported_times_sec = []
@@ -21,17 +36,44 @@ time_offset = 0.0  # For aligning imported data
 charge_offset_uAh = 0.0
 imported_charge_offset_uAh = 0.0
 
+# Background export and import in progress, if any
+export_job = None
+import_job = None
+
+# Live noise spectrum, fed only the samples added since the last frame
+PSD_DEFAULT_FS_HZ = 10000.0
+PSD_NPERSEG = 4096
+psd_estimator = STREAMING_PSD(PSD_DEFAULT_FS_HZ, PSD_NPERSEG)
+psd_samples_processed = 0
+psd_generation = None
+
+# Live time weighted current histogram, fed like the spectrum
+current_histogram = CURRENT_HISTOGRAM()
+histogram_samples_processed = 0
+histogram_generation = None
+
+# Filtered display channel, fed the same way as the spectrum and kept in its own buffer
+DISPLAY_FILTERS = ["None", "Moving Average", "Median", "Low-pass IIR"]
+filtered_buffer = SAMPLE_BUFFER(spill_prefix="metashunt_filtered_spill")
+display_filter = None
+filter_samples_processed = 0
+filter_generation = None
+
+# Sample to decode and sample to display latency. Packets are stamped on receipt and handed over in batches
+LATENCY_BATCH_PACKETS = 256
+latency_tracker = LATENCY_TRACKER()
+latency_samples_processed = 0
+latency_generation = None
+
 # Plot handles
 current_plot_series = "current_series"
 charge_plot_series = "charge_series"
 
-# Protect data
-data_lock = threading.Lock()
-
 # Serial
 ser = None
 running = False
 is_burst = False
+is_playback = False
 burst_rate_hz = 50000
 trigger_type = 0
 trigger_level = 1000
@@ -40,13 +82,29 @@ trigger_level = 1000
 LOGO_DISPLAY_WIDTH = 300
 LOGO_DISPLAY_HEIGHT = 69
 
-# Load and resize image using Pillow
-image = Image.open("metashuntLogo.png").convert("RGBA")
-image = image.resize((LOGO_DISPLAY_WIDTH, LOGO_DISPLAY_HEIGHT), Image.Resampling.LANCZOS)
+LOGO_FILE = "metashuntLogo.png"
+LOGO_CACHE_FILE = "metashuntLogo_{0}x{1}.npy".format(LOGO_DISPLAY_WIDTH, LOGO_DISPLAY_HEIGHT)
+
+def load_logo_texture():
+    # The resized logo is cached as a flat 0.0–1.0 float32 RGBA array, so normal startup
+    # skips Pillow and the resampling entirely
+    if os.path.exists(LOGO_CACHE_FILE) and os.path.getmtime(LOGO_CACHE_FILE) >= os.path.getmtime(LOGO_FILE):
+        try:
+            return np.load(LOGO_CACHE_FILE)
+        except (OSError, ValueError):
+            pass
+
+    from PIL import Image
+    image = Image.open(LOGO_FILE).convert("RGBA")
+    image = image.resize((LOGO_DISPLAY_WIDTH, LOGO_DISPLAY_HEIGHT), Image.Resampling.LANCZOS)
+    flat_pixels = (np.asarray(image, dtype=np.float32) / 255.0).reshape(-1)
+    try:
+        np.save(LOGO_CACHE_FILE, flat_pixels)
+    except OSError:
+        print("Could not cache logo texture")
+    return flat_pixels
 
-# Flatten image data and normalize to 0.0–1.0 for DPG
-pixels = list(image.getdata())
-flat_pixels = [c / 255.0 for pixel in pixels for c in pixel]
+flat_pixels = load_logo_texture()
 
 def find_metashunt_port():
     for comport in serial.tools.list_ports.comports():
@@ -83,7 +141,7 @@ def get_packet(ser, timeout=0.1):
     return None
 
 def serial_worker():
-    global running, ser, measured_times_raw, measured_currents_uA, is_burst, burst_rate_hz, trigger_type, trigger_level
+    global running, ser, is_burst, burst_rate_hz, trigger_type, trigger_level
     port = find_metashunt_port()
     if not port:
         print("MetaShunt not found.")
@@ -97,6 +155,7 @@ def serial_worker():
     ser = serial.Serial(port, timeout=0.1)
     print("Connected to MetaShunt V2 on", port)
     start = time.time()
+    received_device_s, received_host_s = [], []
 
     # If in burst, send the burst command
     if is_burst:
@@ -106,6 +165,7 @@ def serial_worker():
     while running:
         packet = get_packet(ser, timeout=0.5)
         if packet:
+            host_s = time.perf_counter()
             line_spec = "<If"
             info = struct.unpack(line_spec, array.array('B', packet).tobytes())
             t_us = info[0] / 4.0
@@ -115,9 +175,12 @@ def serial_worker():
                 t_offset_us = t_us
             t_us = t_us - t_offset_us
 
-            with data_lock:
-                measured_times_raw.append(t_us)
-                measured_currents_uA.append(i_ma * 1000.0)
+            measurement_buffer.append(t_us, i_ma * 1000.0)
+            received_device_s.append(t_us / 1e6)
+            received_host_s.append(host_s)
+            if len(received_device_s) >= LATENCY_BATCH_PACKETS:
+                latency_tracker.chunk_received(received_device_s, received_host_s)
+                received_device_s, received_host_s = [], []
 
             packet_count = packet_count + 1
             if is_burst:
@@ -126,6 +189,21 @@ def serial_worker():
         else:
             print("No packet received in time at {}".format(time.time()))
 
+# Replays a recorded capture into the measurement buffer in place of the serial port
+def playback_worker(path, speed):
+    source = PLAYBACK_SOURCE(path, speed)
+    print("Playing back '{0}' at {1}".format(path, "maximum speed" if speed is None else f"{speed:g}x"))
+    try:
+        def sink(times_us, currents_uA):
+            measurement_buffer.extend(times_us, currents_uA)
+            latency_tracker.chunk_received(np.asarray(times_us) / 1e6, time.perf_counter())
+        source.run(sink, lambda: running)
+    except Exception as e:
+        print(f"Playback failed: {e}")
+    print(f"Played {source.samples_played} samples in {source.elapsed_s:.2f} s ({source.samples_per_second:.0f} samples/s)")
+    if running:
+        stop_measurement()
+
 # Function to handle burst reading
 def start_burst_reading():
     global ser, burst_rate_hz, trigger_level, trigger_type
@@ -143,14 +221,128 @@ def start_burst_reading():
     time.sleep(0.1)
     ser.reset_input_buffer()
 
+def update_psd(snapshot):
+    global psd_samples_processed, psd_generation
+    if snapshot.generation != psd_generation or snapshot.count < psd_samples_processed:
+        psd_estimator.reset()
+        psd_samples_processed = 0
+        psd_generation = snapshot.generation
+
+    if snapshot.count > psd_samples_processed:
+        # Samples already spilled to disk before the spectrum saw them are skipped
+        start = max(psd_samples_processed - snapshot.spilled_count, 0)
+        psd_estimator.update(snapshot.times_us[start:] / 1e6, snapshot.currents_uA[start:])
+        psd_samples_processed = snapshot.count
+
+    if psd_estimator.segment_count > 0:
+        dpg.set_value("psd_series", [psd_estimator.frequencies_hz[1:].tolist(), psd_estimator.psd[1:].tolist()])
+        dpg.set_item_label("psd_series", f"Current PSD (RMS: {psd_estimator.band_rms(psd_estimator.frequencies_hz[1]):.3g} uA)")
+    else:
+        dpg.set_value("psd_series", [[], []])
+
+def update_histogram(snapshot):
+    global histogram_samples_processed, histogram_generation
+    if snapshot.generation != histogram_generation or snapshot.count < histogram_samples_processed:
+        current_histogram.reset()
+        histogram_samples_processed = 0
+        histogram_generation = snapshot.generation
+
+    if snapshot.count > histogram_samples_processed:
+        start = max(histogram_samples_processed - snapshot.spilled_count, 0)
+        current_histogram.update(snapshot.times_us[start:] / 1e6, snapshot.currents_uA[start:])
+        histogram_samples_processed = snapshot.count
+
+    if current_histogram.total_time_s > 0:
+        edges_ua, ccdf = current_histogram.ccdf()
+        shown = ccdf > 0  # Log axis
+        dpg.set_value("ccdf_series", [edges_ua[shown].tolist(), ccdf[shown].tolist()])
+        lower_ua, time_fraction, charge_fraction = current_histogram.decade_residency()
+        dpg.set_value("residency_series", [np.log10(lower_ua).tolist(), (100.0 * time_fraction).tolist()])
+    else:
+        dpg.set_value("ccdf_series", [[], []])
+        dpg.set_value("residency_series", [[], []])
+
+# Display latency of the samples new to this frame, measured once they have been handed to the plots
+def update_latency(snapshot):
+    global latency_samples_processed, latency_generation
+    if snapshot.generation != latency_generation or snapshot.count < latency_samples_processed:
+        latency_samples_processed = snapshot.count  # Only samples that arrive from now on
+        latency_generation = snapshot.generation
+
+    if snapshot.count > latency_samples_processed:
+        start = max(latency_samples_processed - snapshot.spilled_count, 0)
+        latency_tracker.displayed(snapshot.times_us[start:] / 1e6, time.perf_counter())
+        latency_samples_processed = snapshot.count
+
+    dpg.set_value("decode_latency_text", "Sample to decode: " + latency_tracker.decode.summary())
+    dpg.set_value("display_latency_text", "Sample to display: " + latency_tracker.display.summary())
+    for histogram, series in ((latency_tracker.decode, "decode_latency_series"), (latency_tracker.display, "display_latency_series")):
+        shown = histogram.counts[1:-1] > 0  # Log axis
+        dpg.set_value(series, [histogram.edges_ms[1:][shown].tolist(), histogram.counts[1:-1][shown].tolist()])
+
+def psd_rate_changed_callback(sender, app_data, user_data):
+    global psd_estimator, psd_generation
+    if app_data > 0:
+        psd_estimator = STREAMING_PSD(app_data, PSD_NPERSEG)
+        psd_generation = None  # Reprocess everything at the new rate
+
+def make_display_filter(snapshot):
+    filter_type = dpg.get_value("display_filter_picker")
+    width = max(dpg.get_value("display_filter_width"), 1)
+    if filter_type == "Moving Average":
+        return MOVING_AVERAGE(width)
+    if filter_type == "Median":
+        return MEDIAN_FILTER(width)
+    if filter_type == "Low-pass IIR" and len(snapshot.times_us) > 1:
+        fs = 1e6 / np.median(np.diff(snapshot.times_us[-10000:]))
+        cutoff_hz = dpg.get_value("display_filter_cutoff")
+        if 0 < cutoff_hz < fs / 2:
+            return IIR_LOWPASS(cutoff_hz, fs)
+    return None
+
+def update_filtered(snapshot):
+    global display_filter, filter_samples_processed, filter_generation
+    if dpg.get_value("display_filter_picker") == "None":
+        dpg.set_value("filtered_series", [[], []])
+        return
+
+    if snapshot.generation != filter_generation or display_filter is None:
+        display_filter = make_display_filter(snapshot)
+        filtered_buffer.reset()
+        # Samples already spilled are not refiltered
+        filter_samples_processed = snapshot.spilled_count
+        filter_generation = snapshot.generation
+        if display_filter is None:
+            return
+
+    if snapshot.count > filter_samples_processed:
+        start = max(filter_samples_processed - snapshot.spilled_count, 0)
+        filtered_buffer.extend(*display_filter.process(snapshot.times_us[start:], snapshot.currents_uA[start:]))
+        filter_samples_processed = snapshot.count
+
+    plot_times_s, plot_current = decimate_for_plot(*session_plot_arrays(filtered_buffer.snapshot()))
+    dpg.set_value("filtered_series", [plot_times_s.tolist(), plot_current.tolist()])
+
+def display_filter_changed_callback(sender, app_data, user_data):
+    global display_filter
+    display_filter = None  # Rebuilt and rerun over the resident samples on the next frame
+
+# Whole session for plotting, spilled samples drawn from their summaries with one point per group
+def session_plot_arrays(snapshot):
+    summaries = snapshot.summaries
+    spilled_times_s = (summaries["start_us"] + summaries["end_us"]) / 2e6
+    spilled_current = summaries["sum_uA"] / summaries["samples"]
+    return np.concatenate((spilled_times_s, snapshot.times_us / 1e6)), np.concatenate((spilled_current, snapshot.currents_uA))
+
 def update_plots():
     global charge_offset_uAh, imported_charge_offset_uAh
 
-    times_np = []
-    current_np = []
-    with data_lock:
-        times_np = np.array(measured_times_raw)
-        current_np = np.array(measured_currents_uA)
+    snapshot = measurement_buffer.snapshot()
+    times_np = snapshot.times_us
+    current_np = snapshot.currents_uA
+    update_psd(snapshot)
+    update_histogram(snapshot)
+    update_filtered(snapshot)
 
     if len(times_np) < 2:
         dpg.set_value(current_plot_series, [[], []])
@@ -164,10 +356,17 @@ def update_plots():
             print(f"[WARN] Mismatched lengths: current={len(current_np)}, dt={len(dt)}")
         else:
             charge_uah = (np.cumsum(current_np * dt) / 3600.0)
-            charge_uah += charge_offset_uAh
+            charge_uah += charge_offset_uAh + snapshot.spilled_charge_uAs / 3600.0
+
+            spilled_charge_uah = np.cumsum(snapshot.summaries["charge_uAs"]) / 3600.0 + charge_offset_uAh
 
-            dpg.set_value(current_plot_series, [times_s.tolist(), current_np.tolist()])
-            dpg.set_value(charge_plot_series, [times_s.tolist(), charge_uah.tolist()])
+            # Only a few thousand points reach the plot, however long the session
+            plot_times_s, plot_current = session_plot_arrays(snapshot)
+            charge_times_s, plot_charge = decimate_for_plot(plot_times_s, np.concatenate((spilled_charge_uah, charge_uah)))
+            plot_times_s, plot_current = decimate_for_plot(plot_times_s, plot_current)
+            dpg.set_value(current_plot_series, [plot_times_s.tolist(), plot_current.tolist()])
+            dpg.set_value(charge_plot_series, [charge_times_s.tolist(), plot_charge.tolist()])
+    update_latency(snapshot)
 
     # Add imported data if available
     if len(imported_times_sec) > 2:
@@ -183,73 +382,124 @@ def update_plots():
         dpg.set_value(imported_charge_plot_series, [[], []])
 
     if running:
+        dpg.fit_axis_data("psd_x_axis")
+        dpg.fit_axis_data("psd_y_axis")
+        dpg.fit_axis_data("ccdf_x_axis")
+        dpg.fit_axis_data("ccdf_y_axis")
+        dpg.fit_axis_data("residency_x_axis")
+        dpg.fit_axis_data("residency_y_axis")
         dpg.fit_axis_data("current_x_axis")
         dpg.fit_axis_data("current_y_axis")
         dpg.fit_axis_data("charge_x_axis")
         dpg.fit_axis_data("charge_y_axis")
 
 def export_data_callback():
-    if len(measured_times_raw) == 0 or len(measured_currents_uA) == 0:
+    if len(measurement_buffer) == 0:
         print("No data to export.")
         return
 
     dpg.show_item("file_dialog_id")
 
 def export_data_to_file(sender, app_data):
+    global export_job
     if not app_data['file_path_name']:
         print("Export canceled.")
         return
 
+    if export_job is not None and not export_job.done:
+        print("An export is already running.")
+        return
+
     export_path = app_data['file_path_name']
-    
-    with data_lock:
-        times_s = np.array(measured_times_raw) / 1e6  # Convert to seconds
-        current_mA = np.array(measured_currents_uA) / 1000.0  # Convert uA to mA
 
-    try:
-        with open(export_path, "w") as f:
-            f.write("Time (s),Current (mA)\n")
-            for t, i in zip(times_s, current_mA):
-                f.write(f"{t:.6f},{i:.8f}\n")
-        print(f"Data exported to '{export_path}'")
-    except Exception as e:
-        print(f"Failed to export data: {e}")
+    # The snapshot is a read-only view, so the worker can format it while measurement continues
+    snapshot = measurement_buffer.snapshot()
+    if snapshot.spilled_count > 0 and running:
+        print("Part of this session is spilled to disk. Stop the measurement before exporting.")
+        return
+    export_job = EXPORT_JOB(export_path, snapshot.times_us, snapshot.currents_uA,
+                            spill_path=snapshot.spill_path if snapshot.spilled_count > 0 else None).start()
+    dpg.set_value("export_progress", 0.0)
+    dpg.configure_item("export_progress", overlay="Exporting")
+    dpg.show_item("export_progress_group")
+
+def cancel_export_callback():
+    if export_job is not None and not export_job.done:
+        export_job.cancel()
+
+def update_export_progress():
+    global export_job
+    if export_job is None:
+        return
+
+    dpg.set_value("export_progress", export_job.progress)
+    dpg.configure_item("export_progress", overlay=f"Exporting {100.0 * export_job.progress:.0f}%")
+    if export_job.done:
+        if export_job.error is not None:
+            print(f"Failed to export data: {export_job.error}")
+        elif export_job.cancelled:
+            print("Export canceled.")
+        else:
+            print(f"Data exported to '{export_job.path}'")
+        dpg.hide_item("export_progress_group")
+        export_job = None
 
 
 def import_data_from_file(app_data):
-    global imported_times_sec, imported_currents_uA
+    global import_job
 
     path = app_data['file_path_name']
     if not path:
         print("Import canceled.")
         return
 
-    try:
-        times_list = []
-        currents_list = []
-        with open(path, "r") as f:
-            lines = f.readlines()
-            for line in lines[1:]:  # Skip header
-                t_str, i_str = line.strip().split(',')
-                times_list.append(float(t_str))
-                currents_list.append(float(i_str) * 1000.0)  # mA to uA
-        imported_times_sec = np.array(times_list)
-        imported_currents_uA = np.array(currents_list)
-        avg_imported_current = np.mean(imported_currents_uA)
+    if import_job is not None and not import_job.done:
+        print("An import is already running.")
+        return
 
-        if len(imported_currents_uA) > 2:
-            dpg.set_value("imported_current_series", [imported_times_sec, imported_currents_uA])
-            dpg.set_item_label("imported_current_series", f"Imported Current (avg: {avg_imported_current:.2f} uA)")
-            dpg.show_item("imported_current_series")
-            dpg.show_item("imported_charge_series")
+    # Parsed in a worker, update_import_progress draws a preview until it finishes
+    import_job = IMPORT_JOB(path).start()
+    dpg.set_value("import_progress", 0.0)
+    dpg.configure_item("import_progress", overlay="Importing")
+    dpg.show_item("import_progress_group")
+    dpg.show_item("imported_current_series")
+    dpg.show_item("imported_charge_series")
+
+def cancel_import_callback():
+    if import_job is not None and not import_job.done:
+        import_job.cancel()
+
+def update_import_progress():
+    global import_job, imported_times_sec, imported_currents_uA
+    if import_job is None:
+        return
 
-        print(f"Imported {len(imported_times_sec)} points from '{path}'")
-        update_plots()
+    dpg.set_value("import_progress", import_job.progress)
+    dpg.configure_item("import_progress", overlay=f"Importing {100.0 * import_job.progress:.0f}%")
+    if not import_job.done:
+        preview_times, preview_currents = import_job.arrays()
+        preview_times, preview_currents = decimate_for_plot(preview_times + time_offset, preview_currents)
+        dpg.set_value("imported_current_series", [preview_times.tolist(), preview_currents.tolist()])
+        return
 
-    except Exception as e:
-        print(f"Failed to import data: {e}")
+    dpg.hide_item("import_progress_group")
+    if import_job.error is not None:
+        print(f"Failed to import data: {import_job.error}")
+    elif import_job.cancelled:
+        print("Import canceled.")
+    else:
+        imported_times_sec, imported_currents_uA = import_job.arrays()
+        if len(imported_currents_uA) > 2:
+            avg_imported_current = np.mean(imported_currents_uA)
+            dpg.set_item_label("imported_current_series", f"Imported Current (avg: {avg_imported_current:.2f} uA)")
+        print(f"Imported {len(imported_times_sec)} points from '{import_job.path}'")
+    import_job = None
+    update_plots()
 
 def estimate_time_offset(measured_time, measured_current, imported_time, imported_current):
+    # scipy is slow to import and only needed here
+    from scipy.signal import correlate, correlation_lags
+
     # Create a common time base where both signals have valid data
     start = max(min(measured_time), min(imported_time))
     end = min(max(measured_time), max(imported_time))
@@ -287,16 +537,14 @@ def update_time_offset(val):
     update_plots()
 
 def align_charge_plot_callback():
-    global time_offset, measured_times_raw, measured_currents_uA, imported_times_sec, imported_currents_uA, charge_offset_uAh, imported_charge_offset_uAh
-    if len(measured_times_raw) < 2 or len(imported_times_sec) < 2 or time_offset == 0.0:
+    global time_offset, imported_times_sec, imported_currents_uA, charge_offset_uAh, imported_charge_offset_uAh
+    snapshot = measurement_buffer.snapshot()
+    if len(snapshot) < 2 or len(imported_times_sec) < 2 or time_offset == 0.0:
         # Do nothing, nothing to align
         return
     
-    times_np = []
-    current_np = []
-    with data_lock:
-        times_np = np.array(measured_times_raw)
-        current_np = np.array(measured_currents_uA)
+    times_np = snapshot.times_us
+    current_np = snapshot.currents_uA
     times_s = times_np / 1e6  # Convert to seconds
 
     # Assume we have manually aligned these. The charge level of imported data then will be at zero somewhere
@@ -310,7 +558,7 @@ def align_charge_plot_callback():
         dt = np.diff(times_s)
         dt = np.append(dt, dt[-1])  # For matching shape 
         charge_uah = (np.cumsum(current_np * dt) / 3600.0)
-        charge_uah += charge_offset_uAh
+        charge_uah += charge_offset_uAh + snapshot.spilled_charge_uAs / 3600.0
         
         charge_offset_uAh = -charge_uah[idx]
     else:
@@ -328,13 +576,11 @@ def align_charge_plot_callback():
     update_plots()
 
 def auto_align_callback():
-    global imported_times_sec, imported_currents_uA, measured_times_raw, measured_currents_uA, time_offset
+    global imported_times_sec, imported_currents_uA, time_offset
 
-    times_np = []
-    current_np = []
-    with data_lock:
-        times_np = np.array(measured_times_raw)
-        current_np = np.array(measured_currents_uA)
+    snapshot = measurement_buffer.snapshot()
+    times_np = snapshot.times_us
+    current_np = snapshot.currents_uA
     
     times_s = times_np / 1e6
 
@@ -343,16 +589,30 @@ def auto_align_callback():
         update_plots()
 
 def mode_changed_callback(sender, app_data, user_data):
-    global is_burst
+    global is_burst, is_playback
     is_burst = (app_data == "Burst")
+    is_playback = (app_data == "Playback")
     dpg.configure_item("burst_config", show=(app_data == "Burst"))
-    dpg.configure_item("cont_config", show=(app_data == "Continuous"))
+    dpg.configure_item("cont_config", show=(app_data != "Burst"))
+    dpg.configure_item("playback_config", show=(app_data == "Playback"))
 
 def burst_trigger_changed_callback(sender, app_data, user_data):
     dpg.configure_item("current_trigger_level_config", show=(app_data == "Rise Trigger" or app_data == "Fall Trigger"))
 
+# Waits for the serial or playback worker to exit once running is cleared, so the buffer has no
+# writer left when it is finished or reset. The worker may stop the measurement itself
+def join_measurement_worker():
+    if measurement_thread is not None and measurement_thread is not threading.current_thread():
+        measurement_thread.join()
+
 def start_measurement():
-    global running, measured_times_raw, measured_currents_uA, is_burst, burst_rate_hz, trigger_type, trigger_level
+    global running, is_burst, burst_rate_hz, trigger_type, trigger_level, measurement_thread
+    if measurement_thread is not None and measurement_thread.is_alive():
+        print("A measurement is already running.")
+        return
+    if export_job is not None and not export_job.done:
+        print("Wait for the export to finish before starting a new measurement.")
+        return
     running = True
 
     # Reset label
@@ -384,28 +644,41 @@ def start_measurement():
             trigger_type = 4
             # Trigger level doesn't matter
 
-    with data_lock:
-        measured_times_raw = []
-        measured_currents_uA = []
-    threading.Thread(target=serial_worker, daemon=True).start()
+    memory_budget_mb = dpg.get_value("memory_budget_picker")
+    measurement_buffer.reset()
+    latency_tracker.reset()
+    measurement_buffer.set_memory_budget(memory_budget_mb * 1e6 if memory_budget_mb > 0 and not is_burst else None)
+    filtered_buffer.set_memory_budget(memory_budget_mb * 1e6 if memory_budget_mb > 0 and not is_burst else None)
+    if is_playback:
+        playback_args = (dpg.get_value("playback_path_input"), PLAYBACK_SPEEDS[dpg.get_value("playback_speed_picker")])
+        measurement_thread = threading.Thread(target=playback_worker, args=playback_args, daemon=True)
+    else:
+        measurement_thread = threading.Thread(target=serial_worker, daemon=True)
+    measurement_thread.start()
 
 def stop_measurement():
     global running
     running = False
+    join_measurement_worker()
     if ser:
         ser.close()
 
-    # Compute and display stats
-    with data_lock:
-        current_np = np.array(measured_currents_uA)
-        avg_current = np.mean(current_np)
-        dpg.set_item_label("current_series", f"Current (avg: {avg_current:.2f} uA)")
+    spill_path = measurement_buffer.finish_spill()
+    if spill_path:
+        print(f"Older samples of this session were spilled to '{spill_path}'. Export to keep them, the file is deleted when the session is cleared, a new one starts or the application closes")
+    filtered_buffer.finish_spill()
+
+    # Compute and display stats over the whole session, spilled part included
+    avg_current = measurement_buffer.snapshot().mean_uA()
+    dpg.set_item_label("current_series", f"Current (avg: {avg_current:.2f} uA)")
 
 def clear_measurement():
-    global measured_times_raw, measured_currents_uA, imported_times_sec, imported_currents_uA
-    with data_lock:
-        measured_times_raw = []
-        measured_currents_uA = []
+    global imported_times_sec, imported_currents_uA
+    if export_job is not None and not export_job.done:
+        print("Wait for the export to finish before clearing.")
+        return
+    # Reset is safe while measuring, the worker's samples from before it are dropped
+    measurement_buffer.reset()
     imported_times_sec = []
     imported_currents_uA = []
     update_plots()
@@ -415,10 +688,18 @@ dpg.create_context()
 
 with dpg.window(label="MetaShunt Interface", width=1000, height=800, tag="main_window"):
     dpg.add_text("Mode Selection")
-    dpg.add_combo(["Continuous", "Burst"], default_value="Continuous", callback=mode_changed_callback, width=400)
+    dpg.add_combo(["Continuous", "Burst", "Playback"], default_value="Continuous", callback=mode_changed_callback, width=400)
 
     with dpg.group(tag="cont_config", width=400):
         dpg.add_text("Start and Stop Measurements as Needed")
+        dpg.add_input_int(label="Memory Budget (MB, 0 = unlimited)", default_value=DEFAULT_MEMORY_BUDGET_MB,
+                          min_value=0, min_clamped=True, tag="memory_budget_picker")
+
+    with dpg.group(tag="playback_config", width=400, show=False):
+        with dpg.group(horizontal=True):
+            dpg.add_input_text(label="Recording", tag="playback_path_input", width=300)
+            dpg.add_button(label="Browse", callback=lambda: dpg.show_item("file_dialog_playback"))
+        dpg.add_combo(list(PLAYBACK_SPEEDS.keys()), default_value="Real-time", label="Playback Speed", tag="playback_speed_picker")
 
     with dpg.group(tag="burst_config", width=400, show=False):
         dpg.add_combo(["Rate Only", "Rise Trigger", "Fall Trigger","Button Trigger"], 
@@ -436,6 +717,14 @@ with dpg.window(label="MetaShunt Interface", width=1000, height=800, tag="main_w
         dpg.add_button(label="Export Data", callback=export_data_callback)
         dpg.add_button(label="Import Data", callback=lambda: dpg.show_item("file_dialog_import"))
 
+    with dpg.group(horizontal=True, tag="export_progress_group", show=False):
+        dpg.add_progress_bar(default_value=0.0, tag="export_progress", width=300)
+        dpg.add_button(label="Cancel Export", callback=cancel_export_callback)
+
+    with dpg.group(horizontal=True, tag="import_progress_group", show=False):
+        dpg.add_progress_bar(default_value=0.0, tag="import_progress", width=300)
+        dpg.add_button(label="Cancel Import", callback=cancel_import_callback)
+
     # File dialog widget
     with dpg.file_dialog(
         directory_selector=False,
@@ -447,6 +736,8 @@ with dpg.window(label="MetaShunt Interface", width=1000, height=800, tag="main_w
         modal=True
     ):
         dpg.add_file_extension(".csv", color=(150, 255, 150, 255))
+        dpg.add_file_extension(".npz", color=(150, 200, 255, 255))
+        dpg.add_file_extension(".mscap", color=(255, 200, 150, 255))
         dpg.add_file_extension("", color=(255, 255, 255, 255))  # Show all files
 
     # File dialog for importing data
@@ -463,6 +754,21 @@ with dpg.window(label="MetaShunt Interface", width=1000, height=800, tag="main_w
         dpg.add_file_extension("", color=(255, 255, 255, 255))
 
 
+    # File dialog for choosing a recording to play back
+    with dpg.file_dialog(
+        directory_selector=False,
+        show=False,
+        callback=lambda s, a: dpg.set_value("playback_path_input", a['file_path_name']),
+        id="file_dialog_playback",
+        width=700,
+        height=400,
+        modal=True
+    ):
+        dpg.add_file_extension(".mscap", color=(255, 200, 150, 255))
+        dpg.add_file_extension(".npz", color=(150, 200, 255, 255))
+        dpg.add_file_extension(".csv", color=(150, 255, 150, 255))
+        dpg.add_file_extension("", color=(255, 255, 255, 255))
+
     # Create texture
     with dpg.texture_registry(show=False):
         dpg.add_static_texture(LOGO_DISPLAY_WIDTH, LOGO_DISPLAY_HEIGHT, flat_pixels, tag="logo_tex")
@@ -479,6 +785,15 @@ with dpg.window(label="MetaShunt Interface", width=1000, height=800, tag="main_w
         with dpg.plot_axis(dpg.mvYAxis, label="Current (uA)", tag="current_y_axis"):
             current_plot_series = dpg.add_line_series([], [], label="Current", tag="current_series")
             imported_current_plot_series = dpg.add_line_series([], [], label="Imported Current", tag="imported_current_series")
+            dpg.add_line_series([], [], label="Filtered Current", tag="filtered_series")
+
+    with dpg.group(horizontal=True):
+        dpg.add_combo(DISPLAY_FILTERS, default_value="None", label="Display Filter", tag="display_filter_picker",
+                      callback=display_filter_changed_callback, width=150)
+        dpg.add_input_int(label="Width (samples)", default_value=32, tag="display_filter_width",
+                          callback=display_filter_changed_callback, width=120)
+        dpg.add_input_float(label="Cutoff (Hz)", default_value=1000.0, tag="display_filter_cutoff",
+                            callback=display_filter_changed_callback, width=120)
 
     with dpg.plot(label="Accumulated Charge vs Time", height=225, width=-1):
         dpg.add_plot_axis(dpg.mvXAxis, label="Time (s)", tag="charge_x_axis")
@@ -486,6 +801,34 @@ with dpg.window(label="MetaShunt Interface", width=1000, height=800, tag="main_w
             charge_plot_series = dpg.add_line_series([], [], label="Charge", tag="charge_series")
             imported_charge_plot_series = dpg.add_line_series([], [], label="Imported Charge", tag="imported_charge_series")
 
+    with dpg.collapsing_header(label="Noise Spectrum", default_open=False):
+        dpg.add_input_float(label="PSD Resample Rate (Hz)", default_value=PSD_DEFAULT_FS_HZ, callback=psd_rate_changed_callback, width=200)
+        with dpg.plot(label="Current Noise PSD (Welch)", height=225, width=-1):
+            dpg.add_plot_axis(dpg.mvXAxis, label="Frequency (Hz)", log_scale=True, tag="psd_x_axis")
+            dpg.add_plot_legend(location=dpg.mvPlot_Location_NorthEast)
+            with dpg.plot_axis(dpg.mvYAxis, label="PSD (uA^2/Hz)", log_scale=True, tag="psd_y_axis"):
+                dpg.add_line_series([], [], label="Current PSD", tag="psd_series")
+
+    with dpg.collapsing_header(label="Current Residency", default_open=False):
+        with dpg.plot(label="Time at or Above Current (CCDF)", height=225, width=-1):
+            dpg.add_plot_axis(dpg.mvXAxis, label="Current (uA)", log_scale=True, tag="ccdf_x_axis")
+            with dpg.plot_axis(dpg.mvYAxis, label="Fraction of Time", log_scale=True, tag="ccdf_y_axis"):
+                dpg.add_line_series([], [], label="CCDF", tag="ccdf_series")
+        with dpg.plot(label="Time per Current Decade", height=225, width=-1):
+            dpg.add_plot_axis(dpg.mvXAxis, label="Decade (log10 uA)", tag="residency_x_axis")
+            with dpg.plot_axis(dpg.mvYAxis, label="Time (%)", tag="residency_y_axis"):
+                dpg.add_bar_series([], [], label="Residency", tag="residency_series", weight=0.8)
+
+    with dpg.collapsing_header(label="Latency", default_open=False):
+        dpg.add_text("Sample to decode: no samples", tag="decode_latency_text")
+        dpg.add_text("Sample to display: no samples", tag="display_latency_text")
+        with dpg.plot(label="Latency Distribution", height=225, width=-1):
+            dpg.add_plot_axis(dpg.mvXAxis, label="Latency (ms)", log_scale=True, tag="latency_x_axis")
+            dpg.add_plot_legend(location=dpg.mvPlot_Location_NorthEast)
+            with dpg.plot_axis(dpg.mvYAxis, label="Samples", log_scale=True, tag="latency_y_axis"):
+                dpg.add_line_series([], [], label="Decode", tag="decode_latency_series")
+                dpg.add_line_series([], [], label="Display", tag="display_latency_series")
+
     # Zoom and Auto-Fit Controls
     dpg.add_spacer(height=10)
     dpg.add_text("Plot Controls")
@@ -529,6 +872,8 @@ dpg.set_primary_window("main_window", True)
 
 def frame_update():
     update_plots()
+    update_export_progress()
+    update_import_progress()
     dpg.set_frame_callback(dpg.get_frame_count() + 10, frame_update)
 
 dpg.create_viewport(title='MetaShunt Interface', width=1024, height=768)
@@ -536,4 +881,8 @@ dpg.setup_dearpygui()
 dpg.show_viewport()
 frame_update()
 dpg.start_dearpygui()
+running = False
+join_measurement_worker()
+measurement_buffer.reset()
+filtered_buffer.reset()
 dpg.destroy_context()
@@ -4,8 +4,6 @@ import struct
 import array
 import sys 
 import serial.tools.list_ports
-import matplotlib
-import matplotlib.pyplot as plt
 import numpy as np
 
 class MEASUREMENT:
@@ -62,6 +60,16 @@ def display_how_to_use():
 
 if __name__ == "__main__":
 
+    # Help and bad input need no device, so answer them before connecting
+    if len(sys.argv) < 2:
+        print("Incorrect inputs. Please follow the instructions below.")
+        print("..........")
+        display_how_to_use()
+        exit()
+    elif sys.argv[1] == 'h':
+        display_how_to_use()
+        exit()
+
     # Figure out the correct port
     port = ""
     connected = [comport for comport in serial.tools.list_ports.comports()]
@@ -204,6 +212,9 @@ if __name__ == "__main__":
             display_how_to_use()
             exit()
 
+    # Plotting is the slowest import, only pay for it once there is data to show
+    import matplotlib.pyplot as plt
+
     fig, ax = plt.subplots()
     ax.plot(times_s, current_ua, '.-',label='Current')
     ax.set(xlabel='Time, s', ylabel='Current, uA')
@@ -0,0 +1,62 @@
+import subprocess
+import sys
+import os
+import time
+
+# Measures how long the entry points take to respond from a cold interpreter.
+# Each case runs in a fresh process so import cost is counted every time.
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+comparison_dir = os.path.join(this_dir, "..", "Comparison Tools")
+
+target_s = 0.5
+
+benchmark_cases = [
+    ("V2 realtime help", [os.path.join(this_dir, "metashunt_v2_realtime_interface.py"), "h"], this_dir),
+    ("V1 realtime help", [os.path.join(this_dir, "metashunt_realtime_interface.py"), "h"], this_dir),
+    ("Device discovery", ["-c", "from metashunt_v2_stream import find_metashunt_port; find_metashunt_port()"], this_dir),
+    ("Profile processing import", ["-c", "import metashunt_profile_processing"], comparison_dir),
+]
+
+def display_how_to_use():
+    print("To use, follow these rules:")
+    print("python metashunt_startup_benchmark.py [runs] --- Time each entry point from a fresh interpreter, 5 runs by default")
+
+def time_case(args, cwd, runs):
+    times = []
+    for run in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable] + args, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        times.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            print(result.stderr.decode(errors="replace"))
+            return None
+    times.sort()
+    return times[len(times) // 2]
+
+if __name__ == "__main__":
+
+    runs = 5
+    if len(sys.argv) > 1:
+        if sys.argv[1] == 'h':
+            display_how_to_use()
+            exit()
+        runs = int(sys.argv[1])
+
+    baseline = time_case(["-c", "pass"], this_dir, runs)
+    print("Bare interpreter: {0:.3f} s".format(baseline))
+
+    all_passed = True
+    for name, args, cwd in benchmark_cases:
+        median_s = time_case(args, cwd, runs)
+        if median_s is None:
+            print("{0}: FAILED".format(name))
+            all_passed = False
+            continue
+        passed = median_s < target_s
+        all_passed = all_passed and passed
+        print("{0}: {1:.3f} s median over {2} runs ({3:.3f} s over bare interpreter) {4}".format(
+            name, median_s, runs, median_s - baseline, "OK" if passed else "SLOW"))
+
+    if not all_passed:
+        sys.exit(1)
@@ -0,0 +1,466 @@
+import numpy as np
+import csv
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Comparison Tools"))
+
+import metashunt_capture
+
+# Online anomaly detection on the decoded sample stream, for long soak tests.
+#
+# Samples are sorted into phases by current level (decade bands by default, so sleep, idle and
+# active each get their own). The stream is cut into blocks, and each block adds the median,
+# maximum and minimum of every phase it contains to that phase's ring of recent blocks. Baselines
+# are medians over the ring, and spreads are scaled median absolute deviations, so they follow
+# slow drift while single excursions do not move them. Three kinds of excursion are flagged:
+#
+#   spike     a sample outside the envelope of the phase the signal is sitting in, or while it
+#             sits in a phase never seen during the discovery period. The envelope runs from a
+#             low quantile of the recent block minima to a high quantile of the maxima, so edge
+#             blocks that recur are inside it while a few outliers are not. The phase the signal
+#             sits in is the phase edge_guard samples either side, and samples where those differ
+#             are on a ramp between phases and are not checked. Each check waits for those
+#             edge_guard later samples.
+#   level     a block median away from the phase baseline, such as a leakage step. Reported
+#             once per excursion, when the block it starts in is complete.
+#   dwell     a phase lasting far longer than its recent runs, such as a stuck radio.
+#
+# Each alert goes to on_alert once the chunk it is detected in has been checked, numbered in order
+# of the newest sample its detection needed, then collects post_samples of context and is returned
+# from process (and passed to on_complete) with the samples around it. All checks over samples are
+# array operations, and the per-block work is a handful of medians over short rings. The stream is
+# worked through in segments of SUBCHUNK_BLOCKS blocks at fixed stream positions, and spike
+# envelopes only change between segments, so the alerts, their numbers and their delays (counted in
+# stream samples up to the newest sample the decision needed) are the same however the stream is
+# chunked. Running this file checks that on a synthetic trace.
+
+ANOMALY_SPIKE = "spike"
+ANOMALY_LEVEL = "level"
+ANOMALY_DWELL = "dwell"
+
+DEFAULT_PHASE_EDGES_UA = (1.0, 10.0, 100.0, 1.0e3, 1.0e4, 1.0e5)
+MAD_TO_SIGMA = 1.4826
+SUBCHUNK_BLOCKS = 4
+
+class ANOMALY_ALERT:
+    # value, baseline and threshold are currents in uA, except for dwell alerts where they are run lengths in samples
+    def __init__(self, number, kind, phase, index, tick, value, baseline, threshold, detected_index):
+        self.number = number
+        self.kind = kind
+        self.phase = phase
+        self.index = index  # Sample index in the stream where the excursion starts
+        self.tick = tick
+        self.value = value
+        self.baseline = baseline
+        self.threshold = threshold
+        self.detected_index = detected_index  # Newest sample the detection needed
+        # Context, filled in once post_samples have arrived
+        self.ticks = None
+        self.currents_ua = None
+        self.alert_position = None  # Position of the alert sample in the context
+
+    @property
+    def delay_samples(self):
+        return self.detected_index - self.index
+
+    @property
+    def unit(self):
+        return "samples" if self.kind == ANOMALY_DWELL else "uA"
+
+    def describe(self, ticks_per_us=metashunt_capture.DEFAULT_TICKS_PER_US):
+        return "Anomaly {0} ({1}, phase {2}) at {3:.6f} s: {4:.6g} {7} against baseline {5:.6g} {7}, threshold {6:.6g} {7}".format(
+            self.number, self.kind, self.phase, self.tick / ticks_per_us / 1.0e6, self.value, self.baseline, self.threshold, self.unit)
+
+# Recent block statistics of one phase
+class PHASE_BASELINE:
+    def __init__(self, blocks):
+        self.medians = np.zeros(blocks)
+        self.maxima = np.zeros(blocks)
+        self.minima = np.zeros(blocks)
+        self.runs = np.zeros(blocks)  # Lengths of completed runs, in blocks
+        self.count = 0
+        self.run_count = 0
+        self.run_blocks = 0  # Current run
+        self.in_level_alarm = False
+        self.in_dwell_alarm = False
+
+    def add(self, median, maximum, minimum):
+        k = self.count % len(self.medians)
+        self.medians[k], self.maxima[k], self.minima[k] = median, maximum, minimum
+        self.count += 1
+
+    def end_run(self):
+        if self.run_blocks:
+            self.runs[self.run_count % len(self.runs)] = self.run_blocks
+            self.run_count += 1
+        self.run_blocks = 0
+        self.in_dwell_alarm = False
+
+    # (median, robust spread) of the filled part of a ring, and the quantile q of it if given.
+    # The rings are short, so sorting beats np.median and np.quantile, which are mostly overhead here
+    @staticmethod
+    def location(ring, filled, q=None):
+        values = np.sort(ring[:filled])
+        centre = 0.5 * (values[(filled - 1) // 2] + values[filled // 2])
+        deviations = np.sort(np.abs(values - centre))
+        spread = MAD_TO_SIGMA * 0.5 * (deviations[(filled - 1) // 2] + deviations[filled // 2])
+        if q is None:
+            return centre, spread
+        position = q * (filled - 1)
+        below = int(position)
+        above = min(below + 1, filled - 1)
+        return centre, spread, values[below] + (position - below) * (values[above] - values[below])
+
+class ANOMALY_DETECTOR:
+    def __init__(self, phase_edges_ua=DEFAULT_PHASE_EDGES_UA, k=6.0, block_samples=256, baseline_blocks=64, warmup_blocks=8,
+                 min_phase_samples=None, hysteresis=0.2, rel_floor=0.02, abs_floor_ua=0.05, dwell_factor=4.0, min_dwell_blocks=16,
+                 envelope_quantile=0.95, edge_guard=8, discovery_blocks=16384,
+                 pre_samples=2000, post_samples=6000, holdoff_samples=None, on_alert=None, on_complete=None):
+        self.phase_edges_ua = np.asarray(phase_edges_ua, dtype=np.float64)
+        self.k = k
+        self.block_samples = int(block_samples)
+        self.baseline_blocks = int(baseline_blocks)
+        self.warmup_blocks = int(warmup_blocks)
+        self.min_phase_samples = self.block_samples // 4 if min_phase_samples is None else int(min_phase_samples)
+        self.hysteresis = hysteresis
+        self.rel_floor = rel_floor
+        self.abs_floor_ua = abs_floor_ua
+        self.dwell_factor = dwell_factor
+        self.min_dwell_blocks = int(min_dwell_blocks)
+        self.envelope_quantile = envelope_quantile
+        self.edge_guard = int(edge_guard)
+        self.discovery_blocks = int(discovery_blocks)  # About 33 s at 127.5 kHz with 256 sample blocks
+        self.pre_samples = int(pre_samples)
+        self.post_samples = int(post_samples)
+        self.holdoff_samples = self.block_samples if holdoff_samples is None else int(holdoff_samples)
+        self.on_alert = on_alert
+        self.on_complete = on_complete
+        self.reset()
+
+    @property
+    def n_phases(self):
+        return len(self.phase_edges_ua) + 1
+
+    def reset(self):
+        self.phases = [PHASE_BASELINE(self.baseline_blocks) for _ in range(self.n_phases)]
+        self.blocks_seen = 0
+        self.current_phase = None
+        self.samples_seen = 0
+        self.partial_currents = np.zeros(0)
+        self.last_spike_index = -np.inf
+        self.spike_checked = 0  # Samples before this have been checked for spikes
+        self.alert_count = 0
+        self.alerts_by_kind = {ANOMALY_SPIKE: 0, ANOMALY_LEVEL: 0, ANOMALY_DWELL: 0}
+        self.max_delay_samples = 0
+        # Recent samples for context, starting at history_start in the stream
+        self.history_ticks = np.zeros(0, dtype=np.int64)
+        self.history_currents = np.zeros(0)
+        self.history_start = 0
+        self.pending = []
+        self.detections = []  # (detected_index, index, ...) found in the current segment, not yet numbered
+        # Spike limits per phase, unchecked until a phase has warmed up
+        self.high_ua = np.full(self.n_phases, np.inf)
+        self.low_ua = np.full(self.n_phases, -np.inf)
+        self.baseline_ua = np.full(self.n_phases, np.nan)
+        self.envelope_counts = np.zeros(self.n_phases, dtype=np.int64)  # Ring counts the limits were computed from
+        self.previous_envelopes = self.high_ua.copy(), self.low_ua.copy()
+        self.envelope_start = 0
+
+    def _floor(self, baseline_ua):
+        return max(self.abs_floor_ua, self.rel_floor * abs(baseline_ua))
+
+    # Spike limits per phase from the rings so far. Phases still warming up are not checked, and
+    # phases never seen are out of bounds once the discovery period is over. The limits in use
+    # before are kept for samples of the previous segment still waiting for their edge guard.
+    # Only phases whose rings changed since the last update are recomputed.
+    def _update_envelopes(self):
+        self.previous_envelopes = self.high_ua.copy(), self.low_ua.copy()
+        discovered = self.blocks_seen >= self.discovery_blocks
+        for p, phase in enumerate(self.phases):
+            if phase.count == 0:
+                if discovered:
+                    self.high_ua[p], self.low_ua[p] = -np.inf, np.inf
+                continue
+            filled = min(phase.count, self.baseline_blocks)
+            if filled < self.warmup_blocks:
+                self.high_ua[p], self.low_ua[p] = np.inf, -np.inf
+                continue
+            if phase.count == self.envelope_counts[p]:
+                continue
+            self.envelope_counts[p] = phase.count
+            baseline, _ = phase.location(phase.medians, filled)
+            _, top_spread, top = phase.location(phase.maxima, filled, self.envelope_quantile)
+            _, bottom_spread, bottom = phase.location(phase.minima, filled, 1.0 - self.envelope_quantile)
+            floor = self._floor(baseline)
+            self.baseline_ua[p] = baseline
+            self.high_ua[p] = top + self.k * max(top_spread, floor)
+            self.low_ua[p] = bottom - self.k * max(bottom_spread, floor)
+
+    def _alert(self, kind, phase, index, tick, value, baseline, threshold, detected_index):
+        self.detections.append((int(detected_index), int(index), kind, int(phase), int(tick), float(value), float(baseline), float(threshold)))
+
+    # Numbers and publishes the detections of a segment in stream order. Every detection needing only
+    # samples already seen has been made by now, so the order does not depend on the chunking.
+    def _publish_alerts(self):
+        for detected_index, index, kind, phase, tick, value, baseline, threshold in sorted(self.detections, key=lambda d: d[:2]):
+            self.alert_count += 1
+            self.alerts_by_kind[kind] += 1
+            alert = ANOMALY_ALERT(self.alert_count, kind, phase, index, tick, value, baseline, threshold, detected_index)
+            self.max_delay_samples = max(self.max_delay_samples, alert.delay_samples)
+            first = max(alert.index - self.pre_samples, self.history_start)
+            self.pending.append({"alert": alert, "first": first, "last": alert.index + self.post_samples})
+            if self.on_alert:
+                self.on_alert(alert)
+        self.detections = []
+
+    # Checks every sample that has edge_guard samples after it, up to stream index end (exclusive).
+    # Past the end of the stream the newest sample stands in for the missing ones.
+    def _check_spikes(self, end, final=False):
+        start = self.spike_checked
+        stop = end if final else end - self.edge_guard
+        if stop <= start:
+            return
+        indices = np.arange(start, stop)
+        offset = self.history_start
+        phase_at = lambda positions: np.searchsorted(self.phase_edges_ua, self.history_currents[positions - offset], side="right")
+        before = phase_at(np.maximum(indices - self.edge_guard, 0))
+        after = phase_at(np.minimum(indices + self.edge_guard, end - 1))
+        currents_ua = self.history_currents[start - offset:stop - offset]
+        self.spike_checked = stop
+
+        # Samples of the previous segment use the limits that were in force when they arrived
+        high = self.high_ua[after]
+        low = self.low_ua[after]
+        earlier = indices < self.envelope_start
+        if earlier.any():
+            high[earlier] = self.previous_envelopes[0][after[earlier]]
+            low[earlier] = self.previous_envelopes[1][after[earlier]]
+        flagged = np.flatnonzero((before == after) & ((currents_ua > high) | (currents_ua < low)))
+        if len(flagged) == 0:
+            return
+        # One alert per excursion: consecutive flagged samples closer than the hold-off belong together
+        gaps = np.diff(np.concatenate(([self.last_spike_index], indices[flagged])))
+        for i in flagged[gaps > self.holdoff_samples]:
+            p = after[i]
+            threshold = high[i] if currents_ua[i] > high[i] else low[i]
+            self._alert(ANOMALY_SPIKE, p, indices[i], self.history_ticks[indices[i] - offset], currents_ua[i], self.baseline_ua[p],
+                        threshold if np.isfinite(threshold) else np.nan, min(indices[i] + self.edge_guard, end - 1))
+        self.last_spike_index = indices[flagged[-1]]
+
+    # Per block and phase (sample count, median, maximum, minimum) from one sort of each block. Phases
+    # are value bands, so each phase is a contiguous run of a sorted block.
+    def _block_stats(self, blocks):
+        ordered = np.sort(blocks, axis=1)
+        rows = np.arange(len(blocks))[:, None]
+        bounds = np.stack([(ordered < edge).sum(axis=1) for edge in self.phase_edges_ua], axis=1)
+        starts = np.concatenate((np.zeros((len(blocks), 1), dtype=bounds.dtype), bounds), axis=1)
+        ends = np.concatenate((bounds, np.full((len(blocks), 1), self.block_samples)), axis=1)
+        counts = ends - starts
+        # Columns are phases. Entries where a phase has no samples are meaningless and never used.
+        at = lambda positions: ordered[rows, np.clip(positions, 0, self.block_samples - 1)]
+        medians = (at(starts + (counts - 1) // 2) + at(starts + counts // 2)) / 2.0
+        block_medians = (ordered[:, (self.block_samples - 1) // 2] + ordered[:, self.block_samples // 2]) / 2.0
+        return counts, medians, at(ends - 1), at(starts), block_medians
+
+    # Phase of a block median, staying in the current phase until the median is clearly past its edges
+    def _block_phase(self, median):
+        p = self.current_phase
+        if p is not None:
+            low = self.phase_edges_ua[p - 1] / (1.0 + self.hysteresis) if p > 0 else -np.inf
+            high = self.phase_edges_ua[p] * (1.0 + self.hysteresis) if p < len(self.phase_edges_ua) else np.inf
+            if low <= median < high:
+                return p
+        return int(np.searchsorted(self.phase_edges_ua, median, side="right"))
+
+    # Blocks completed by currents_ua, which are already in the history
+    def _process_blocks(self, currents_ua):
+        blocks = np.concatenate((self.partial_currents, currents_ua))
+        n_blocks = len(blocks) // self.block_samples
+        first_index = self.samples_seen - len(self.partial_currents)
+        self.partial_currents = blocks[n_blocks * self.block_samples:]
+        if n_blocks == 0:
+            return
+        blocks = blocks[:n_blocks * self.block_samples].reshape(n_blocks, self.block_samples)
+        counts, medians, maxima, minima, block_medians = self._block_stats(blocks)
+
+        for b in range(n_blocks):
+            block_index = first_index + b * self.block_samples
+            block_tick = self.history_ticks[block_index - self.history_start]
+            newest_index = block_index + self.block_samples - 1
+            # Level: compare each phase's block median with its baseline before adding it. Blocks with
+            # only a few samples of a phase (edges of activity) still widen its envelope.
+            for p in np.flatnonzero(counts[b]):
+                median = medians[b, p]
+                phase = self.phases[p]
+                filled = min(phase.count, self.baseline_blocks)
+                if filled >= self.warmup_blocks and counts[b, p] >= self.min_phase_samples:
+                    baseline, spread = phase.location(phase.medians, filled)
+                    threshold = self.k * max(spread, self._floor(baseline))
+                    outside = abs(median - baseline) > threshold
+                    if outside and not phase.in_level_alarm:
+                        self._alert(ANOMALY_LEVEL, p, block_index, block_tick, median, baseline, threshold, newest_index)
+                    phase.in_level_alarm = outside
+                phase.add(median, maxima[b, p], minima[b, p])
+
+            # Dwell: the phase of the block is the phase of its median
+            block_phase = self._block_phase(block_medians[b])
+            if block_phase != self.current_phase:
+                if self.current_phase is not None:
+                    self.phases[self.current_phase].end_run()
+                self.current_phase = block_phase
+            phase = self.phases[block_phase]
+            phase.run_blocks += 1
+            runs = min(phase.run_count, self.baseline_blocks)
+            if runs >= self.warmup_blocks and not phase.in_dwell_alarm:
+                limit = max(self.dwell_factor * np.median(phase.runs[:runs]), self.min_dwell_blocks)
+                if phase.run_blocks > limit:
+                    phase.in_dwell_alarm = True
+                    self._alert(ANOMALY_DWELL, block_phase, block_index, block_tick, phase.run_blocks * self.block_samples,
+                                np.median(phase.runs[:runs]) * self.block_samples, limit * self.block_samples, newest_index)
+            self.blocks_seen += 1
+
+    def _collect_context(self, completed):
+        end = self.history_start + len(self.history_ticks)
+        still_pending = []
+        for entry in self.pending:
+            if entry["last"] > end:
+                still_pending.append(entry)
+                continue
+            alert = entry["alert"]
+            lo, hi = entry["first"] - self.history_start, entry["last"] - self.history_start
+            alert.ticks = self.history_ticks[lo:hi].copy()
+            alert.currents_ua = self.history_currents[lo:hi].copy()
+            alert.alert_position = alert.index - entry["first"]
+            completed.append(alert)
+            if self.on_complete:
+                self.on_complete(alert)
+        self.pending = still_pending
+
+    # Feed one decoded chunk, returns the alerts whose context is complete. The chunk is cut at
+    # segment boundaries, which fall at fixed positions in the stream whatever the chunking.
+    def process(self, ticks, currents_ua):
+        ticks = np.asarray(ticks, dtype=np.int64)
+        currents_ua = np.asarray(currents_ua, dtype=np.float64)
+        completed = []
+        step = self.block_samples * SUBCHUNK_BLOCKS
+        start = 0
+        while start < len(ticks):
+            stop = start + step - self.samples_seen % step
+            self._process_subchunk(ticks[start:stop], currents_ua[start:stop], completed)
+            start = stop
+        return completed
+
+    def _process_subchunk(self, ticks, currents_ua, completed):
+        self.history_ticks = np.concatenate((self.history_ticks, ticks))
+        self.history_currents = np.concatenate((self.history_currents, currents_ua))
+        self._process_blocks(currents_ua)
+        self.samples_seen += len(ticks)
+        self._check_spikes(self.samples_seen)
+        self._publish_alerts()
+        if self.samples_seen % (self.block_samples * SUBCHUNK_BLOCKS) == 0:
+            self._update_envelopes()
+            self.envelope_start = self.samples_seen
+
+        # Keep enough history for the pre-alert context of anything still to be detected or completed,
+        # and for the edge guard of samples still to be checked
+        self._collect_context(completed)
+        keep_from = min(self.samples_seen - len(self.partial_currents) - self.pre_samples, self.spike_checked - self.edge_guard)
+        if self.pending:
+            keep_from = min(keep_from, min(entry["first"] for entry in self.pending))
+        drop = max(keep_from - self.history_start, 0)
+        if drop:
+            self.history_ticks = self.history_ticks[drop:]
+            self.history_currents = self.history_currents[drop:]
+            self.history_start += drop
+
+    # Checks the newest samples without their full edge guard, then completes the alerts still
+    # collecting context with whatever has arrived
+    def flush(self):
+        completed = []
+        self._check_spikes(self.samples_seen, final=True)
+        self._publish_alerts()
+        for entry in self.pending:
+            entry["last"] = min(entry["last"], self.history_start + len(self.history_ticks))
+        self._collect_context(completed)
+        return completed
+
+def save_alert(alert, directory, ticks_per_us=metashunt_capture.DEFAULT_TICKS_PER_US):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "anomaly_{0:05d}_{1}.mscap".format(alert.number, alert.kind))
+    metashunt_capture.write_capture(path, alert.ticks, alert.currents_ua, ticks_per_us=ticks_per_us,
+                                    metadata={"kind": alert.kind, "phase": alert.phase, "alert_tick": alert.tick,
+                                              "alert_index": alert.alert_position, "value": alert.value,
+                                              "baseline": alert.baseline, "threshold": alert.threshold, "unit": alert.unit})
+    return path
+
+# Appends one CSV row per alert
+class ANOMALY_LOG:
+    columns = ["number", "kind", "phase", "time_s", "value", "baseline", "threshold", "unit", "delay_samples", "context_file"]
+
+    def __init__(self, filename, ticks_per_us=metashunt_capture.DEFAULT_TICKS_PER_US):
+        self.ticks_per_us = ticks_per_us
+        new_file = not os.path.exists(filename)
+        self.file = open(filename, "a", newline="")
+        self.writer = csv.writer(self.file)
+        if new_file:
+            self.writer.writerow(self.columns)
+
+    def write(self, alert, context_file=""):
+        self.writer.writerow([alert.number, alert.kind, alert.phase, alert.tick / self.ticks_per_us / 1.0e6, alert.value,
+                              alert.baseline, alert.threshold, alert.unit, alert.delay_samples, context_file])
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+# Synthetic soak trace: sleep with ramped bursts, plus a spike, a leakage step and a stuck burst
+def synthetic_trace(duration_s, sample_rate_hz=127500.0, seed=0):
+    rng = np.random.default_rng(seed)
+    n = int(duration_s * sample_rate_hz)
+    currents_ua = np.full(n, 5.0)
+    ramp = 5.0 * 4000.0 ** (np.arange(1, 41) / 40.0)
+    for start_s in np.arange(0.1, duration_s - 0.2, 0.5):
+        i, length = int(start_s * sample_rate_hz), int(0.05 * sample_rate_hz)
+        currents_ua[i:i + 40] = ramp
+        currents_ua[i + 40:i + length] = 2.0e4
+        currents_ua[i + length:i + length + 40] = ramp[::-1]
+    currents_ua = currents_ua * (1.0 + 0.01 * rng.standard_normal(n)) + 0.02 * rng.standard_normal(n)
+    at = lambda fraction: int(fraction * n)
+    currents_ua[at(0.4)] = 600.0
+    currents_ua[at(0.6):at(0.65)] += np.where(currents_ua[at(0.6):at(0.65)] < 100.0, 3.0, 0.0)
+    currents_ua[at(0.8):at(0.8) + int(0.4 * sample_rate_hz)] = 2.0e4
+    ticks = np.round(np.arange(n) * metashunt_capture.DEFAULT_TICKS_PER_US * 1.0e6 / sample_rate_hz).astype(np.int64)
+    return ticks, currents_ua
+
+def display_how_to_use():
+    print("To use, follow these rules:")
+    print("python metashunt_v2_anomaly.py [duration_seconds] --- Check that a synthetic trace gives the same alerts for every chunk size, 20 s by default")
+
+if __name__ == "__main__":
+
+    duration_s = 20.0
+    if len(sys.argv) > 1:
+        if sys.argv[1] == 'h':
+            display_how_to_use()
+            exit()
+        duration_s = float(sys.argv[1])
+
+    ticks, currents_ua = synthetic_trace(duration_s)
+    results = {}
+    for chunk_samples in (333, 1000, 4096, 100000):
+        alerts = []
+        detector = ANOMALY_DETECTOR(on_alert=alerts.append)
+        for start in range(0, len(ticks), chunk_samples):
+            detector.process(ticks[start:start + chunk_samples], currents_ua[start:start + chunk_samples])
+        detector.flush()
+        results[chunk_samples] = [(alert.number, alert.kind, alert.index, alert.delay_samples) for alert in alerts]
+        print("{0} sample chunks: {1} alerts {2}".format(chunk_samples, len(alerts), detector.alerts_by_kind))
+
+    reference = next(iter(results.values()))
+    for alert in reference:
+        print("  #{0} {1} at sample {2}, {3} samples to detect".format(*alert))
+    if any(result != reference for result in results.values()):
+        print("Alerts depend on the chunk size")
+        sys.exit(1)
+    print("Alerts are the same for every chunk size")
@@ -0,0 +1,122 @@
+import numpy as np
+
+# Host receive timestamps and latency tracking for the V2 stream.
+#
+# The device clock and the host clock are not synchronised, so latency is measured against a
+# running model of host time minus device time. Every decoded chunk is stamped with a monotonic
+# host time, and the freshest sample in it gives one observation of the offset. The smallest
+# offset seen in each window is the least delayed path through USB and the OS. A line through the
+# recent window minima gives offset plus clock skew. A sample's latency is then its receive (or
+# display) time minus the host time the model says it was taken, so latencies are relative to
+# the fastest observed transfer, which is what buffering and refresh tuning need.
+
+LATENCY_EDGES_MS = np.logspace(-2, 4, 61)  # 10 us to 10 s, 10 bins per decade
+
+class CLOCK_OFFSET_MODEL:
+    def __init__(self, window_s=5.0, max_windows=24):
+        self.window_s = window_s
+        self.max_windows = max_windows
+        self.window_start = None
+        self.window_min = None  # (device_s, offset_s) of the smallest offset in the current window
+        self.minima = []
+        self.coefficients = None
+
+    def observe(self, device_s, host_s):
+        offset_s = host_s - device_s
+        if self.window_start is None:
+            self.window_start = host_s
+        if self.window_min is None or offset_s < self.window_min[1]:
+            self.window_min = (device_s, offset_s)
+        if host_s - self.window_start >= self.window_s:
+            self.minima = (self.minima + [self.window_min])[-self.max_windows:]
+            self.window_start = host_s
+            self.window_min = None
+        self._fit()
+
+    def _fit(self):
+        points = self.minima + ([self.window_min] if self.window_min is not None else [])
+        device, offset = np.array(points).T
+        if len(points) >= 3 and np.ptp(device) > 0:
+            skew, intercept = np.polyfit(device, offset, 1)
+            # The line has to stay at or below every minimum, so shift it down to the lowest one
+            intercept += np.min(offset - (intercept + skew * device))
+            self.coefficients = (intercept, skew)
+        else:
+            self.coefficients = (float(offset.min()), 0.0)
+
+    @property
+    def ready(self):
+        return self.coefficients is not None
+
+    # Host time at which samples at these device times were taken
+    def expected_host_s(self, device_s):
+        intercept, skew = self.coefficients
+        device_s = np.asarray(device_s, dtype=np.float64)
+        return device_s + intercept + skew * device_s
+
+class LATENCY_HISTOGRAM:
+    def __init__(self, edges_ms=LATENCY_EDGES_MS):
+        self.edges_ms = np.asarray(edges_ms, dtype=np.float64)
+        self.counts = np.zeros(len(self.edges_ms) + 1, dtype=np.int64)  # Underflow and overflow at the ends
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def reset(self):
+        self.counts[:] = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    @property
+    def count(self):
+        return int(self.counts.sum())
+
+    @property
+    def mean_ms(self):
+        return self.total_ms / self.count if self.count else float("nan")
+
+    def add(self, latencies_s):
+        latencies_ms = np.maximum(np.atleast_1d(np.asarray(latencies_s, dtype=np.float64)) * 1.0e3, 0.0)
+        if len(latencies_ms) == 0:
+            return
+        self.counts += np.bincount(np.searchsorted(self.edges_ms, latencies_ms, side="right"), minlength=len(self.counts))
+        self.total_ms += float(latencies_ms.sum())
+        self.max_ms = max(self.max_ms, float(latencies_ms.max()))
+
+    # Upper bin edge below which a fraction q of latencies fall
+    def percentile_ms(self, q):
+        if self.count == 0:
+            return float("nan")
+        k = int(np.searchsorted(np.cumsum(self.counts), q / 100.0 * self.count, side="left"))
+        return min(float(self.edges_ms[min(k, len(self.edges_ms) - 1)]), self.max_ms)
+
+    def summary(self):
+        return "p50 {0:.3g} ms, p95 {1:.3g} ms, p99 {2:.3g} ms, max {3:.3g} ms ({4} samples)".format(
+            self.percentile_ms(50), self.percentile_ms(95), self.percentile_ms(99), self.max_ms, self.count)
+
+# Offset model plus the sample to decode and sample to display latency distributions
+class LATENCY_TRACKER:
+    def __init__(self, window_s=5.0):
+        self.clock = CLOCK_OFFSET_MODEL(window_s)
+        self.decode = LATENCY_HISTOGRAM()
+        self.display = LATENCY_HISTOGRAM()
+
+    def reset(self):
+        self.clock = CLOCK_OFFSET_MODEL(self.clock.window_s)
+        self.decode.reset()
+        self.display.reset()
+
+    # A decoded chunk of samples received at host_s, one time for the chunk or one per sample
+    def chunk_received(self, device_s, host_s):
+        device_s = np.asarray(device_s, dtype=np.float64)
+        if len(device_s) == 0:
+            return
+        host_s = np.broadcast_to(np.asarray(host_s, dtype=np.float64), device_s.shape)
+        k = int(np.argmin(host_s - device_s))
+        self.clock.observe(float(device_s[k]), float(host_s[k]))
+        self.decode.add(host_s - self.clock.expected_host_s(device_s))
+
+    # Samples handed to the display at host_s
+    def displayed(self, device_s, host_s):
+        if len(device_s) == 0 or not self.clock.ready:
+            return
+        self.display.add(host_s - self.clock.expected_host_s(device_s))
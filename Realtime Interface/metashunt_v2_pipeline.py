@@ -0,0 +1,310 @@
+import numpy as np
+import threading
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Comparison Tools"))
+
+import metashunt_capture
+import metashunt_v2_trigger
+import metashunt_v2_anomaly
+
+# Streaming analyzer pipeline for the decoded V2 sample stream.
+#
+# The reader only calls submit(ticks, currents_ua), which queues the batch for every registered
+# analyzer and returns at once. Each analyzer keeps its own state and backlog and is drained on a
+# shared worker pool, one drain at a time per analyzer, so it always sees batches in order while
+# different analyzers run in parallel. A drain concatenates everything queued since the last one
+# into a single batch, so a slow analyzer works on larger vectorized batches instead of falling
+# further behind. Analyzers declare their outputs up front, and results() returns the latest
+# values of each.
+
+class SAMPLE_BATCH:
+    def __init__(self, ticks, currents_ua, first_sample, ticks_per_us=metashunt_capture.DEFAULT_TICKS_PER_US):
+        self.ticks = ticks
+        self.currents_ua = currents_ua
+        self.first_sample = first_sample  # Index of the first sample in the whole stream
+        self.ticks_per_us = ticks_per_us
+
+    def __len__(self):
+        return len(self.ticks)
+
+    @property
+    def t_s(self):
+        return self.ticks / (self.ticks_per_us * 1.0e6)
+
+# Base class. Subclasses set name and outputs ({output name: description}) and implement process,
+# returning a dict of updated outputs or None. finish runs once after the last batch.
+class ANALYZER:
+    name = "analyzer"
+    outputs = {}
+
+    def process(self, batch):
+        raise NotImplementedError
+
+    def finish(self):
+        return None
+
+class STATS_ANALYZER(ANALYZER):
+    name = "stats"
+    outputs = {
+        "samples": "Samples seen",
+        "mean_ua": "Mean current (uA)",
+        "min_ua": "Minimum current (uA)",
+        "max_ua": "Maximum current (uA)",
+        "charge_uAh": "Charge, each sample held until the next (uAh)",
+    }
+
+    def __init__(self):
+        self.samples = 0
+        self.sum_ua = 0.0
+        self.min_ua = np.inf
+        self.max_ua = -np.inf
+        self.charge_uAs = 0.0
+        self.last = None
+
+    def process(self, batch):
+        t_s = batch.t_s
+        currents_ua = np.asarray(batch.currents_ua, dtype=np.float64)
+        if self.last is not None:
+            self.charge_uAs += self.last[1] * (t_s[0] - self.last[0])
+        self.charge_uAs += float(np.sum(currents_ua[:-1] * np.diff(t_s)))
+        self.last = (t_s[-1], currents_ua[-1])
+        self.samples += len(batch)
+        self.sum_ua += float(np.sum(currents_ua))
+        self.min_ua = min(self.min_ua, float(currents_ua.min()))
+        self.max_ua = max(self.max_ua, float(currents_ua.max()))
+        return {"samples": self.samples, "mean_ua": self.sum_ua / self.samples, "min_ua": self.min_ua,
+                "max_ua": self.max_ua, "charge_uAh": float(self.charge_uAs) / 3600.0}
+
+class TRIGGER_ANALYZER(ANALYZER):
+    name = "trigger"
+    outputs = {
+        "event_count": "Events completed",
+        "last_event_path": "Capture of the latest event, if saving",
+    }
+
+    def __init__(self, trigger, output_dir=None, on_saved=None):
+        self.trigger = trigger
+        self.output_dir = output_dir
+        self.on_saved = on_saved
+
+    def process(self, batch):
+        events = self.trigger.process(batch.ticks, batch.currents_ua)
+        if not events:
+            return None
+        result = {"event_count": self.trigger.event_count}
+        if self.output_dir is not None:
+            for event in events:
+                path = metashunt_v2_trigger.save_event(event, self.output_dir, batch.ticks_per_us)
+                if self.on_saved:
+                    self.on_saved(event, path)
+            result["last_event_path"] = path
+        return result
+
+class CAPTURE_ANALYZER(ANALYZER):
+    name = "capture"
+    outputs = {"samples_written": "Samples written to the capture"}
+
+    def __init__(self, filename, **writer_kwargs):
+        self.writer = metashunt_capture.CAPTURE_WRITER(filename, **writer_kwargs)
+        self.samples_written = 0
+
+    def process(self, batch):
+        self.writer.write(batch.ticks, batch.currents_ua)
+        self.samples_written += len(batch)
+        return {"samples_written": self.samples_written}
+
+    def finish(self):
+        self.writer.close()
+        return {"samples_written": self.samples_written}
+
+# Runs a FILTER_BANK on the stream. With a base filename, each filtered channel is appended to
+# its own capture (base_name.mscap) as it is produced, alongside the raw capture.
+class FILTER_ANALYZER(ANALYZER):
+    name = "filters"
+    outputs = {
+        "latest_ua": "Latest output of each filter channel (uA)",
+        "samples_written": "Filtered samples produced per channel",
+    }
+
+    def __init__(self, filter_bank, base_filename=None, **writer_kwargs):
+        self.filter_bank = filter_bank
+        self.writers = {}
+        if base_filename is not None:
+            base = base_filename[:-len(metashunt_capture.CAPTURE_EXTENSION)] if base_filename.endswith(metashunt_capture.CAPTURE_EXTENSION) else base_filename
+            for name, stream_filter in filter_bank.filters.items():
+                metadata = {"filter": type(stream_filter).__name__, "group_delay_samples": stream_filter.group_delay_samples}
+                self.writers[name] = metashunt_capture.CAPTURE_WRITER("{0}_{1}{2}".format(base, name, metashunt_capture.CAPTURE_EXTENSION),
+                                                                      metadata=metadata, **writer_kwargs)
+        self.samples_written = {name: 0 for name in filter_bank.filters}
+        self.latest_ua = {}
+
+    def process(self, batch):
+        for name, (ticks, values) in self.filter_bank.process(batch.ticks, batch.currents_ua).items():
+            if len(values) == 0:
+                continue
+            if name in self.writers:
+                self.writers[name].write(ticks, values)
+            self.samples_written[name] += len(values)
+            self.latest_ua[name] = float(values[-1])
+        return {"latest_ua": dict(self.latest_ua), "samples_written": dict(self.samples_written)}
+
+    def finish(self):
+        for writer in self.writers.values():
+            writer.close()
+        return {"samples_written": dict(self.samples_written)}
+
+# Runs an ANOMALY_DETECTOR on the stream. Alerts reach the detector's on_alert from the worker
+# thread as soon as they are found. Once their context is complete they are logged and, with an
+# output directory, saved as captures.
+class ANOMALY_ANALYZER(ANALYZER):
+    name = "anomaly"
+    outputs = {
+        "alert_count": "Alerts raised",
+        "alerts_by_kind": "Alerts raised per kind",
+        "max_delay_samples": "Largest delay between an excursion and its alert, in samples",
+        "last_alert": "Description of the latest completed alert",
+    }
+
+    def __init__(self, detector, output_dir=None, log_filename=None):
+        self.detector = detector
+        self.output_dir = output_dir
+        self.log = metashunt_v2_anomaly.ANOMALY_LOG(log_filename) if log_filename is not None else None
+        self.ticks_per_us = metashunt_capture.DEFAULT_TICKS_PER_US
+
+    def _record(self, completed):
+        result = {"alert_count": self.detector.alert_count, "alerts_by_kind": dict(self.detector.alerts_by_kind),
+                  "max_delay_samples": self.detector.max_delay_samples}
+        for alert in completed:
+            path = metashunt_v2_anomaly.save_alert(alert, self.output_dir, self.ticks_per_us) if self.output_dir is not None else ""
+            if self.log is not None:
+                self.log.write(alert, path)
+            result["last_alert"] = alert.describe(self.ticks_per_us)
+        return result
+
+    def process(self, batch):
+        self.ticks_per_us = batch.ticks_per_us
+        return self._record(self.detector.process(batch.ticks, batch.currents_ua))
+
+    def finish(self):
+        result = self._record(self.detector.flush())
+        if self.log is not None:
+            self.log.close()
+        return result
+
+class ANALYZER_STATE:
+    def __init__(self, analyzer, max_backlog_samples):
+        self.analyzer = analyzer
+        self.max_backlog_samples = max_backlog_samples
+        self.backlog = []
+        self.backlog_samples = 0
+        self.dropped_samples = 0
+        self.scheduled = False
+        self.results = {}
+        self.error = None
+
+class ANALYZER_PIPELINE:
+    def __init__(self, workers=None, max_backlog_samples=None, ticks_per_us=metashunt_capture.DEFAULT_TICKS_PER_US):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="analyzer")
+        self.max_backlog_samples = max_backlog_samples
+        self.ticks_per_us = ticks_per_us
+        self.states = {}
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.samples_submitted = 0
+
+    def register(self, analyzer, max_backlog_samples=None):
+        if analyzer.name in self.states:
+            raise ValueError("An analyzer named '{0}' is already registered".format(analyzer.name))
+        limit = self.max_backlog_samples if max_backlog_samples is None else max_backlog_samples
+        self.states[analyzer.name] = ANALYZER_STATE(analyzer, limit)
+        return analyzer
+
+    # {analyzer name: {output name: description}}
+    def declared_outputs(self):
+        return {name: dict(state.analyzer.outputs) for name, state in self.states.items()}
+
+    # Called from the reader thread, never waits on an analyzer
+    def submit(self, ticks, currents_ua):
+        n = len(ticks)
+        if n == 0:
+            return
+        batch = SAMPLE_BATCH(np.asarray(ticks, dtype=np.int64), np.asarray(currents_ua), self.samples_submitted, self.ticks_per_us)
+        self.samples_submitted += n
+        with self.lock:
+            for state in self.states.values():
+                if state.error is not None:
+                    continue
+                # An analyzer that cannot keep up loses data rather than holding up acquisition
+                if state.max_backlog_samples is not None and state.backlog_samples + n > state.max_backlog_samples:
+                    state.dropped_samples += n
+                    continue
+                state.backlog.append(batch)
+                state.backlog_samples += n
+                if not state.scheduled:
+                    state.scheduled = True
+                    self.executor.submit(self._drain, state)
+
+    def _store(self, state, produced):
+        if not produced:
+            return
+        unknown = set(produced) - set(state.analyzer.outputs)
+        if unknown:
+            raise ValueError("Analyzer '{0}' produced undeclared outputs {1}".format(state.analyzer.name, sorted(unknown)))
+        state.results.update(produced)
+
+    def _drain(self, state):
+        while True:
+            with self.lock:
+                batches = state.backlog
+                if not batches or state.error is not None:
+                    state.backlog = []
+                    state.backlog_samples = 0
+                    state.scheduled = False
+                    self.idle.notify_all()
+                    return
+                state.backlog = []
+                state.backlog_samples = 0
+
+            if len(batches) == 1:
+                batch = batches[0]
+            else:
+                batch = SAMPLE_BATCH(np.concatenate([b.ticks for b in batches]), np.concatenate([b.currents_ua for b in batches]),
+                                     batches[0].first_sample, self.ticks_per_us)
+            try:
+                produced = state.analyzer.process(batch)
+                with self.lock:
+                    self._store(state, produced)
+            except Exception as e:
+                state.error = e
+
+    # Latest outputs, {analyzer name: {output name: value}}
+    def results(self):
+        with self.lock:
+            return {name: dict(state.results) for name, state in self.states.items()}
+
+    def errors(self):
+        return {name: state.error for name, state in self.states.items() if state.error is not None}
+
+    def dropped_samples(self):
+        return {name: state.dropped_samples for name, state in self.states.items() if state.dropped_samples}
+
+    # Waits for every queued batch to be processed
+    def flush(self):
+        with self.idle:
+            self.idle.wait_for(lambda: not any(state.scheduled for state in self.states.values()))
+
+    # Flushes, lets each analyzer finish and returns the final results
+    def close(self):
+        self.flush()
+        for state in self.states.values():
+            try:
+                produced = state.analyzer.finish()
+                with self.lock:
+                    self._store(state, produced)
+            except Exception as e:
+                state.error = e
+        self.executor.shutdown()
+        return self.results()
@@ -3,11 +3,12 @@ import time
 import struct 
 import array
 import sys 
+import os
 import serial.tools.list_ports
-import matplotlib
-import matplotlib.pyplot as plt
 import numpy as np
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Comparison Tools"))
+
 class MEASUREMENT:
     def __init__(self, time, current_ma):
         self.time = time 
@@ -53,15 +54,33 @@ def display_how_to_use():
     print("python metashunt_realtime_v2_interface.py h --- Provides helpful information")
     print("python metashunt_realtime_v2_interface.py s [measurement_time_seconds] --- Get streaming data, by default for 10 seconds")
     print("python metashunt_realtime_v2_interface.py l [measurement_time_seconds] [CSV_file_name] --- Log streaming data, by default for 10 seconds")
+    print("Note: Log file names ending in .mscap are written as compressed captures instead of CSV")
     print("Note: Burst measurements up to 127.5kHz")
     print("python metashunt_realtime_v2_interface.py b rate_hz --- Burst reads 37,500 samples immediately")
     print("python metashunt_realtime_v2_interface.py b rate_hz r current_level_uA --- Burst reads 37,500 samples once current rises over the specified level")
     print("python metashunt_realtime_v2_interface.py b rate_hz f current_level_uA --- Burst reads 37,500 samples once current falls below the specified level")
     print("python metashunt_realtime_v2_interface.py b rate_hz s stage_index --- Burst reads 37,500 samples once system operates at specified stage index")
     print("python metashunt_realtime_v2_interface.py b rate_hz i --- Burst reads 37,500 samples once KEY2 button is pressed")
+    print("Software triggers run on the stream and save pre and post trigger samples of every event to output_dir")
+    print("python metashunt_realtime_v2_interface.py t measurement_time_seconds r current_level_uA output_dir --- Trigger when current rises over the level")
+    print("python metashunt_realtime_v2_interface.py t measurement_time_seconds f current_level_uA output_dir --- Trigger when current falls below the level")
+    print("python metashunt_realtime_v2_interface.py t measurement_time_seconds e current_level_uA output_dir --- Trigger when current crosses the level either way")
+    print("python metashunt_realtime_v2_interface.py t measurement_time_seconds w low_uA high_uA output_dir --- Trigger when current leaves the window")
+    print("python metashunt_realtime_v2_interface.py t measurement_time_seconds p current_level_uA min_width_us max_width_us output_dir --- Trigger on pulses over the level with width in range")
+    print("python metashunt_realtime_v2_interface.py a measurement_time_seconds output_dir [sigma] --- Flag spikes, level steps and overlong phases, saving each with context to output_dir, 6 sigma by default")
 
 if __name__ == "__main__":
 
+    # Help and bad input need no device, so answer them before connecting
+    if len(sys.argv) < 2:
+        print("Incorrect inputs. Please follow the instructions below.")
+        print("..........")
+        display_how_to_use()
+        exit()
+    elif sys.argv[1] == 'h':
+        display_how_to_use()
+        exit()
+
     # Figure out the correct port
     port = ""
     connected = [comport for comport in serial.tools.list_ports.comports()]
@@ -182,6 +201,88 @@ if __name__ == "__main__":
                     info = struct.unpack(line_spec, array.array('B',payload).tobytes())
                     measurements.append(MEASUREMENT(time=info[0],current_ma=info[1]))
                     data_received = data_received + 1
+        elif command_character == 't':
+            from metashunt_v2_stream import STREAM_READER, TICKS_PER_US
+            import metashunt_v2_trigger as mtrig
+            import metashunt_v2_pipeline as mpipe
+            from metashunt_v2_latency import LATENCY_TRACKER
+
+            edge_conditions = {'r': mtrig.TRIGGER_RISING, 'f': mtrig.TRIGGER_FALLING, 'e': mtrig.TRIGGER_EITHER}
+            trig_type = sys.argv[3] if len(sys.argv) > 3 else None
+            if trig_type in edge_conditions and len(sys.argv) == 6:
+                trigger = mtrig.SOFTWARE_TRIGGER(edge_conditions[trig_type], level_ua=float(sys.argv[4]))
+            elif trig_type == 'w' and len(sys.argv) == 7:
+                trigger = mtrig.SOFTWARE_TRIGGER(mtrig.TRIGGER_WINDOW_EXIT, level_ua=float(sys.argv[4]), high_ua=float(sys.argv[5]))
+            elif trig_type == 'p' and len(sys.argv) == 8:
+                trigger = mtrig.SOFTWARE_TRIGGER(mtrig.TRIGGER_PULSE_HIGH, level_ua=float(sys.argv[4]),
+                                                 min_width_ticks=float(sys.argv[5]) * TICKS_PER_US, max_width_ticks=float(sys.argv[6]) * TICKS_PER_US)
+            else:
+                print("With software trigger, please provide a time, trigger type, levels and output directory")
+                display_how_to_use()
+                exit()
+
+            run_time = float(sys.argv[2])
+            output_dir = sys.argv[-1]
+            print("Software trigger armed, pre-trigger {0} samples, post-trigger {1} samples".format(trigger.pre_samples, trigger.post_samples))
+
+            # Triggering and saving run on the analyzer pool, so the read loop only decodes
+            pipeline = mpipe.ANALYZER_PIPELINE()
+            pipeline.register(mpipe.STATS_ANALYZER())
+            pipeline.register(mpipe.TRIGGER_ANALYZER(trigger, output_dir, on_saved=lambda event, path: print(
+                "Trigger {0} at {1:.6f} s saved to {2}".format(event.number, event.trigger_tick / TICKS_PER_US / 1.0e6, path))))
+
+            latency = LATENCY_TRACKER()
+            reader = STREAM_READER(ser, latency=latency)
+            ser.reset_input_buffer()
+            while(time.time() < start_time + run_time):
+                ticks, current_ma = reader.read_chunk()
+                pipeline.submit(ticks, current_ma * 1000.0)
+            ser.close()
+            results = pipeline.close()
+            for name, error in pipeline.errors().items():
+                print("Analyzer {0} failed: {1}".format(name, error))
+
+            print("Readings complete")
+            print("Readings received: {}".format(reader.packet_count))
+            print("Mean current: {}uA ".format(results["stats"].get("mean_ua", float("nan"))))
+            print("Events captured: {}".format(trigger.event_count))
+            print("Sample to decode latency: {}".format(latency.decode.summary()))
+            exit()
+        elif command_character == 'a':
+            from metashunt_v2_stream import STREAM_READER, TICKS_PER_US
+            import metashunt_v2_anomaly as manom
+            import metashunt_v2_pipeline as mpipe
+
+            if len(sys.argv) < 4:
+                print("With anomaly detection, please provide a time and output directory")
+                display_how_to_use()
+                exit()
+            run_time = float(sys.argv[2])
+            output_dir = sys.argv[3]
+            detector = manom.ANOMALY_DETECTOR(k=float(sys.argv[4]) if len(sys.argv) > 4 else 6.0,
+                                              on_alert=lambda alert: print(alert.describe(TICKS_PER_US)))
+            os.makedirs(output_dir, exist_ok=True)
+
+            pipeline = mpipe.ANALYZER_PIPELINE()
+            pipeline.register(mpipe.STATS_ANALYZER())
+            pipeline.register(mpipe.ANOMALY_ANALYZER(detector, output_dir, os.path.join(output_dir, "anomalies.csv")))
+
+            reader = STREAM_READER(ser)
+            ser.reset_input_buffer()
+            while(time.time() < start_time + run_time):
+                ticks, current_ma = reader.read_chunk()
+                pipeline.submit(ticks, current_ma * 1000.0)
+            ser.close()
+            results = pipeline.close()
+            for name, error in pipeline.errors().items():
+                print("Analyzer {0} failed: {1}".format(name, error))
+
+            print("Readings complete")
+            print("Readings received: {}".format(reader.packet_count))
+            print("Mean current: {}uA ".format(results["stats"].get("mean_ua", float("nan"))))
+            print("Anomalies: {}".format(", ".join("{0} {1}".format(n, kind) for kind, n in detector.alerts_by_kind.items())))
+            print("Longest alert delay: {} samples".format(detector.max_delay_samples))
+            exit()
         elif command_character == 'h':
             display_how_to_use()
             exit()
@@ -207,7 +308,12 @@ if __name__ == "__main__":
     print("Mean current: {}uA ".format(np.mean(current_ua)))
 
     if command_character == 'l':
-        if len(sys.argv) > 3:
+        if len(sys.argv) > 3 and sys.argv[3].endswith(".mscap"):
+            import metashunt_capture
+            ticks = times.astype(np.int64)
+            ticks[1:] += metashunt_capture.TICK_WRAP * np.cumsum(np.diff(ticks) < 0)
+            metashunt_capture.write_capture(sys.argv[3], ticks - ticks[0], current_ua)
+        elif len(sys.argv) > 3:
             csv_filename = sys.argv[3]
             csv_output = np.transpose(np.array([times_us, current_ua]))
             np.savetxt(csv_filename, csv_output, header='time [us], current [uA]', delimiter = ", ", comments='')
@@ -216,6 +322,9 @@ if __name__ == "__main__":
             display_how_to_use()
             exit()
 
+    # Plotting is the slowest import, only pay for it once there is data to show
+    import matplotlib.pyplot as plt
+
     fig, ax = plt.subplots()
     ax.plot(times_s, current_ua, '.-',label='Current')
     ax.set(xlabel='Time, s', ylabel='Current, uA')
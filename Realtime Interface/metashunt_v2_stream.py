@@ -0,0 +1,117 @@
+import numpy as np
+import time
+import serial
+import serial.tools.list_ports
+
+# Chunked decoding of the MetaShunt V2 sample stream.
+#
+# Each sample is 10 bytes: 0xAA, tick (uint32, quarter microseconds), current (float32, mA),
+# checksum (sum of the 8 payload bytes). Instead of reading one byte at a time, whole chunks
+# are read from the port and every frame in the chunk is found and unpacked with NumPy.
+
+FRAME_LENGTH = 10
+TICKS_PER_US = 4.0
+TICK_WRAP = 1 << 32
+BURST_NUMBER_MEASUREMENTS = 37500
+
+payload_dtype = np.dtype([("tick", "<u4"), ("current_ma", "<f4")])
+
+def find_metashunt_port():
+    for comport in serial.tools.list_ports.comports():
+        if "STM" in comport.description:
+            return comport.device
+    return None
+
+def burst_command(rate_hz, trigger_id=0, trigger_level=0):
+    rate_500s_hz = int(round(float(rate_hz) / 500.0))
+    payload = [0xAA, 1, 4, rate_500s_hz, trigger_id, (trigger_level >> 8) & 0xFF, trigger_level & 0xFF]
+    payload.append(sum(payload[1:]) & 0xFF)
+    return bytearray(payload)
+
+# Returns (frame start offsets, number of bytes consumed)
+def find_frames(buf):
+    n = len(buf)
+    last_start = n - FRAME_LENGTH
+    if last_start < 0:
+        return np.zeros(0, dtype=np.int64), 0
+
+    # Checksum of every possible frame start at once from a running sum
+    sums = np.concatenate(([0], np.cumsum(buf, dtype=np.int64)))
+    starts = np.arange(last_start + 1)
+    chk = (sums[starts + 9] - sums[starts + 1]) & 0xFF
+    valid = (buf[:last_start + 1] == 0xAA) & (chk == buf[starts + 9])
+
+    # Frames normally follow back to back, so follow the chain from each valid start and
+    # only search again where the chain breaks
+    frames = []
+    candidates = np.flatnonzero(valid)
+    pos = 0
+    while True:
+        k = np.searchsorted(candidates, pos)
+        if k == len(candidates):
+            break
+        p = candidates[k]
+        chain = np.arange(p, last_start + 1, FRAME_LENGTH)
+        ok = valid[chain]
+        run = len(ok) if ok.all() else int(np.argmin(ok))
+        frames.append(chain[:run])
+        pos = p + FRAME_LENGTH * run
+
+    frame_starts = np.concatenate(frames) if frames else np.zeros(0, dtype=np.int64)
+    # Keep any bytes that could still begin a frame once more data arrives
+    consumed = max(pos, last_start + 1)
+    return frame_starts, consumed
+
+def decode_frames(buf, frame_starts):
+    idx = frame_starts[:, None] + np.arange(1, 9)
+    payload = np.ascontiguousarray(buf[idx]).view(payload_dtype).reshape(-1)
+    return payload["tick"], payload["current_ma"]
+
+class STREAM_READER:
+    def __init__(self, ser, chunk_bytes=FRAME_LENGTH * 512, latency=None):
+        self.ser = ser
+        self.chunk_bytes = chunk_bytes
+        self.latency = latency  # Optional LATENCY_TRACKER fed with every chunk
+        self.last_host_s = None
+        self.pending = np.zeros(0, dtype=np.uint8)
+        self.last_tick = None
+        self.wraps = 0
+        self.packet_count = 0
+
+    # Decode raw bytes into (ticks, current_ma). Ticks are unwrapped to int64 so they keep
+    # increasing past the 32 bit rollover (about every 18 minutes).
+    def decode(self, data):
+        buf = np.concatenate((self.pending, np.frombuffer(data, dtype=np.uint8)))
+        frame_starts, consumed = find_frames(buf)
+        self.pending = buf[consumed:]
+        ticks_raw, current_ma = decode_frames(buf, frame_starts)
+        if len(ticks_raw) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        ticks = ticks_raw.astype(np.int64)
+        previous = ticks[0] if self.last_tick is None else self.last_tick
+        wrapped = np.diff(np.concatenate(([previous], ticks))) < 0
+        ticks += TICK_WRAP * (self.wraps + np.cumsum(wrapped))
+        self.wraps += int(np.count_nonzero(wrapped))
+        self.last_tick = int(ticks_raw[-1])
+        self.packet_count += len(ticks)
+        return ticks, current_ma
+
+    # Each chunk is stamped with the monotonic host time it was received, in last_host_s
+    def read_chunk(self):
+        data = self.ser.read(max(self.chunk_bytes, self.ser.in_waiting))
+        self.last_host_s = time.perf_counter()
+        ticks, current_ma = self.decode(data)
+        if self.latency is not None:
+            self.latency.chunk_received(ticks / (TICKS_PER_US * 1.0e6), self.last_host_s)
+        return ticks, current_ma
+
+    # Stream for a fixed time, returning all (ticks, current_ma) samples
+    def capture(self, duration_s):
+        ticks_chunks, current_chunks = [], []
+        end = time.time() + duration_s
+        while time.time() < end:
+            ticks, current_ma = self.read_chunk()
+            ticks_chunks.append(ticks)
+            current_chunks.append(current_ma)
+        return np.concatenate(ticks_chunks), np.concatenate(current_chunks)
@@ -0,0 +1,158 @@
+import numpy as np
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Comparison Tools"))
+
+import metashunt_capture
+
+# Oscilloscope style software trigger on the decoded sample stream.
+#
+# Each chunk is scanned for trigger conditions with array operations. The last sample of the
+# previous chunk (and any pulse still in progress) is carried over so edges on chunk boundaries
+# are not missed. A ring of the most recent pre_samples gives the pre-trigger history, and each
+# event collects post_samples more before it is complete. The trigger re-arms once the event is
+# complete plus an optional hold-off, like normal mode on a scope.
+
+TRIGGER_RISING = "rising"
+TRIGGER_FALLING = "falling"
+TRIGGER_EITHER = "either"
+TRIGGER_WINDOW_EXIT = "window_exit"
+TRIGGER_WINDOW_ENTER = "window_enter"
+TRIGGER_PULSE_HIGH = "pulse_high"
+TRIGGER_PULSE_LOW = "pulse_low"
+
+class TRIGGER_EVENT:
+    def __init__(self, number, trigger_tick, trigger_index, ticks, currents_ua):
+        self.number = number
+        self.trigger_tick = trigger_tick
+        self.trigger_index = trigger_index
+        self.ticks = ticks
+        self.currents_ua = currents_ua
+
+class SOFTWARE_TRIGGER:
+    def __init__(self, condition, level_ua=0.0, high_ua=None, min_width_ticks=0, max_width_ticks=None,
+                 pre_samples=5000, post_samples=20000, holdoff_samples=0, on_event=None):
+        self.condition = condition
+        self.level_ua = level_ua
+        self.high_ua = high_ua
+        self.min_width_ticks = min_width_ticks
+        self.max_width_ticks = max_width_ticks
+        self.pre_samples = int(pre_samples)
+        self.post_samples = max(int(post_samples), 1)
+        self.holdoff_samples = int(holdoff_samples)
+        self.on_event = on_event
+
+        self.previous = None
+        self.pulse_start_tick = None
+        self.ring_ticks = np.zeros(0, dtype=np.int64)
+        self.ring_currents = np.zeros(0, dtype=np.float64)
+        self.samples_seen = 0
+        self.armed_at = 0
+        self.pending = None
+        self.event_count = 0
+
+    # Indices in the chunk where the condition fires
+    def _candidates(self, ticks, currents_ua):
+        previous = currents_ua[0] if self.previous is None else self.previous
+        x = np.concatenate(([previous], currents_ua))
+
+        if self.condition in (TRIGGER_RISING, TRIGGER_FALLING, TRIGGER_EITHER):
+            above = x >= self.level_ua
+            rising = ~above[:-1] & above[1:]
+            falling = above[:-1] & ~above[1:]
+            if self.condition == TRIGGER_RISING:
+                return np.flatnonzero(rising)
+            if self.condition == TRIGGER_FALLING:
+                return np.flatnonzero(falling)
+            return np.flatnonzero(rising | falling)
+
+        if self.condition in (TRIGGER_WINDOW_EXIT, TRIGGER_WINDOW_ENTER):
+            inside = (x >= self.level_ua) & (x <= self.high_ua)
+            if self.condition == TRIGGER_WINDOW_EXIT:
+                return np.flatnonzero(inside[:-1] & ~inside[1:])
+            return np.flatnonzero(~inside[:-1] & inside[1:])
+
+        # Pulse width: fire at the end of a pulse whose width is within limits
+        active = x >= self.level_ua if self.condition == TRIGGER_PULSE_HIGH else x < self.level_ua
+        if self.previous is None:
+            active[0] = False
+        starts = np.flatnonzero(~active[:-1] & active[1:])
+        ends = np.flatnonzero(active[:-1] & ~active[1:])
+        start_ticks = ticks[starts]
+        if self.pulse_start_tick is not None:
+            start_ticks = np.concatenate(([self.pulse_start_tick], start_ticks))
+        widths = ticks[ends] - start_ticks[:len(ends)]
+        self.pulse_start_tick = int(start_ticks[-1]) if len(start_ticks) > len(ends) else None
+        ok = widths >= self.min_width_ticks
+        if self.max_width_ticks is not None:
+            ok &= widths <= self.max_width_ticks
+        return ends[ok]
+
+    def _finish_pending(self, events):
+        event = self.pending
+        ticks = np.concatenate(event["ticks"])
+        currents_ua = np.concatenate(event["currents"])
+        self.event_count += 1
+        completed = TRIGGER_EVENT(self.event_count, event["trigger_tick"], event["trigger_index"], ticks, currents_ua)
+        self.pending = None
+        events.append(completed)
+        if self.on_event:
+            self.on_event(completed)
+
+    # Feed one decoded chunk, returns the events completed by it
+    def process(self, ticks, currents_ua):
+        ticks = np.asarray(ticks, dtype=np.int64)
+        currents_ua = np.asarray(currents_ua, dtype=np.float64)
+        n = len(ticks)
+        events = []
+        if n == 0:
+            return events
+
+        # Finish an event started in an earlier chunk
+        k = 0
+        if self.pending is not None:
+            k = min(self.pending["remaining"], n)
+            self.pending["ticks"].append(ticks[:k])
+            self.pending["currents"].append(currents_ua[:k])
+            self.pending["remaining"] -= k
+            if self.pending["remaining"] == 0:
+                self._finish_pending(events)
+
+        candidates = self._candidates(ticks, currents_ua)
+        chunk_start = self.samples_seen
+        while self.pending is None:
+            first_allowed = max(self.armed_at - chunk_start, k, 0)
+            i = np.searchsorted(candidates, first_allowed)
+            if i == len(candidates):
+                break
+            t = int(candidates[i])
+
+            pre_ticks = np.concatenate((self.ring_ticks, ticks[:t]))[-self.pre_samples:] if self.pre_samples else ticks[:0]
+            pre_currents = np.concatenate((self.ring_currents, currents_ua[:t]))[-self.pre_samples:] if self.pre_samples else currents_ua[:0]
+            post = min(self.post_samples, n - t)
+            self.pending = {
+                "trigger_tick": int(ticks[t]),
+                "trigger_index": len(pre_ticks),
+                "ticks": [pre_ticks, ticks[t:t + post]],
+                "currents": [pre_currents, currents_ua[t:t + post]],
+                "remaining": self.post_samples - post,
+            }
+            self.armed_at = chunk_start + t + self.post_samples + self.holdoff_samples
+            k = t + post
+            if self.pending["remaining"] == 0:
+                self._finish_pending(events)
+
+        self.previous = currents_ua[-1]
+        if self.pre_samples:
+            self.ring_ticks = np.concatenate((self.ring_ticks, ticks))[-self.pre_samples:]
+            self.ring_currents = np.concatenate((self.ring_currents, currents_ua))[-self.pre_samples:]
+        self.samples_seen += n
+        return events
+
+def save_event(event, directory, ticks_per_us=metashunt_capture.DEFAULT_TICKS_PER_US):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "event_{0:05d}.mscap".format(event.number))
+    metashunt_capture.write_capture(path, event.ticks, event.currents_ua, ticks_per_us=ticks_per_us,
+                                    metadata={"trigger_tick": event.trigger_tick, "trigger_index": event.trigger_index})
+    return path